@@ -0,0 +1,669 @@
+''' benchmark.py
+
+    Benchmarks for the robot code, run them with:
+        python benchmark.py [name ...]
+'''
+
+import random
+import sys
+import timeit
+
+from fixtures import NullBoard, controller_session, sample_controller_data
+
+
+def time_per_call(func, number=10000, repeat=5):
+    ''' Return the best time in microseconds that one call of func took '''
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number * 1e6
+
+
+def sample_telemetry():
+    ''' Telemetry like the robot sends with all of the sensors attached '''
+    from protocol import TELEMETRY_KEYS
+    return {key: 10.0 + i for i, key in enumerate(TELEMETRY_KEYS)}
+
+
+def bench_codecs():
+    ''' Encode and decode speed and size of each message format '''
+    from protocol import CODECS
+
+    controller_data = sample_controller_data()
+    telemetry = sample_telemetry()
+
+    print('{:<8} {:<11} {:>10} {:>10} {:>8}'.format('codec', 'message', 'encode us', 'decode us', 'bytes'))
+    for name, codec_class in sorted(CODECS.items()):
+        codec = codec_class()
+        for message, data, encode, decode in (
+                ('controller', controller_data, codec.encode_controller, codec.decode_controller),
+                ('telemetry', telemetry, codec.encode_telemetry, codec.decode_telemetry)):
+            packed = encode(data)
+            assert decode(packed) == data
+
+            def decode_new():
+                # A frame is only decoded once
+                codec.reset()
+                return decode(packed)
+
+            print('{:<8} {:<11} {:>10.2f} {:>10.2f} {:>8}'.format(
+                name, message, time_per_call(lambda: encode(data)), time_per_call(decode_new), len(packed)))
+
+
+def bench_delta():
+    ''' Bytes sent and decode speed with delta frames compared to sending every field '''
+    from protocol import BinaryCodec
+
+    session = controller_session()
+
+    print('{:<10} {:>12} {:>10}'.format('frames', 'bytes/frame', 'decode us'))
+    for name, keyframe_interval in (('full', 1), ('delta', 20)):
+        sender, receiver = BinaryCodec(keyframe_interval), BinaryCodec(keyframe_interval)
+        packed = [sender.encode_controller(data_dict) for data_dict in session]
+
+        def decode():
+            receiver.reset()
+            for message in packed:
+                receiver.decode_controller(message)
+
+        print('{:<10} {:>12.2f} {:>10.2f}'.format(
+            name, sum(map(len, packed)) / len(packed), time_per_call(decode, number=10) / len(packed)))
+
+
+def percentile(values, p):
+    ''' Return the p-th percentile of the sorted list values '''
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def simulate_transport(reliable, loss, frames=5000, period=0.02, delay=0.005, jitter=0.01, rto=0.2, seed=0):
+    ''' Simulate sending a frame every period over a link that loses packets.
+
+        - reliable: model TCP, lost packets are resent after rto (doubling each time)
+            and every later frame waits for them. Otherwise model UDP, lost
+            frames are gone and frames arriving after a newer one are dropped
+
+        Return the sorted latencies of the frames that were applied,
+        and the sorted age of the newest applied frame sampled every millisecond
+    '''
+    rng = random.Random(seed)
+    applied = []    # (time applied, time sent)
+    newest = 0
+
+    for i in range(frames):
+        sent = i * period
+        wait = 0
+        timeout = rto
+        while rng.random() < loss:
+            if not reliable:
+                wait = None
+                break
+            wait += timeout
+            timeout *= 2
+        if wait is None:
+            continue
+
+        arrived = sent + wait + delay + rng.uniform(0, jitter)
+        if reliable:
+            # Head of line blocking
+            arrived = max(arrived, newest)
+            newest = arrived
+        applied.append((arrived, sent))
+
+    if not reliable:
+        # Drop frames that arrive after a newer frame
+        applied.sort()
+        in_order = []
+        for arrived, sent in applied:
+            if not in_order or sent > in_order[-1][1]:
+                in_order.append((arrived, sent))
+        applied = in_order
+
+    latencies = sorted(arrived - sent for arrived, sent in applied)
+
+    ages = []
+    current = None
+    events = iter(applied)
+    event = next(events, None)
+    for ms in range(int(frames * period * 1000)):
+        now = ms / 1000
+        while event is not None and event[0] <= now:
+            current = event[1]
+            event = next(events, None)
+        if current is not None:
+            ages.append(now - current)
+    ages.sort()
+
+    return latencies, ages
+
+
+def bench_transport_loss():
+    ''' Simulated latency of controller frames over TCP and UDP as packets are lost '''
+    frames = 5000
+    print('{:<5} {:>6} {:>8} {:>8} {:>8} {:>10} {:>10}'.format(
+        'link', 'loss', 'p50 ms', 'p99 ms', 'max ms', 'age p99 ms', 'delivered'))
+    for loss in (0, 0.01, 0.05, 0.1):
+        for name, reliable in (('tcp', True), ('udp', False)):
+            latencies, ages = simulate_transport(reliable, loss, frames=frames)
+            print('{:<5} {:>5.0f}% {:>8.1f} {:>8.1f} {:>8.1f} {:>10.1f} {:>9.1f}%'.format(
+                name, loss * 100, percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000,
+                latencies[-1] * 1000, percentile(ages, 99) * 1000, len(latencies) / frames * 100))
+
+
+def event_storm(count=500, seed=0):
+    ''' A burst of SDL events like a controller sends while the sticks are pushed around '''
+    import sdl2
+
+    rng = random.Random(seed)
+    storm = []
+    for _ in range(count):
+        event = sdl2.SDL_Event()
+        roll = rng.random()
+        if roll < 0.9:
+            event.type = sdl2.SDL_JOYAXISMOTION
+            event.jaxis.axis = rng.randrange(6)
+            event.jaxis.value = rng.randint(-32768, 32767)
+        elif roll < 0.97:
+            event.type = rng.choice((sdl2.SDL_JOYBUTTONDOWN, sdl2.SDL_JOYBUTTONUP))
+            event.jbutton.button = rng.randrange(11)
+        else:
+            event.type = sdl2.SDL_JOYHATMOTION
+            event.jhat.value = rng.choice((0, 1, 2, 4, 8))
+        storm.append(event)
+    return storm
+
+
+def bench_event_storm():
+    ''' Processing a burst of controller events with an event tuple made for each one, and without '''
+    import ctypes
+    import sdl2
+    from xbox import Controller
+
+    class ReplayController(Controller):
+        ''' Reads the events pushed to SDL, without a controller plugged in '''
+        def __init__(self):
+            self._create_states()
+
+    sdl2.SDL_Init(sdl2.SDL_INIT_JOYSTICK)
+    sdl2.SDL_JoystickEventState(sdl2.SDL_ENABLE)
+
+    storm = event_storm()
+    pointers = [ctypes.byref(event) for event in storm]
+
+    def replay(update):
+        for pointer in pointers:
+            sdl2.SDL_PushEvent(pointer)
+        return update()
+
+    def flush():
+        sdl2.SDL_FlushEvents(sdl2.SDL_FIRSTEVENT, sdl2.SDL_LASTEVENT)
+        return len(storm)
+
+    def state(controller):
+        return [button.value() for button in controller._buttons + controller._axes] + [controller.hat.value()]
+
+    # Both ways must end up with the same state
+    events, slots = ReplayController(), ReplayController()
+    assert replay(events.update_events) == replay(slots.update) == len(storm)
+    assert state(events) == state(slots)
+
+    print('{} events, {:.0f}% axis motion'.format(
+        len(storm), sum(event.type == sdl2.SDL_JOYAXISMOTION for event in storm) / len(storm) * 100))
+    for name, update in (('push only', flush), ('events', events.update_events), ('slots', slots.update)):
+        print('{:<10} {:.3f} us/event'.format(name, time_per_call(lambda: replay(update), number=100) / len(storm)))
+
+    sdl2.SDL_Quit()
+
+
+def bench_sensor_table():
+    ''' Converting ADC readings to distances with the polynomial and the table '''
+    from components import SensorComponent
+    from settings import SENSOR_0_COEFFICIENTS
+
+    start = timeit.default_timer()
+    sensor = SensorComponent('bench', 0, SENSOR_0_COEFFICIENTS)
+    print('Built table in {:.1f} ms'.format((timeit.default_timer() - start) * 1000))
+
+    reading = 1865
+    print('polynomial: {:.2f} us'.format(time_per_call(lambda: sensor._convert_to_distance(reading))))
+    print('table:      {:.2f} us'.format(time_per_call(lambda: sensor.table[reading])))
+
+
+def bench_sensor_reads():
+    ''' Reading all 8 ADC channels one at a time and in one burst transfer '''
+    from hardware import MAX192AEPP
+
+    channels = list(range(8))
+
+    print('one at a time: {:.1f} us'.format(time_per_call(lambda: [MAX192AEPP.read_channel(c) for c in channels], number=1000)))
+    print('burst:         {:.1f} us'.format(time_per_call(lambda: MAX192AEPP.read_channels(channels), number=1000)))
+
+
+def build_outputs(board):
+    ''' The robot's output components, writing to board '''
+    from components import LEDComponent, MotorComponent, MotorController, ServoComponent, ServoScheduler
+    from settings import (SERVO_0_CHANNEL, SERVO_0_MODIFIER, SERVO_0_MAX_PWM, SERVO_0_MIN_PWM, SERVO_0_PRESETS,
+                          SERVO_0_CONTROL_SPEED, SERVO_0_SPEED, MOTOR_FORWARD_AXIS, MOTOR_BACKWARD_AXIS,
+                          MOTOR_STEER_AXIS, MOTOR_STEER_SPEED, MOTOR_MIN_PWM, LED_CHANNEL, LED_BUTTON, LED_VALUE)
+
+    scheduler = ServoScheduler()
+    motors = [MotorComponent(pca9685=board, pca9685_channel=channel, dir_pin=pin) for channel, pin in enumerate((33, 29, 35, 31))]
+    outputs = [
+        ServoComponent(pca9685=board, pca9685_channel=SERVO_0_CHANNEL, modifier=SERVO_0_MODIFIER, max_pwm=SERVO_0_MAX_PWM,
+                       min_pwm=SERVO_0_MIN_PWM, presets=SERVO_0_PRESETS, control_speed=SERVO_0_CONTROL_SPEED,
+                       servo_speed=SERVO_0_SPEED, scheduler=scheduler),
+        MotorController(fwd_axis=MOTOR_FORWARD_AXIS, back_axis=MOTOR_BACKWARD_AXIS, steer_axis=MOTOR_STEER_AXIS,
+                        steer_speed=MOTOR_STEER_SPEED, motors=motors, min_pwm=MOTOR_MIN_PWM, reverse=True),
+        LEDComponent(pca9685=board, pca9685_channel=LED_CHANNEL, button=LED_BUTTON, value=LED_VALUE),
+    ]
+
+    # Only the targets are compared, the servos don't need to move
+    scheduler.stop()
+    return outputs
+
+
+def output_state(outputs, board):
+    ''' Everything the frames could have changed '''
+    servo, motors, led = outputs
+    return servo.target, [motor.last_value for motor in motors.motors], led._state, dict(board.channels)
+
+
+def bench_dispatch():
+    ''' Time to pass a frame to the output components, updating all of them or only the affected ones '''
+    import asyncio
+    from components import OutputRouter
+
+    session = controller_session()
+    loop = asyncio.get_event_loop()
+
+    results = {}
+    print('{:<8} {:>10} {:>12}'.format('dispatch', 'us/frame', 'updates'))
+    for name in ('all', 'routed'):
+        board = NullBoard()
+        outputs = build_outputs(board)
+        router = OutputRouter(outputs)
+        update = router.update_all if name == 'all' else router.update
+
+        async def run():
+            for data_dict in session:
+                await update(data_dict)
+
+        loop.run_until_complete(run())
+        results[name] = output_state(outputs, board)
+        updates = router.stats()['updates'] if name == 'routed' else len(outputs) * len(session)
+
+        router.reset()
+        print('{:<8} {:>10.2f} {:>12}'.format(
+            name, time_per_call(lambda: loop.run_until_complete(run()), number=5) / len(session), updates))
+
+    # Skipping the components whose inputs didn't change must not change what they do
+    assert results['all'] == results['routed'], results
+
+
+def bench_sim_robot():
+    ''' The whole robot driven by a recorded session, on simulated hardware '''
+    import asyncio
+    from settings import HARDWARE_BACKEND
+
+    if HARDWARE_BACKEND != 'sim':
+        print('Needs simulated hardware, run with KSURCT_HARDWARE=sim')
+        return
+
+    from robot import Robot
+    from simulation import SimPCA9685
+    from settings import MOTOR_I2C_ADDRESS, SERVO_I2C_ADDRESS
+
+    session = controller_session()
+    loop = asyncio.get_event_loop()
+    robot = Robot()
+    loop.run_until_complete(robot.ready())
+
+    times = []
+    async def run():
+        for data_dict in session:
+            start = timeit.default_timer()
+            await robot.update(data_dict)
+            times.append((timeit.default_timer() - start) * 1000)
+
+    loop.run_until_complete(run())
+    robot.stop()
+    times.sort()
+
+    print('update ms: p50 {:.3f}, p99 {:.3f}, max {:.3f}'.format(percentile(times, 50), percentile(times, 99), times[-1]))
+    for name, address in (('motor', MOTOR_I2C_ADDRESS), ('servo', SERVO_I2C_ADDRESS)):
+        print('{} board: {}'.format(name, SimPCA9685.boards[address].stats()))
+
+
+def bench_startup():
+    ''' Time from starting until the robot can drive, on simulated hardware:
+        importing the robot, setting up the boards one after the other on the
+        event loop as it used to be, and in the background while the server could listen
+    '''
+    import asyncio
+    import os
+    import subprocess
+    from settings import HARDWARE_BACKEND
+
+    if HARDWARE_BACKEND != 'sim':
+        print('Needs simulated hardware, run with KSURCT_HARDWARE=sim')
+        return
+
+    from hardware import open_pca9685, ShadowPCA9685
+    from robot import Robot
+    from simulation import SimPCA9685
+    from settings import MOTOR_I2C_ADDRESS, MOTOR_PWM_FREQ, SERVO_I2C_ADDRESS, SERVO_PWM_FREQ
+
+    # Importing everything the robot needs, in a new interpreter
+    command = 'import time; start = time.perf_counter(); import robot; print(time.perf_counter() - start)'
+    imports = [float(subprocess.check_output([sys.executable, '-c', command], cwd=os.path.dirname(os.path.abspath(__file__))))
+               for _ in range(3)]
+    print('import robot:          {:6.1f} ms'.format(min(imports) * 1000))
+
+    def sequential():
+        servo_board = ShadowPCA9685(open_pca9685(SERVO_I2C_ADDRESS))
+        motor_board = ShadowPCA9685(open_pca9685(MOTOR_I2C_ADDRESS))
+        servo_board.set_pwm_freq(SERVO_PWM_FREQ)
+        motor_board.set_pwm_freq(MOTOR_PWM_FREQ)
+
+    runs = 5
+    old = []
+    for _ in range(runs):
+        start = timeit.default_timer()
+        sequential()
+        old.append(timeit.default_timer() - start)
+
+    loop = asyncio.get_event_loop()
+    data_dict = sample_controller_data()
+    constructed, motors, first_frame, boards = [], [], [], []
+    for _ in range(runs):
+        start = timeit.default_timer()
+        robot = Robot()
+        constructed.append(timeit.default_timer() - start)
+
+        loop.run_until_complete(robot.motors_ready)
+        motors.append(timeit.default_timer() - start)
+
+        loop.run_until_complete(robot.update(data_dict))
+        first_frame.append(timeit.default_timer() - start)
+
+        # The first frame reached the motors
+        assert SimPCA9685.boards[MOTOR_I2C_ADDRESS].pwm(0) != (0, 0)
+
+        loop.run_until_complete(robot.ready())
+        boards.append(timeit.default_timer() - start)
+        robot.stop()
+
+    print('boards one at a time:  {:6.1f} ms before the server could listen'.format(percentile(sorted(old), 50) * 1000))
+    print('Robot() returns:       {:6.1f} ms, the server listens from here'.format(percentile(sorted(constructed), 50) * 1000))
+    print('motor board ready:     {:6.1f} ms'.format(percentile(sorted(motors), 50) * 1000))
+    print('first frame applied:   {:6.1f} ms'.format(percentile(sorted(first_frame), 50) * 1000))
+    print('both boards ready:     {:6.1f} ms'.format(percentile(sorted(boards), 50) * 1000))
+
+
+def bench_loopback():
+    ''' Frames from senders over localhost websockets to the robot on simulated hardware,
+        see loopback.py to choose the senders and save the results
+    '''
+    import asyncio
+    from settings import HARDWARE_BACKEND
+
+    if HARDWARE_BACKEND != 'sim':
+        print('Needs simulated hardware, run with KSURCT_HARDWARE=sim')
+        return
+
+    from loopback import run_loopback
+    from robot import Robot
+
+    loop = asyncio.get_event_loop()
+    robot = Robot()
+
+    print('{:<8} {:>7} {:>6} {:>10} {:>8} {:>8} {:>10}'.format(
+        'codec', 'senders', 'rate', 'frames/s', 'rtt p50', 'rtt p99', 'cpu us/fr'))
+    for codec, clients, rate in (('binary', 1, 50), ('binary', 4, 50), ('binary', 1, 500), ('pickle', 1, 50)):
+        results = loop.run_until_complete(run_loopback(robot, clients, rate, codec, duration=2))
+        robot.stop()
+
+        # Websockets don't lose frames, and every one applied is acked
+        assert results['applied'] + results['skipped'] == results['sent']
+        assert codec != 'binary' or results['acked'] == results['applied']
+
+        rtt = results['latency']['rtt']
+        print('{:<8} {:>7} {:>6} {:>10.0f} {:>8} {:>8} {:>10.0f}'.format(
+            codec, clients, rate, results['frames_per_sec'],
+            '-' if rtt['p50'] is None else '{:.1f}'.format(rtt['p50']),
+            '-' if rtt['p99'] is None else '{:.1f}'.format(rtt['p99']),
+            results['cpu_per_frame_us']))
+
+
+def bench_impairment():
+    ''' Driving through a proxy that delays, drops and cuts the link,
+        see impairment.py for the scenarios and to save the results
+    '''
+    import asyncio
+    import logging
+    from settings import HARDWARE_BACKEND, SERVER_TIMEOUT
+
+    if HARDWARE_BACKEND != 'sim':
+        print('Needs simulated hardware, run with KSURCT_HARDWARE=sim')
+        return
+
+    from impairment import SCENARIOS, run_impaired
+    from robot import Robot
+
+    # Every reconnect and watchdog trip is logged
+    logging.getLogger('__main__').setLevel(logging.ERROR)
+    logging.getLogger('client').setLevel(logging.ERROR)
+
+    loop = asyncio.get_event_loop()
+    robot = Robot()
+
+    print('{:<12} {:>8} {:>8} {:>8} {:>10} {:>12}  {}'.format(
+        'scenario', 'frames', 'age p50', 'age p99', 'max gap', 'recovery', 'watchdog'))
+    for scenario in ('clean', 'arena', 'congested', 'short_blip', 'blip', 'disconnect'):
+        results = loop.run_until_complete(run_impaired(robot, scenario))
+        robot.stop()
+
+        # The client must keep going, and the watchdog only trips on outages longer than its timeout
+        assert results['client_error'] is None, results['client_error']
+        outages = [step[2] for step in SCENARIOS[scenario][1] if step[1] == 'outage']
+        assert bool(results['watchdog_trips']) == any(outage > SERVER_TIMEOUT for outage in outages), results
+        # A dropped connection picks its session back up without stopping the robot
+        if scenario == 'disconnect':
+            assert results['resumed'] and not results['robot_stops'], results
+
+        print('{:<12} {:>8} {:>8} {:>8} {:>10} {:>12}  {}'.format(
+            scenario, results['applied'], results['age']['p50'], results['age']['p99'], results['max_gap'],
+            ','.join(str(recovery) for recovery in results['recoveries']) or '-',
+            ','.join(str(trip) for trip in results['watchdog_trips']) or '-'))
+
+
+def bench_logging():
+    ''' Time spent on the event loop logging every controller frame, written straight to a stream
+        and through the queue to the logging thread, limited to once a second
+    '''
+    import io
+    import logging
+    from logs import FrameLog, setup_logging
+    from settings import LOG_FORMAT
+
+    data_dict = sample_controller_data()
+    logger = logging.getLogger('bench')
+    root = logging.getLogger()
+    handlers, level = root.handlers[:], root.level
+
+    try:
+        # The way every frame used to be logged
+        handler = logging.StreamHandler(io.StringIO())
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        root.handlers = [handler]
+        root.setLevel(logging.INFO)
+        direct = time_per_call(lambda: logger.info('Sending: {}'.format(data_dict)), number=2000)
+
+        listener = setup_logging(logging.INFO, io.StringIO())
+        queued = time_per_call(lambda: logger.info('Sending: %s', data_dict), number=2000)
+        frame_log = FrameLog(logger, enabled=True)
+        limited = time_per_call(lambda: frame_log('Sending: %s', data_dict), number=2000)
+        listener.stop()
+    finally:
+        root.handlers, root.level = handlers, level
+
+    print('direct:        {:.2f} us/frame'.format(direct))
+    print('queued:        {:.2f} us/frame'.format(queued))
+    print('rate limited:  {:.2f} us/frame'.format(limited))
+
+
+def bench_watchdog():
+    ''' How long after a missed deadline the robot is stopped, and frames resume after a reconnect '''
+    import asyncio
+    import logging
+    from watchdog import Watchdog
+
+    # Every trip is logged
+    logging.getLogger('__main__').setLevel(logging.ERROR)
+
+    loop = asyncio.get_event_loop()
+    timeout, period, outage = 0.1, 0.02, 0.3
+    events = []
+
+    async def close():
+        events.append('close')
+
+    watchdog = Watchdog(timeout, lambda: events.append('stop'), close)
+
+    async def run(trips):
+        for _ in range(trips):
+            # Drive for a while, then lose the connection
+            for _ in range(25):
+                watchdog.feed()
+                await asyncio.sleep(period)
+            await asyncio.sleep(outage)
+        watchdog.feed()
+
+    trips = 10
+    loop.run_until_complete(run(trips))
+    watchdog.shutdown()
+
+    # Every outage stops the robot and closes the connections once, and never while driving
+    assert events == ['stop', 'close'] * trips, events
+
+    stop, resume = watchdog.time_to_stop.summary(), watchdog.time_to_resume.summary()
+    print('time to stop:   p50 {:.2f} ms, max {:.2f} ms after the deadline'.format(stop['p50'], stop['max']))
+    print('time to resume: p50 {:.0f} ms after the deadline ({:.0f} ms outage, {:.0f} ms timeout)'.format(
+        resume['p50'], outage * 1000, timeout * 1000))
+
+
+def bench_loop_lag():
+    ''' That blocking the event loop shows up in the loop lag, and what the stats message costs '''
+    import asyncio
+    import time
+    from metrics import LoopMonitor, StageTimings
+    from protocol import BinaryCodec, STATS_MESSAGE
+
+    loop = asyncio.get_event_loop()
+    monitor = LoopMonitor(0.01)
+
+    async def run(block):
+        for _ in range(20):
+            await asyncio.sleep(0.02)
+        # Something that forgot to await
+        time.sleep(block)
+        await asyncio.sleep(0.02)
+
+    block = 0.05
+    monitor.start()
+    loop.run_until_complete(run(block))
+    monitor.stop()
+
+    lag = monitor.lag.summary()
+    # The tick due while blocked is run late by up to the block, less the time it had left to wait
+    assert lag['max'] >= (block - 2 * monitor.interval) * 1000, lag
+    assert lag['p50'] < block * 1000 / 2, lag
+    print('loop lag: p50 {:.2f} ms, max {:.1f} ms with the loop blocked for {:.0f} ms'.format(
+        lag['p50'], lag['max'], block * 1000))
+
+    timings = StageTimings(['loop_lag', 'decode', 'queue', 'robot', 'i2c', 'MotorController', 'Servo1', 'Servo2', 'sensors'])
+    for stage in timings.stages:
+        for i in range(100):
+            timings.record(stage, i / 7)
+
+    codec = BinaryCodec()
+    stats = timings.compact()
+    packed = codec.encode_stats(stats)
+    assert codec.message_type(packed) == STATS_MESSAGE
+    assert codec.decode_stats(packed) == stats
+
+    n = 1000
+    start = time.perf_counter()
+    for _ in range(n):
+        codec.encode_stats(timings.compact())
+    elapsed = (time.perf_counter() - start) / n * 1e6
+    print('stats message: {} bytes, {:.1f} us to summarize and pack'.format(len(packed), elapsed))
+
+
+def bench_streams():
+    ''' How long acks wait to be sent over a slow link busy with telemetry,
+        on one queue in order compared to the prioritized streams
+    '''
+    import asyncio
+    from streams import CONTROL, STREAMS, TELEMETRY, StreamSender
+
+    loop = asyncio.get_event_loop()
+    bandwidth = 12000   # Bytes a second the link can send, less than is sent
+    ack, telemetry = b'a' * 30, b't' * 400
+
+    class SlowLink(object):
+        async def send(self, message):
+            await asyncio.sleep(len(message) / bandwidth)
+
+    async def run(streams, names):
+        writer = asyncio.ensure_future(streams.run())
+        # Acks at 50 a second, telemetry at 35 a second
+        for i in range(100):
+            streams.send(names[CONTROL], ack)
+            if i % 2 == 0 or i % 5 == 0:
+                streams.send(names[TELEMETRY], telemetry)
+            await asyncio.sleep(0.02)
+        writer.cancel()
+
+    print('{:<12} {:>10} {:>10} {:>10} {:>10}'.format('streams', 'ack p50', 'ack p99', 'max depth', 'dropped'))
+    for name, streams, names in (
+            ('one queue', StreamSender(SlowLink(), [('all', 0, 10000)]), {CONTROL: 'all', TELEMETRY: 'all'}),
+            ('prioritized', StreamSender(SlowLink(), STREAMS), {CONTROL: CONTROL, TELEMETRY: TELEMETRY})):
+        loop.run_until_complete(run(streams, names))
+        summary = streams.summary()
+        wait = summary[names[CONTROL]]['wait']
+        print('{:<12} {:>10.1f} {:>10.1f} {:>10} {:>10}'.format(
+            name, wait['p50'], wait['p99'], max(stream['max_depth'] for stream in summary.values()),
+            summary[names[TELEMETRY]]['dropped']))
+
+    # Acks only wait for the message already being sent, and telemetry is what gets dropped
+    assert wait['p99'] < 2 * len(telemetry) / bandwidth * 1000, summary
+    assert summary[CONTROL]['dropped'] == 0 and summary[TELEMETRY]['dropped'] > 0, summary
+
+
+BENCHMARKS = {
+    'codecs': bench_codecs,
+    'delta': bench_delta,
+    'dispatch': bench_dispatch,
+    'event_storm': bench_event_storm,
+    'impairment': bench_impairment,
+    'logging': bench_logging,
+    'loopback': bench_loopback,
+    'loop_lag': bench_loop_lag,
+    'sensor_reads': bench_sensor_reads,
+    'sensor_table': bench_sensor_table,
+    'sim_robot': bench_sim_robot,
+    'startup': bench_startup,
+    'streams': bench_streams,
+    'transport_loss': bench_transport_loss,
+    'watchdog': bench_watchdog,
+}
+
+
+def main(names):
+    for name in names or sorted(BENCHMARKS):
+        print('== {} =='.format(name))
+        BENCHMARKS[name]()
+        print()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
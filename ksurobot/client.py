@@ -6,109 +6,399 @@
 import websockets
 import asyncio
 from contextlib import suppress
-from concurrent.futures import CancelledError
-from xbox import Controller
-import pickle
 import logging
-
-from settings import SERVER_IP, SERVER_PORT
-
-TIMEOUT_DELAY = 5
-DELAY_TIME = 1
+import socket
+import threading
+import time
+
+from logs import FrameLog, setup_logging
+from metrics import StageTimings
+from protocol import (ACK_MESSAGE, ACK_STAGES, STATS_MESSAGE, BinaryCodec, elapsed_ms, get_codec,
+                      new_session_token, session_path, subprotocols)
+from recording import SessionRecorder
+from settings import *
+
+
+class ControllerInput(object):
+    ''' Reads the controller on its own thread, so a slow SDL call never
+        holds up the event loop. The newest controller data is kept for
+        the sender, which is woken as soon as it changes
+    '''
+
+    def __init__(self, controller, read, timeout=CLIENT_INPUT_TIMEOUT):
+        ''' - controller: the Controller to wait for events from
+            - read: builds the controller data from the state of the controller
+            - timeout: longest to wait for an event before checking if it should stop (sec)
+        '''
+        self.controller = controller
+        self.read = read
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._data = None
+        self._loop = None
+        self._changed = None
+        self._stop_event = threading.Event()
+        self._thread = None
+
+        self.events = 0
+        self.changes = 0
+
+    def start(self):
+        ''' Start reading the controller, waking the sender on the current event loop '''
+        if self._thread and self._thread.is_alive():
+            return
+        self._loop = asyncio.get_event_loop()
+        self._changed = asyncio.Event()
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def run(self):
+        ''' Main loop of the input thread '''
+        self._publish()
+        while not self._stop_event.is_set():
+            events = self.controller.wait(self.timeout)
+            if events:
+                self.events += events
+                self._publish()
+
+    def _publish(self):
+        ''' Build the controller data and pass it on if it changed '''
+        data = self.read()
+        with self._lock:
+            if data == self._data:
+                return
+            self._data = data
+        self.changes += 1
+        self._loop.call_soon_threadsafe(self._changed.set)
+
+    def get(self):
+        ''' Return the newest controller data, None if there isn't any yet '''
+        self._changed.clear()
+        with self._lock:
+            return self._data
+
+    async def wait(self, timeout=None):
+        ''' Wait up to timeout (sec) for the controller data to change since the last get '''
+        with suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(self._changed.wait(), timeout)
 
 
 class Client(object):
 
-    def __init__(self, ip, port):
-
-        # Initalize controller number 0
-        Controller.init()
-        self.controller = Controller(0)
+    def __init__(self, ip, port, controller_input=None, transport=CLIENT_CONTROL_TRANSPORT):
+        ''' Construct a client of the server at ip and port, sending the controller data
+            over transport ('websocket' or 'udp', see CLIENT_CONTROL_TRANSPORT).
+            controller_input can stand in for the controller, it needs start, stop, get and wait
+            like ControllerInput
+        '''
+
+        if controller_input is None:
+            # Initalize controller number 0, SDL is only imported when one is used
+            from xbox import Controller
+            Controller.init()
+            self.controller = Controller(0)
+            controller_input = ControllerInput(self.controller, self.read_controller_data)
+        else:
+            self.controller = None
+        self.controller_input = controller_input
+        self.transport = transport
         self.logger = logging.getLogger(__name__)
+        self.send_log = FrameLog(self.logger)
+        self.receive_log = FrameLog(self.logger)
+        self.stats_log = FrameLog(self.logger, interval=LATENCY_LOG_INTERVAL)
         self.ws = None
+        self.codec = None
+        self.datagram_transport = None
+        self.datagram_codec = None
         self.ip = ip
         self.port = port
 
+        # The same on every connection, so the server carries on where the last one left off
+        self.session = new_session_token()
+        self.uri = 'ws://{0}:{1}{2}'.format(ip, port, session_path(self.session))
+        self.connections = 0
+        self.reconnect_delay = CLIENT_RECONNECT_MIN_DELAY
+
+        # Keep every frame sent, to replay later
+        self.recorder = SessionRecorder.in_directory(CLIENT_RECORD_DIR) if CLIENT_RECORD_DIR else None
+
+        # Round trip time of controller frames and how long each stage on the robot took
+        self.latency = StageTimings(('rtt', 'network') + ACK_STAGES)
+        self._last_latency_log = time.monotonic()
+
+        # The last loop lag and stage timings sent by the robot, [median, 99th percentile, max] (ms)
+        self.robot_stats = {}
+
     async def start_client(self):
         ''' Setup Client '''
+        self.controller_input.start()
+
         # while True:
         await self.connect()
         await self.handle_connection()
 
     async def connect(self):
-        ''' Connect to server at ip and port, try to reconect on failure '''
+        ''' Connect to the server at ip and port, trying again until it works.
+            The delay between attempts starts at CLIENT_RECONNECT_MIN_DELAY
+            and doubles after each one that fails, up to CLIENT_RECONNECT_MAX_DELAY
+        '''
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        self.reconnect_delay = CLIENT_RECONNECT_MIN_DELAY
         while True:
+            sock = await self.open_socket()
             try:
-                ws = await asyncio.wait_for(websockets.connect('ws://{0}:{1}'.format(self.ip, self.port)), TIMEOUT_DELAY)
-            except ConnectionRefusedError:
-                self.logger.info('Connection Refused at {0}:{1}, trying again'.format(self.ip, self.port))
-                await asyncio.sleep(DELAY_TIME)
+                ws = await asyncio.wait_for(websockets.connect(self.uri, sock=sock, subprotocols=subprotocols(CONNECTION_CODECS)),
+                                            CLIENT_CONNECT_TIMEOUT)
             except asyncio.TimeoutError:
-                self.logger.info('Connection to {0}:{1} timed out, trying again'.format(self.ip, self.port))
+                self.logger.warning('Connection to {0}:{1} timed out, trying again'.format(self.ip, self.port))
+            except (OSError, websockets.InvalidHandshake) as e:
+                self.logger.warning('Could not connect to {0}:{1} ({2}), trying again'.format(self.ip, self.port, e))
             else:
                 if ws.open:
-                    self.logger.info('Connected to server at: {0}'.format(str(ws.remote_address)))
-                    self.ws = ws
+                    await self.connected(ws, loop.time() - start)
                     return
+            sock.close()
+
+            await asyncio.sleep(self.reconnect_delay)
+            self.reconnect_delay = min(self.reconnect_delay * 2, CLIENT_RECONNECT_MAX_DELAY)
+
+    async def open_socket(self):
+        ''' Open a TCP connection to the server. While an attempt is waiting, another is
+            started every reconnect delay, up to CLIENT_CONNECT_ATTEMPTS at once, and the
+            first to connect is used. Only that one goes on to the websocket handshake,
+            so the server only ever sees one connection
+        '''
+        loop = asyncio.get_event_loop()
+        attempts = set()
+        try:
+            while True:
+                if len(attempts) < CLIENT_CONNECT_ATTEMPTS:
+                    attempts.add(asyncio.ensure_future(self.connect_socket()))
+
+                next_attempt = loop.time() + self.reconnect_delay
+                while attempts and loop.time() < next_attempt:
+                    done, attempts = await asyncio.wait(attempts, timeout=next_attempt - loop.time(),
+                                                        return_when=asyncio.FIRST_COMPLETED)
+                    socks = [attempt.result() for attempt in done if attempt.result() is not None]
+                    if socks:
+                        for sock in socks[1:]:
+                            sock.close()
+                        return socks[0]
+
+                await asyncio.sleep(max(next_attempt - loop.time(), 0))
+                self.reconnect_delay = min(self.reconnect_delay * 2, CLIENT_RECONNECT_MAX_DELAY)
+        finally:
+            for attempt in attempts:
+                if attempt.done() and not attempt.cancelled() and attempt.result() is not None:
+                    attempt.result().close()
+                attempt.cancel()
+
+    async def connect_socket(self):
+        ''' Try once to open a TCP connection to the server, returning the socket or None if it didn't work '''
+        loop = asyncio.get_event_loop()
+        sock = None
+        try:
+            family, type_, proto, _, address = (await loop.getaddrinfo(self.ip, self.port, type=socket.SOCK_STREAM))[0]
+            sock = socket.socket(family, type_, proto)
+            sock.setblocking(False)
+            await asyncio.wait_for(loop.sock_connect(sock, address), CLIENT_CONNECT_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.logger.warning('Connection to {0}:{1} timed out, trying again'.format(self.ip, self.port))
+        except OSError as e:
+            self.logger.warning('Could not connect to {0}:{1} ({2}), trying again'.format(self.ip, self.port, e))
+        except BaseException:
+            # Cancelled, another attempt got there first
+            if sock:
+                sock.close()
+            raise
+        else:
+            return sock
+
+        if sock:
+            sock.close()
+        return None
+
+    async def connected(self, ws, elapsed):
+        ''' Start using a new connection '''
+        self.logger.info('Connected to server at: {0} in {1:.2f} sec'.format(str(ws.remote_address), elapsed))
+        self.ws = ws
+        self.codec = get_codec(ws.subprotocol)
+        self.logger.info('Using {} messages'.format(self.codec.name))
+        self.connections += 1
+        await self.open_datagram()
+
+    async def open_datagram(self):
+        ''' Send the controller data over UDP if set to and the server understands it '''
+        self.close_datagram()
+
+        if self.transport != 'udp':
+            return
+        if not isinstance(self.codec, BinaryCodec):
+            self.logger.info('Server does not support binary messages, sending controller data over the websocket')
+            return
+
+        self.datagram_transport, _ = await asyncio.get_event_loop().create_datagram_endpoint(
+            asyncio.DatagramProtocol, remote_addr=(self.ip, SERVER_UDP_PORT))
+        # Every datagram is a keyframe, since any of them can be lost
+        self.datagram_codec = BinaryCodec(keyframe_interval=1)
+        self.logger.info('Sending controller data over UDP to {0}:{1}'.format(self.ip, SERVER_UDP_PORT))
+
+    def close_datagram(self):
+        if self.datagram_transport:
+            self.datagram_transport.close()
+        self.datagram_transport = None
+        self.datagram_codec = None
 
     async def handle_connection(self):
-        ''' Maintain send and receive task with the server '''
+        ''' Maintain send and receive task with the server, reconnecting when the connection is lost '''
         while True:
+            tasks = [asyncio.ensure_future(self.sender()), asyncio.ensure_future(self.receiver())]
             try:
-                sender_task = asyncio.ensure_future(self.sender())
-                receiver_task = asyncio.ensure_future(self.receiver())
-
-                await asyncio.wait([sender_task, receiver_task], return_when=asyncio.FIRST_EXCEPTION)
-
-            except CancelledError:
-                pass
-
-            except websockets.ConnectionClosed:
-                # Close the connection
-                self.logger.info('Server closed connection')
-                if self.ws.open:
-                    await self.ws.close()
-                self.logger.info('Connection closed to: {}'.format(self.ws.remote_address))
-                break
-
-#            finally:
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                for task in tasks:
+                    task.cancel()
+
+            for task in done:
+                error = task.exception()
+                if error and not isinstance(error, websockets.ConnectionClosed):
+                    self.logger.error('Connection to the server failed: {!r}'.format(error))
+            self.logger.info('Lost the connection to {}, reconnecting'.format(self.ws.remote_address))
+
+            # Closing can take a while on a bad link, connect again meanwhile
+            asyncio.ensure_future(self.ws.close())
             await self.connect()
 
     async def sender(self):
         ''' Handle data that needs to be sent to the server '''
+        if CLIENT_SEND_MODE == 'event':
+            await self.event_sender()
+        else:
+            await self.poll_sender()
+
+    async def poll_sender(self):
+        ''' Send the controller data every CLIENT_SEND_INTERVAL '''
         while self.ws.open:
             # Get updated controller data
             controller_data = self.get_controller_data()
 
             if controller_data:
-                self.logger.info('Sending: {}'.format(controller_data))
+                await self.send_controller_data(controller_data)
+            await asyncio.sleep(CLIENT_SEND_INTERVAL)
+
+    async def event_sender(self):
+        ''' Send the controller data as soon as it changes, but no faster than CLIENT_MAX_SEND_RATE.
+            While it doesn't change, only send it every CLIENT_HEARTBEAT_INTERVAL to feed the
+            server's watchdog, or every CLIENT_SEND_INTERVAL if a repeating input is held
+        '''
+        loop = asyncio.get_event_loop()
+        min_interval = 1 / CLIENT_MAX_SEND_RATE
+
+        last_sent = None
+        last_send_time = 0
 
-                pickled_message = pickle.dumps(controller_data)
+        while self.ws.open:
+            controller_data = self.controller_input.get()
+            if controller_data is None:
+                await self.controller_input.wait()
+                continue
+
+            if controller_data != last_sent:
+                interval = min_interval
+            elif any(controller_data[key] for key in CLIENT_REPEAT_KEYS):
+                interval = CLIENT_SEND_INTERVAL
+            else:
+                interval = CLIENT_HEARTBEAT_INTERVAL
+
+            wait = last_send_time + interval - loop.time()
+            if wait <= 0:
+                last_send_time = loop.time()
+                last_sent = controller_data
+                await self.send_controller_data(controller_data)
+                continue
+
+            # Sleep until it's time to send, or the controller changes
+            await self.controller_input.wait(wait)
+
+    async def send_controller_data(self, controller_data):
+        ''' Pack and send the controller data to the server '''
+        self.send_log('Sending: %s', controller_data)
+
+        if self.recorder:
+            self.recorder.record(controller_data)
+
+        if self.datagram_transport:
+            self.datagram_transport.sendto(self.datagram_codec.encode_controller(controller_data))
+            return
+
+        packed_message = self.codec.encode_controller(controller_data)
 
-                await self.ws.send(pickled_message)
-            await asyncio.sleep(.1)
+        await self.ws.send(packed_message)
 
     async def receiver(self):
         ''' Handle data from the server '''
         while self.ws.open:
             # Get data from server
-            pickled_message = await self.ws.recv()
+            packed_message = await self.ws.recv()
 
-            message = pickle.loads(pickled_message)
+            message_type = self.codec.message_type(packed_message)
+            if message_type == ACK_MESSAGE:
+                self.handle_ack(*self.codec.decode_ack(packed_message))
+                continue
+            if message_type == STATS_MESSAGE:
+                self.robot_stats = self.codec.decode_stats(packed_message)
+                self.stats_log('Robot: %s (times in ms)', self.robot_stats)
+                continue
 
-            self.logger.info('Received: {}'.format(message))
+            message = self.codec.decode_telemetry(packed_message)
+
+            self.receive_log('Received: %s', message)
+
+    def handle_ack(self, sequence, timestamp, stages):
+        ''' Record the round trip time of an acked frame and how long the robot took with it '''
+        rtt = elapsed_ms(timestamp)
+
+        self.latency.record('rtt', rtt)
+        self.latency.record('network', max(rtt - stages['robot'], 0))
+        for stage in ACK_STAGES:
+            self.latency.record(stage, stages[stage])
+
+        if time.monotonic() - self._last_latency_log >= LATENCY_LOG_INTERVAL:
+            self._last_latency_log = time.monotonic()
+            self.logger.info('Frame latency: {}'.format(self.latency.format()))
+
+    def latency_summary(self):
+        ''' Return the count, p50, p99 and max time (ms) of the round trip,
+            the network and each stage on the robot for the controller frames
+        '''
+        return self.latency.summary()
 
     async def shutdown(self):
-        if self.ws.open:
+        self.controller_input.stop()
+        self.close_datagram()
+        if self.recorder:
+            self.recorder.close()
+        if self.ws and self.ws.open:
             await self.ws.close()
 
     def get_controller_data(self):
+        ''' The newest controller data from the input thread '''
+        return self.controller_input.get()
+
+    def read_controller_data(self):
+        ''' Build the dictionary to send from the state of the controller '''
         # Create the dictionary to send
         controller_data = {}
 
-        # update the controller object
-        self.controller.update()
-
         # General buttons
         controller_data['x'] = 1 if self.controller.x() else 0
         controller_data['y'] = 1 if self.controller.y() else 0
@@ -141,8 +431,8 @@ class Client(object):
 
 def main():
 
-    # Setup Logging
-    logging.basicConfig(format='%(name)s: %(levelname)s: %(asctime)s: %(message)s', level=logging.INFO)
+    # Setup Logging, written on its own thread
+    log_listener = setup_logging(logging.INFO)
     logger = logging.getLogger(__name__)
 
     # Get the event loop to work with
@@ -163,6 +453,7 @@ def main():
 
     finally:
         loop.close()
+        log_listener.stop()
 
 if __name__ == '__main__':
     main()
@@ -4,16 +4,48 @@
 '''
 
 import asyncio
+import hashlib
 import logging
-import RPi.GPIO as io
+import os
 import time
 import threading
+from array import array
+from collections import Counter, deque
+from contextlib import ExitStack
+from functools import partial
 
-from hardware import MAX192AEPP
+from hardware import MAX192AEPP, MAX192AEPP_READINGS, gpio as io
+from logs import FrameLog
+from metrics import StageTimings
 
 logger = logging.getLogger("__main__")
 
 
+def component_names(components):
+    ''' Name each component after its class, numbering them where there are several of a class '''
+    classes = Counter(type(component).__name__ for component in components)
+    numbered = Counter()
+    names = []
+    for component in components:
+        name = type(component).__name__
+        if classes[name] > 1:
+            numbered[name] += 1
+            name = '{0} {1}'.format(name, numbered[name] - 1)
+        names.append(name)
+    return names
+
+
+def batch_writes(boards):
+    ''' Hold the writes to each of the boards until the end of the with block,
+        for the boards that can
+    '''
+    stack = ExitStack()
+    for board in set(boards):
+        if hasattr(board, 'batch'):
+            stack.enter_context(board.batch())
+    return stack
+
+
 class Component(object):
 
     def stop(self):
@@ -33,15 +65,51 @@ class SensorComponent(InputComponent):
         and then converts that to a distance
     '''
 
-    def __init__(self, name, channel, coefficients):
-        ''' Setup channel and coefficients '''
+    def __init__(self, name, channel, coefficients, cache_dir=None):
+        ''' Setup channel and coefficients
+
+            - cache_dir: a directory to save the distance table in, so it
+                doesn't need to be worked out again on the next start
+        '''
         self.name = name
         self.channel = channel
         self.coefficients = coefficients
 
+        # The distance for every reading the ADC can give
+        self.table = self._load_table(cache_dir)
+
+    def _load_table(self, cache_dir):
+        ''' Load the distance table from the cache, or build it and save it there '''
+        if cache_dir is None:
+            return self._build_table()
+
+        key = hashlib.sha1(repr(list(self.coefficients)).encode()).hexdigest()
+        path = os.path.join(cache_dir, 'sensor-{}.table'.format(key))
+
+        table = array('d')
+        try:
+            with open(path, 'rb') as f:
+                table.fromfile(f, MAX192AEPP_READINGS)
+        except (OSError, EOFError, ValueError):
+            # Not cached yet, or cut short
+            logger.info('Building distance table for {}'.format(self.name))
+            table = self._build_table()
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                with open(path, 'wb') as f:
+                    table.tofile(f)
+            except OSError as e:
+                logger.warn('Could not save distance table: {}'.format(e))
+        return table
+
+    def _build_table(self):
+        ''' Work out the distance for every reading the ADC can give '''
+        return array('d', (self._convert_to_distance(reading) for reading in range(MAX192AEPP_READINGS)))
+
     def _convert_to_distance(self, voltage):
         ''' Take the voltage read on the sensor and return
             the distance (in centimeters) based on the coefficients and voltage. 
+            This is slow, the table built from it is used instead.
         '''
         index = 0
         distance = 0
@@ -54,18 +122,118 @@ class SensorComponent(InputComponent):
         ''' Get the raw value from the adc about the sensor '''
         return MAX192AEPP.read_channel(self.channel)
 
+    def convert(self, reading):
+        ''' Return the distance for a reading from the adc '''
+        return self.table[reading]
+
     async def produce(self):
         ''' Async funtion to read sensor data on channel from SCI '''
-        return self.name, self._convert_to_distance(self._get_value())
+        return self.name, self.convert(self._get_value())
 
     def stop(self):
         ''' Close SCI connection '''
         pass
 
 
+class SensorSampler(object):
+    ''' Reads sensors from the adc on its own thread at a set rate,
+        keeping the last few readings of each so they never have to be waited on
+    '''
+
+    def __init__(self, sensors, rate=50, size=5):
+        ''' Setup the sensors to read
+
+            - sensors: the SensorComponents to read
+            - rate: how many times a second to read them
+            - size: how many readings of each sensor to keep
+        '''
+        self.sensors = sensors
+        self.rate = rate
+        self._channels = [sensor.channel for sensor in sensors]
+        self._buffers = [deque(maxlen=size) for _ in sensors]
+
+        # When the last second of readings were made
+        self._times = deque(maxlen=max(int(rate), 2))
+
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        ''' Start reading on a new thread, if not already '''
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self.loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        ''' Stop reading and wait for the thread to finish '''
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def loop(self):
+        ''' Main loop of the sampling thread '''
+        period = 1 / self.rate
+        next_time = time.monotonic()
+
+        while not self._stop_event.is_set():
+            readings = MAX192AEPP.read_channels(self._channels)
+            for buffer, reading in zip(self._buffers, readings):
+                buffer.append(reading)
+            self._times.append(time.monotonic())
+
+            next_time += period
+            delay = next_time - time.monotonic()
+            if delay > 0:
+                self._stop_event.wait(delay)
+            else:
+                # Running behind, don't try to catch up
+                next_time = time.monotonic()
+
+    def latest(self):
+        ''' Return the distance from the newest reading of each sensor '''
+        return {sensor.name: sensor.convert(buffer[-1])
+                for sensor, buffer in zip(self.sensors, self._buffers) if buffer}
+
+    def filtered(self):
+        ''' Return the distance from the median of the readings kept for each sensor '''
+        data_dict = {}
+        for sensor, buffer in zip(self.sensors, self._buffers):
+            readings = sorted(buffer)
+            if readings:
+                data_dict[sensor.name] = sensor.convert(readings[len(readings) // 2])
+        return data_dict
+
+    def stats(self):
+        ''' Return the set rate, the rate readings were actually made at over
+            the last second and how far off that is, as a percentage
+        '''
+        times = list(self._times)
+        if len(times) < 2 or times[-1] == times[0]:
+            actual = 0
+        else:
+            actual = (len(times) - 1) / (times[-1] - times[0])
+        return {'rate': self.rate, 'actual_rate': actual, 'drift': (actual - self.rate) / self.rate * 100}
+
+
 class OutputComponent(Component):
 
-    async def update(self, data_dict):
+    # Inputs that this component reacts to changes of, rather than their current value.
+    # Frames are never skipped over if they change one of these.
+    edge_keys = ()
+
+    # Inputs that this component reads. It is only updated when one of them
+    # changes, or on every frame if there are none.
+    inputs = ()
+
+    def repeats(self, data_dict):
+        ''' Return True if the component needs updating again with the same inputs '''
+        return False
+
+    def update(self, data_dict):
+        ''' Update the component, this may be a coroutine if it has to wait on something '''
         raise NotImplementedError()
 
 
@@ -86,6 +254,10 @@ class LEDComponent(OutputComponent):
         self.value = value
         self._state = 0
 
+        # Toggles on each press
+        self.edge_keys = (button,)
+        self.inputs = (button,)
+
         self.stop()
 
     def stop(self):
@@ -99,7 +271,7 @@ class LEDComponent(OutputComponent):
         else:
             self.pca9685.set_pwm(self.pca9685_channel, 0, 0)
 
-    async def update(self, data_dict):
+    def update(self, data_dict):
         ''' Update the state of the LED '''
         if self._state == 0:
             if data_dict[self.button]:
@@ -143,6 +315,8 @@ class MotorComponent(Component):
         # Reverses the output when true
         self.reverse = reverse
 
+        self.log = FrameLog(logger)
+
         self.stop()
 
     def stop(self):
@@ -173,10 +347,15 @@ class MotorComponent(Component):
         if value < 4096:
             self.pca9685.set_pwm(self.pca9685_channel, 0, value)
 
-        logging.getLogger('__main__').info('Setting: {}, {}'.format(self.pca9685_channel, value))
+        self.log('Setting: %s, %s', self.pca9685_channel, value)
 
-        # if not value: # Just to save time
-        io.output(self.dir_pin, direction ^ self.reverse)
+        # Change direction once the new duty cycle is written, never at the old one.
+        # Writes through the I2C arbiter are queued, so it is done on its thread
+        set_direction = partial(io.output, self.dir_pin, direction ^ self.reverse)
+        if hasattr(self.pca9685, 'after_write'):
+            self.pca9685.after_write(self.pca9685_channel, set_direction)
+        else:
+            set_direction()
 
 
 class MotorController(OutputComponent):
@@ -194,6 +373,7 @@ class MotorController(OutputComponent):
         self.fwd_axis = fwd_axis
         self.back_axis = back_axis
         self.steer_axis = steer_axis
+        self.inputs = (fwd_axis, back_axis, steer_axis)
 
         self.steer_speed = steer_speed
         self.reverse = reverse
@@ -210,7 +390,7 @@ class MotorController(OutputComponent):
         for motor in self.motors:
             motor.stop()
     
-    async def update(self, data_dict):
+    def update(self, data_dict):
         ''' Update the state of the 4 motors '''
 
         fwd, back = (data_dict[self.fwd_axis] + 4096) // 2, (data_dict[self.back_axis] + 4096) // 2
@@ -243,10 +423,11 @@ class MotorController(OutputComponent):
         # logging.getLogger('__main__').info('Controller values: {0}, {1}'.format(r_val, l_val))
 
 
-        self.motors[0].output(r_val) # Front Right
-        self.motors[1].output(l_val) # Front Left
-        self.motors[2].output(r_val) # Back Right
-        self.motors[3].output(l_val) # Back Left
+        with batch_writes(motor.pca9685 for motor in self.motors):
+            self.motors[0].output(r_val) # Front Right
+            self.motors[1].output(l_val) # Front Left
+            self.motors[2].output(r_val) # Back Right
+            self.motors[3].output(l_val) # Back Left
 
 
 class ServoComponent(OutputComponent):
@@ -255,8 +436,12 @@ class ServoComponent(OutputComponent):
     DOWN_BUTTON = 'down'
     AXIS = 'r_stick_y'
 
+    # While the controls are held the target moves control_speed every CONTROL_PERIOD (sec),
+    # the time between the frames the client used to send, however often frames come now
+    CONTROL_PERIOD = 0.1
+
     def __init__(self, pca9685=None, pca9685_channel=None, modifier=None, max_pwm=None, min_pwm=None,
-                    presets=None, control_speed=None, servo_speed=None, reverse=False):
+                    presets=None, control_speed=None, servo_speed=None, reverse=False, scheduler=None):
         ''' Setup PCA9685 and button logic
 
             - pca9685: an object to output the pwm
@@ -268,6 +453,7 @@ class ServoComponent(OutputComponent):
                     with the highest priorty at the front
             - control_speed: the speed that the user is controling the servo with
             - servo_speed: the speed that the servo moves at
+            - scheduler: the ServoScheduler that moves the servo, a new one is started if not given
          '''
 
         # Setup PCA9685 connection
@@ -286,30 +472,41 @@ class ServoComponent(OutputComponent):
                 logger.warn("A preset value is out of range!!!!")
         self.presets = presets
 
+        self.inputs = (modifier, self.UP_BUTTON, self.DOWN_BUTTON, self.AXIS) + tuple(preset[0] for preset in presets)
+
         self.current = self.min_pwm
         self.target = self.min_pwm
-        self._last_time = time.time()
-        self._last_ouput = self.current
+        self._last_time = time.monotonic()
+        self._last_control = self._last_time
+        self._control_move = 0 # Part of a step moved by the controls, not added to the target yet
+        self._last_output = None # Nothing output yet, so the starting position is written on the first step
 
         self.control_speed = control_speed
         self.servo_speed = servo_speed
 
-        self.active = True
+        self.scheduler = scheduler
         self.setup()
 
     def stop(self):
-        ''' Stop Servo '''
-        self.active = False
+        ''' Stop Servo where it is '''
+        self.target = self.current
 
     def setup(self):
         ''' Move the servo until it reaches it's starting position '''
-        t = threading.Thread(target=self.loop)
-        t.start()
+        if self.scheduler is None:
+            self.scheduler = ServoScheduler()
+        self.scheduler.add(self)
+        self.scheduler.start()
 
     def output(self):
         self.pca9685.set_pwm(self.channel, 0, self.target)
 
-    async def update(self, data_dict):
+    def repeats(self, data_dict):
+        ''' Keep moving the target while the controls are held '''
+        return bool(data_dict[self.modifier] and
+                    (data_dict[self.UP_BUTTON] or data_dict[self.DOWN_BUTTON] or data_dict[self.AXIS]))
+
+    def update(self, data_dict):
         ''' Update the target of the servo based on the data_dict '''
         
         # Validate that data is in the set range
@@ -321,16 +518,30 @@ class ServoComponent(OutputComponent):
         # Get Modifier
         mod = data_dict[self.modifier]
 
+        # Time since the last frame, at most one control period so the
+        # first frame the controls are held on moves a whole step
+        now = time.monotonic()
+        elapsed = min(now - self._last_control, self.CONTROL_PERIOD)
+        self._last_control = now
+
+        direction = 0
         if mod:
             if data_dict[self.UP_BUTTON]:
-                self.target += self.control_speed
+                direction += 1
             if data_dict[self.DOWN_BUTTON]:
-                self.target -= self.control_speed
+                direction -= 1
+            direction += data_dict[self.AXIS]
+
+        if direction:
+            self._control_move += direction * self.control_speed * elapsed / self.CONTROL_PERIOD
+            step = round(self._control_move)
+            self._control_move -= step
+            self.target += step
 
-            self.target += data_dict[self.AXIS] * self.control_speed
-            
             self.target = min(self.target, self.max_pwm)
             self.target = max(self.target, self.min_pwm)
+        else:
+            self._control_move = 0
 
         # Set to a preset value and override manual control
         for preset in self.presets:
@@ -338,32 +549,197 @@ class ServoComponent(OutputComponent):
                 self.target = int(preset[1])
                 break
 
-    def loop(self):
-        ''' Main loop of special thread '''
-        while self.active:
-            self.move_towards()
-            time.sleep(0.02)
-
-    def move_towards(self):
-        ''' Move the servo to self.target,
-            increment self.current according to the servo speed and time elapsed,
-            then move to new current and save the state
+    def step(self, now):
+        ''' Move self.current towards self.target,
+            according to the servo speed and time elapsed.
+            Return True if it needs to be output
         '''
+        if self.current == self.target:
+            # Nothing to do, start timing from when the target changes
+            self._last_time = now
+            return self.current != self._last_output
+
         # Calculate the amount to move by
-        time_delta = time.time() - self._last_time
+        time_delta = now - self._last_time
         move_amt = int(self.servo_speed * time_delta)
         if move_amt < 1:
-            return
+            return False
 
         # Increment towards the target value in the right direction without being out of bounds
         if self.current < self.target:
             self.current = min(self.current + move_amt, self.target, self.max_pwm)
-        elif self.current >= self.target:
+        else:
             self.current = max(self.current - move_amt, self.target, self.min_pwm)
 
-        # Output
+        # Save state for future
+        self._last_time = now
+        return self.current != self._last_output
+
+    def write(self):
+        ''' Move the servo to self.current '''
         self.pca9685.set_pwm(self.pca9685_channel, 0, self.current) # Move the servo CHECK OUT THE 0
+        self._last_output = self.current
 
-        # Save state for future
-        self._last_time = time.time()
-        self._last_ouput = self.current
+
+class ServoScheduler(object):
+    ''' Moves every servo towards its target on a single thread,
+        only writing to the servos that moved
+    '''
+
+    def __init__(self, period=0.02):
+        ''' - period: the time between each step of the servos (sec) '''
+        self.period = period
+        self.servos = []
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def add(self, servo):
+        self.servos.append(servo)
+
+    def start(self):
+        ''' Start moving the servos on a new thread, if not already '''
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self.loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        ''' Stop moving the servos and wait for the thread to finish '''
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def loop(self):
+        ''' Main loop of the servo thread '''
+        while not self._stop_event.is_set():
+            self.step()
+            self._stop_event.wait(self.period)
+
+    def step(self):
+        ''' Move every servo one step, then write all the ones that moved '''
+        now = time.monotonic()
+        moved = [servo for servo in self.servos if servo.step(now)]
+        with batch_writes(servo.pca9685 for servo in moved):
+            for servo in moved:
+                servo.write()
+
+
+class OutputRouter(object):
+    ''' Passes each controller frame to only the output components
+        whose inputs changed since the frame before it.
+
+        Frames skipped over because they changed an edge triggered input only
+        go to the components with edge_keys, so the others never see them
+    '''
+
+    def __init__(self, outputs):
+        self.outputs = list(outputs)
+        self.edge_outputs = [output for output in self.outputs if output.edge_keys]
+
+        # Input key -> components that read it
+        self.routes = {}
+        self.unrouted = []
+        for output in self.outputs:
+            if not output.inputs:
+                self.unrouted.append(output)
+            for key in output.inputs:
+                self.routes.setdefault(key, []).append(output)
+
+        # The last frame the components without and with edge_keys were updated with
+        self.previous = None
+        self.edge_previous = None
+
+        self.frames = 0
+        self.updates = 0 # Component updates made
+        self.skipped = 0 # Component updates skipped because nothing they read changed
+
+        # Time each component takes to update (ms)
+        self.names = dict(zip(self.outputs, component_names(self.outputs)))
+        self.timings = StageTimings(self.names.values())
+
+    def reset(self):
+        ''' Forget the last frame, so the next one updates everything '''
+        self.previous = None
+        self.edge_previous = None
+
+    def _changed(self, data_dict, previous):
+        ''' Return the components that read an input that changed since previous '''
+        if previous is None:
+            return set(self.outputs)
+
+        changed = set(self.unrouted)
+        for key, outputs in self.routes.items():
+            if data_dict[key] != previous[key]:
+                changed.update(outputs)
+        return changed
+
+    def affected(self, data_dict):
+        ''' Return the components to update for the frame, in order '''
+        changed = self._changed(data_dict, self.previous)
+        if self.edge_previous is not self.previous:
+            # The components with edge_keys have seen frames since, that the others skipped
+            edge_changed = self._changed(data_dict, self.edge_previous)
+            changed = set(output for output in changed if not output.edge_keys)
+            changed.update(output for output in edge_changed if output.edge_keys)
+
+        return [output for output in self.outputs if output in changed or output.repeats(data_dict)]
+
+    def affected_edges(self, data_dict):
+        ''' Return the components with edge_keys to update for a skipped frame, in order '''
+        changed = self._changed(data_dict, self.edge_previous)
+        return [output for output in self.edge_outputs if output in changed or output.repeats(data_dict)]
+
+    async def update(self, data_dict):
+        ''' Update the components affected by the frame '''
+        outputs = self.affected(data_dict)
+        self.previous = self.edge_previous = data_dict
+
+        self.frames += 1
+        await self._update_outputs(outputs, data_dict)
+
+    async def update_edges(self, data_dict):
+        ''' Update only the components with edge_keys affected by a frame that is
+            skipped over, so they still see every press and release
+        '''
+        outputs = self.affected_edges(data_dict)
+        self.edge_previous = data_dict
+        await self._update_outputs(outputs, data_dict)
+
+    async def _update_outputs(self, outputs, data_dict):
+        self.updates += len(outputs)
+        self.skipped += len(self.outputs) - len(outputs)
+
+        # Only wait on the components that need to
+        pending = []
+        for output in outputs:
+            start = time.perf_counter()
+            result = output.update(data_dict)
+            if asyncio.iscoroutine(result):
+                pending.append(self._timed(output, result))
+            else:
+                self.timings.record(self.names[output], (time.perf_counter() - start) * 1000)
+        if pending:
+            await asyncio.gather(*pending)
+
+    async def _timed(self, output, update):
+        start = time.perf_counter()
+        await update
+        self.timings.record(self.names[output], (time.perf_counter() - start) * 1000)
+
+    async def update_all(self, data_dict):
+        ''' Update every component with the frame as its own task,
+            the way every frame was handled before routing
+        '''
+        self.previous = self.edge_previous = data_dict
+        await asyncio.gather(*[asyncio.ensure_future(self._update(output, data_dict)) for output in self.outputs])
+
+    @staticmethod
+    async def _update(output, data_dict):
+        result = output.update(data_dict)
+        if asyncio.iscoroutine(result):
+            await result
+
+    def stats(self):
+        return {'frames': self.frames, 'updates': self.updates, 'skipped': self.skipped}
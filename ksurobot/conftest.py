@@ -0,0 +1,19 @@
+''' conftest.py
+
+    Setup for the tests in tests/, run them from here or the top of the repo with:
+        python -m pytest
+
+    The tests use the simulated hardware (KSURCT_HARDWARE=sim), so they run anywhere
+'''
+
+import os
+import sys
+
+# Before anything imports settings
+os.environ['KSURCT_HARDWARE'] = 'sim'
+
+# The robot's modules import each other by name
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Reads the sensors on a pi, it isn't a pytest test
+collect_ignore = ['test_sensor.py']
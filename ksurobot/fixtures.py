@@ -0,0 +1,46 @@
+''' fixtures.py
+
+    Made up controller data to drive the robot with when there is no controller,
+    and a stand in for a pca9685, for the benchmarks, tests and the loopback and impairment tools
+'''
+
+import random
+
+
+def sample_controller_data():
+    ''' Controller data like the client sends while driving forward and steering '''
+    return {
+        'x': 0, 'y': 0, 'a': 1, 'b': 0,
+        'r_trigger': 4095, 'l_trigger': -4096,
+        'r_stick_x': 0, 'r_stick_y': 10, 'l_stick_x': -10, 'l_stick_y': 0,
+        'r_bump': 0, 'l_bump': 1, '': 0,
+        'left': 0, 'right': 0, 'up': 1, 'down': 0,
+    }
+
+
+def controller_session(frames=2000, seed=0):
+    ''' A made up drive: inputs are held for a while and only sometimes change '''
+    rng = random.Random(seed)
+    data_dict = sample_controller_data()
+    session = []
+    for _ in range(frames):
+        if rng.random() < 0.1:
+            key = rng.choice(sorted(data_dict))
+            if key in ('r_trigger', 'l_trigger'):
+                data_dict[key] = rng.randint(-4096, 4095)
+            elif key.endswith(('_x', '_y')):
+                data_dict[key] = rng.choice((-10, 0, 10))
+            else:
+                data_dict[key] ^= 1
+        session.append(dict(data_dict))
+    return session
+
+
+class NullBoard(object):
+    ''' Stands in for a pca9685, remembering what each channel was set to '''
+
+    def __init__(self):
+        self.channels = {}
+
+    def set_pwm(self, channel, on, off):
+        self.channels[channel] = (on, off)
@@ -1,12 +1,51 @@
 
-import spidev
+import asyncio
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from itertools import count
 
-from settings import SPI_DEVICE
+from metrics import Histogram
+from settings import HARDWARE_BACKEND, SPI_DEVICE
+
+# The GPIO to use, simulated GPIO doesn't need a pi.
+# SPI and the PCA9685 boards are only imported when they are first opened
+if HARDWARE_BACKEND == 'sim':
+    from simulation import SimGPIO
+    gpio = SimGPIO()
+elif HARDWARE_BACKEND == 'real':
+    import RPi.GPIO as gpio
+else:
+    raise ValueError('Unknown hardware backend: {}'.format(HARDWARE_BACKEND))
+
+spi = None
+
+def get_spi():
+    ''' Open the SPI connection to the adc the first time it's needed '''
+    global spi
+    if spi is None:
+        if HARDWARE_BACKEND == 'sim':
+            from simulation import SimSpiDev as SpiDev
+        else:
+            from spidev import SpiDev
+        spi = SpiDev()
+        spi.open(0, SPI_DEVICE)
+        spi.max_speed_hz = 500000
+    return spi
+
+def open_pca9685(address):
+    ''' Connect to the PCA9685 board at address. The library is imported
+        here, so it can be done on a board's setup thread
+    '''
+    if HARDWARE_BACKEND == 'sim':
+        from simulation import SimPCA9685 as PCA9685
+    else:
+        from Adafruit_PCA9685 import PCA9685
+    return PCA9685(address)
 
-spi = spidev.SpiDev()
-spi.open(0, SPI_DEVICE)
-spi.max_speed_hz = 500000
 MAX192AEPP_CHANNEL_TO_COMMAND = [0,4,1,5,2,6,3,7]
+MAX192AEPP_READINGS = 1 << 13 # How many different values process_response can return
 
 def build_read_command(channel):
     ''' Create the command to send to the adc '''
@@ -18,6 +57,401 @@ def process_response(response):
     ''' Return the first 10 bits received back from the adc after 10 zeros '''
     return (response[1]<<5) + (response[2]>>3)
 
+def build_burst_command(channels):
+    ''' Create the command to read several channels in one transfer.
+        Each channel's command byte is sent while the last byte of the
+        channel before it is clocked out (16 clocks per conversion)
+    '''
+    command = []
+    for channel in channels:
+        command += build_read_command(channel)[:2]
+    return command + [0]
+
+def process_burst_response(response, count):
+    ''' Return the reading of each channel from a burst transfer '''
+    return [process_response(response[2*i:2*i+3]) for i in range(count)]
+
+
+class ShadowPCA9685(object):
+    ''' Wraps a PCA9685, remembering what every channel was last set to.
+        Writes that wouldn't change anything are skipped, and inside batch()
+        neighbouring channels that did change are written in one block.
+
+        The PCA9685 can be connected after the wrapper is made, so the board
+        can be set up in the background. Nothing should be written until then
+    '''
+
+    MODE1 = 0x00
+    AUTO_INCREMENT = 0x20
+    LED0_ON_L = 0x06
+    CHANNELS = 16
+    BLOCK_CHANNELS = 8 # An I2C block write is at most 32 bytes
+
+    def __init__(self, pca9685=None):
+        self.pca9685 = None
+        self._device = None
+
+        # (on, off) of each channel, None until it is written
+        self._shadow = [None] * self.CHANNELS
+        self._pending = {}
+        self._batch_depth = 0
+        self._lock = threading.RLock()
+
+        self.writes_issued = 0  # I2C writes made
+        self.writes_avoided = 0 # Channel writes skipped because nothing changed
+        self.write_time = 0     # Time spent writing (sec)
+
+        if pca9685 is not None:
+            self.connect(pca9685)
+
+    @property
+    def connected(self):
+        return self.pca9685 is not None
+
+    def connect(self, pca9685, freq_hz=None):
+        ''' Start writing to pca9685, setting its frequency first if freq_hz is given '''
+        with self._lock:
+            self._device = pca9685._device
+            if freq_hz is not None:
+                pca9685.set_pwm_freq(freq_hz)
+            self._enable_auto_increment()
+            self.pca9685 = pca9685
+
+    def _enable_auto_increment(self):
+        ''' Let block writes go to the registers one after another '''
+        mode1 = self._device.readU8(self.MODE1)
+        self._device.write8(self.MODE1, mode1 | self.AUTO_INCREMENT)
+
+    def set_pwm_freq(self, freq_hz):
+        with self._lock:
+            self.pca9685.set_pwm_freq(freq_hz)
+            self._enable_auto_increment()
+
+    def set_all_pwm(self, on, off):
+        with self._lock:
+            self.pca9685.set_all_pwm(on, off)
+            self.writes_issued += 4
+            self._shadow = [(on, off)] * self.CHANNELS
+
+    def set_pwm(self, channel, on, off):
+        ''' Set a channel, waiting until the end of the batch if in one '''
+        with self._lock:
+            self._pending[channel] = (on, off)
+            if not self._batch_depth:
+                self._flush()
+
+    @contextmanager
+    def batch(self):
+        ''' Hold the writes made in the with block and write them all at the end '''
+        with self._lock:
+            self._batch_depth += 1
+            try:
+                yield self
+            finally:
+                self._batch_depth -= 1
+                if not self._batch_depth:
+                    self._flush()
+
+    def _flush(self):
+        ''' Write the pending channels that changed, neighbours together '''
+        try:
+            changed = sorted(channel for channel, value in self._pending.items() if self._shadow[channel] != value)
+            self.writes_avoided += len(self._pending) - len(changed)
+
+            block = []
+            for channel in changed:
+                if block and (channel != block[-1] + 1 or len(block) == self.BLOCK_CHANNELS):
+                    self._write_block(block)
+                    block = []
+                block.append(channel)
+            if block:
+                self._write_block(block)
+        finally:
+            self._pending.clear()
+
+    def _write_block(self, channels):
+        ''' Write the pending values of neighbouring channels in one I2C write '''
+        data = []
+        for channel in channels:
+            on, off = self._pending[channel]
+            data += [on & 0xFF, on >> 8, off & 0xFF, off >> 8]
+
+        start = time.perf_counter()
+        self._device.writeList(self.LED0_ON_L + 4 * channels[0], data)
+        self.write_time += time.perf_counter() - start
+        self.writes_issued += 1
+
+        for channel in channels:
+            self._shadow[channel] = self._pending[channel]
+
+    def stats(self):
+        return {'writes_issued': self.writes_issued, 'writes_avoided': self.writes_avoided, 'write_time': self.write_time}
+
+
+# Priorities of writes on the I2C bus, lowest first
+MOTOR_PRIORITY = 0
+SERVO_PRIORITY = 1
+LED_PRIORITY = 2
+
+
+class I2CError(Exception):
+    ''' The I2C thread stopped, so writes waiting for it will never be made '''
+
+
+class ArbitratedPCA9685(object):
+    ''' Passes writes for one board to an I2CArbiter at a set priority '''
+
+    def __init__(self, arbiter, board, priority):
+        self.arbiter = arbiter
+        self.board = board
+        self.priority = priority
+        self._batch = None
+        self._after = None
+
+    def set_pwm(self, channel, on, off):
+        if self._batch is not None:
+            self._batch.append((channel, on, off))
+        else:
+            self.arbiter.submit(self.board, self.priority, [(channel, on, off)])
+
+    def after_write(self, channel, callback):
+        ''' Call callback once the write waiting for the channel has been made, see I2CArbiter.after_write '''
+        if self._batch is not None:
+            self._after[channel] = callback
+        else:
+            self.arbiter.after_write(self.board, channel, callback)
+
+    @contextmanager
+    def batch(self):
+        ''' Queue the writes made in the with block all at once at the end '''
+        if self._batch is not None:
+            yield self
+            return
+
+        self._batch = []
+        self._after = {}
+        try:
+            yield self
+        finally:
+            writes, self._batch = self._batch, None
+            after, self._after = self._after, None
+            if writes:
+                self.arbiter.submit(self.board, self.priority, writes)
+            for channel, callback in after.items():
+                self.arbiter.after_write(self.board, channel, callback)
+
+
+class I2CArbiter(object):
+    ''' Owns the I2C bus. Writes to the boards are queued and made on
+        one thread, the most urgent first, so a burst of servo moves can
+        never hold up stopping the motors. A newer write to a channel
+        replaces one that is still waiting. Writes to a board that isn't
+        connected yet wait until it is.
+    '''
+
+    def __init__(self):
+        # (board, channel) -> [priority, order, on, off, time queued, callback once written]
+        self._pending = {}
+        self._in_flight = {} # The same for the writes being made
+        self._order = count()
+        self._condition = threading.Condition()
+        self._writing = None # Priority of the writes being made
+        self._waiters = []
+        self._thread = None
+        self._running = False
+        self._stopping = False
+
+        self.replaced = 0
+        self.queue_depth = Histogram()
+        self.write_latency = Histogram() # From queued to written (ms)
+
+    def channel(self, board, priority):
+        ''' Return an object to write to the board through at the priority '''
+        return ArbitratedPCA9685(self, board, priority)
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopping = False
+        self._running = True
+        self._thread = threading.Thread(target=self.loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        ''' Make the writes still waiting, then stop the thread '''
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, board, priority, writes):
+        ''' Queue writes of (channel, on, off) to the board '''
+        now = time.perf_counter()
+        with self._condition:
+            for channel, on, off in writes:
+                key = (board, channel)
+                waiting = self._pending.get(key)
+                write_priority = priority
+                after = None
+                if waiting is not None:
+                    # Keep the urgency and callback of the write being replaced
+                    self.replaced += 1
+                    write_priority = min(priority, waiting[0])
+                    after = waiting[5]
+                self._pending[key] = [write_priority, next(self._order), on, off, now, after]
+            self.queue_depth.record(len(self._pending))
+            self._condition.notify_all()
+
+    def board_connected(self):
+        ''' Start making the writes that were waiting for a board to be connected '''
+        with self._condition:
+            self._condition.notify_all()
+
+    def after_write(self, board, channel, callback):
+        ''' Call callback on the I2C thread once the write waiting for the channel
+            has been made, or now if there isn't one. It is dropped if the write fails
+        '''
+        key = (board, channel)
+        with self._condition:
+            waiting = self._pending.get(key) or self._in_flight.get(key)
+            if waiting is not None:
+                waiting[5] = callback
+                return
+        callback()
+
+    def flush(self, timeout=None):
+        ''' Wait until every write queued so far to a connected board has been made.
+            Return False if they weren't within timeout (sec), or the I2C thread stopped first
+        '''
+        with self._condition:
+            self._condition.wait_for(lambda: not self._running or self._flushed(), timeout)
+            return self._flushed()
+
+    def written(self, priority):
+        ''' Return a future that is done when no writes at or above the priority to
+            a connected board are waiting. It fails with I2CError if the I2C thread stops first
+        '''
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        with self._condition:
+            if self._idle(priority):
+                future.set_result(None)
+            elif not self._running:
+                future.set_exception(I2CError('The I2C thread has stopped'))
+            else:
+                self._waiters.append((priority, loop, future))
+        return future
+
+    def _flushed(self):
+        return not self._writable() and self._writing is None
+
+    def _writable(self):
+        ''' Return the writes waiting for boards that are connected '''
+        return {key: waiting for key, waiting in self._pending.items() if key[0].connected}
+
+    def _idle(self, priority):
+        if self._writing is not None and self._writing <= priority:
+            return False
+        return not any(waiting[0] <= priority for waiting in self._writable().values())
+
+    def loop(self):
+        ''' Main loop of the I2C thread '''
+        try:
+            self._write_loop()
+        except Exception:
+            logging.getLogger('__main__').exception('I2C thread failed')
+        finally:
+            # Nothing waiting on the thread would ever hear from it again
+            with self._condition:
+                self._running = False
+                self._fail_waiters()
+                self._condition.notify_all()
+
+    def _write_loop(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._writable() or self._stopping)
+                writable = self._writable()
+                if not writable:
+                    # Stopping, drop the writes to boards that never connected
+                    self._pending.clear()
+                    self._wake_waiters()
+                    return
+
+                # Take every write at the most urgent priority waiting
+                priority = min(waiting[0] for waiting in writable.values())
+                writes = sorted((waiting[1], board, channel, waiting[2], waiting[3], waiting[4])
+                                for (board, channel), waiting in writable.items() if waiting[0] == priority)
+                for _, board, channel, _, _, _ in writes:
+                    self._in_flight[(board, channel)] = self._pending.pop((board, channel))
+                self._writing = priority
+
+            written = False
+            crashed = True
+            try:
+                for board in set(write[1] for write in writes):
+                    with board.batch():
+                        for _, write_board, channel, on, off, _ in writes:
+                            if write_board is board:
+                                board.set_pwm(channel, on, off)
+                written = True
+                crashed = False
+            except OSError as e:
+                logging.getLogger('__main__').warn('I2C write failed: {}'.format(e))
+                crashed = False
+            finally:
+                done = time.perf_counter()
+                with self._condition:
+                    for write in writes:
+                        self.write_latency.record((done - write[5]) * 1000)
+                    callbacks = [waiting[5] for waiting in self._in_flight.values() if waiting[5]]
+                    self._in_flight.clear()
+                    self._writing = None
+                    if not crashed:
+                        # Otherwise the thread is stopping, and the waiters are failed instead
+                        self._wake_waiters()
+                    self._condition.notify_all()
+
+            if written:
+                for callback in callbacks:
+                    try:
+                        callback()
+                    except Exception as e:
+                        logging.getLogger('__main__').warn('Call after an I2C write failed: {!r}'.format(e))
+
+    def _wake_waiters(self):
+        waiters = []
+        for priority, loop, future in self._waiters:
+            if self._idle(priority):
+                loop.call_soon_threadsafe(self._set_done, future)
+            else:
+                waiters.append((priority, loop, future))
+        self._waiters = waiters
+
+    def _fail_waiters(self):
+        for priority, loop, future in self._waiters:
+            loop.call_soon_threadsafe(self._set_failed, future)
+        self._waiters = []
+
+    @staticmethod
+    def _set_done(future):
+        if not future.done():
+            future.set_result(None)
+
+    @staticmethod
+    def _set_failed(future):
+        if not future.done():
+            future.set_exception(I2CError('The I2C thread has stopped'))
+
+    def stats(self):
+        return {
+            'replaced': self.replaced,
+            'queue_depth': self.queue_depth.summary(),
+            'write_latency': self.write_latency.summary(),
+        }
+
 
 class MAX192AEPP(object):
 
@@ -29,17 +463,33 @@ class MAX192AEPP(object):
             raise ValueError('Channel for MAX192AEPP must be between 0 and 7 (inclusive)')
 
         command = build_read_command(channel)
-        response = spi.xfer2(command)
+        response = get_spi().xfer2(command)
         return process_response(response)
 
+    @staticmethod
+    def read_channels(channels):
+        ''' Read from the ADC on each of the requested channels in a single transfer '''
+
+        for channel in channels:
+            if channel > 7 or channel < 0:
+                raise ValueError('Channel for MAX192AEPP must be between 0 and 7 (inclusive)')
+
+        if not channels:
+            return []
+
+        command = build_burst_command(channels)
+        response = get_spi().xfer2(command)
+        return process_burst_response(response, len(channels))
+
 def test():
     try:
         while True:
             for channel in range(8):
                 print(channel, MAX192AEPP.read_channel(channel), end='\t')
             print()
+            print('burst', MAX192AEPP.read_channels(list(range(8))))
     except KeyboardInterrupt:
-        spi.close()
+        get_spi().close()
 
 if __name__ == '__main__':
     test()
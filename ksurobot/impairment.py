@@ -0,0 +1,500 @@
+''' impairment.py
+
+    A proxy to put between the client and the server that makes the link as
+    bad as the arena Wi-Fi: delay, jitter, bandwidth caps, loss, reordering,
+    outages and disconnects, changed over time by a scenario.
+
+        python impairment.py [--scenario NAME ...] [--transport websocket|udp] [--output FILE]
+
+    runs the client, with a scripted controller, through the proxy to the
+    server and a robot on simulated hardware (KSURCT_HARDWARE=sim) for each
+    scenario. It reports how long the client took to get frames to the robot
+    again after the link came back, how old the frames the robot applied were,
+    and when the watchdog stopped the robot. --output appends the results to
+    FILE as lines of json
+'''
+
+import argparse
+import asyncio
+import json
+import logging
+import random
+import socket
+import time
+
+from client import Client
+from fixtures import controller_session
+from logs import setup_logging
+from metrics import Histogram
+from protocol import elapsed_ms
+from server import Server
+from settings import *
+
+
+class Impairment(object):
+    ''' How bad the link is, in each direction.
+
+        TCP can't lose or reorder what it delivers, so on the websocket a lost
+        chunk arrives retransmit_delay late instead, holding up everything
+        sent after it. Datagrams are dropped, and can overtake each other
+    '''
+
+    def __init__(self, delay=0, jitter=0, bandwidth=None, loss=0, reorder=0,
+                 retransmit_delay=0.2, reorder_delay=0.02):
+        ''' - delay: time everything takes to get through (sec)
+            - jitter: up to this much more, picked at random (sec)
+            - bandwidth: bytes a second that can get through, None for no limit
+            - loss: chance a chunk or datagram is lost
+            - reorder: chance a datagram is held back reorder_delay (sec), so the next ones overtake it
+            - retransmit_delay: how late a lost TCP chunk arrives (sec)
+        '''
+        self.delay = delay
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.loss = loss
+        self.reorder = reorder
+        self.retransmit_delay = retransmit_delay
+        self.reorder_delay = reorder_delay
+
+
+PROFILES = {
+    'clean': Impairment(),
+    'arena': Impairment(delay=0.01, jitter=0.03, loss=0.02, reorder=0.01),
+    'congested': Impairment(delay=0.05, jitter=0.1, bandwidth=8000, loss=0.05, reorder=0.05),
+    'lossy': Impairment(delay=0.005, jitter=0.01, loss=0.2, reorder=0.05),
+}
+
+# name -> (duration (sec), steps of (time (sec), action, argument)). Actions:
+#   'profile': switch to the named profile
+#   'outage': nothing gets through for argument sec
+#   'disconnect': reset every connection
+SCENARIOS = {
+    'clean': (4, [(0, 'profile', 'clean')]),
+    'arena': (6, [(0, 'profile', 'arena')]),
+    'congested': (6, [(0, 'profile', 'congested')]),
+    'lossy': (6, [(0, 'profile', 'lossy')]),
+    'short_blip': (5, [(0, 'profile', 'arena'), (1, 'outage', 0.5)]),
+    'blip': (8, [(0, 'profile', 'arena'), (1, 'outage', 2)]),
+    'disconnect': (5, [(0, 'profile', 'arena'), (1, 'disconnect', None)]),
+    'degrade': (10, [(0, 'profile', 'arena'), (2, 'profile', 'congested'), (4, 'outage', 1.5),
+                     (5.5, 'profile', 'lossy'), (7.5, 'profile', 'clean')]),
+}
+
+
+class ImpairedPipe(object):
+    ''' One direction of a TCP connection through the proxy, delivering what
+        is read in order, each chunk when the impairment says it gets through
+    '''
+
+    def __init__(self, proxy, reader, writer):
+        self.proxy = proxy
+        self.reader = reader
+        self.writer = writer
+        self._queue = asyncio.Queue()
+        self._link_free = 0     # When the chunks before have been sent at the capped bandwidth
+        self._last_delivery = 0
+
+    async def run(self):
+        ''' Forward until either side closes '''
+        delivery = asyncio.ensure_future(self._deliver())
+        try:
+            while True:
+                data = await self.reader.read(65536)
+                if not data:
+                    break
+                self._queue.put_nowait((self._delivery_time(len(data)), data))
+        except ConnectionError:
+            pass
+        finally:
+            # Deliver what is left, then close the other side
+            self._queue.put_nowait((None, None))
+            await delivery
+
+    def _delivery_time(self, size):
+        profile = self.proxy.profile
+        random_ = self.proxy.random
+        loop = asyncio.get_event_loop()
+
+        sent = max(loop.time(), self._link_free)
+        if profile.bandwidth:
+            sent += size / profile.bandwidth
+            self._link_free = sent
+
+        delivery = sent + profile.delay + random_.uniform(0, profile.jitter)
+        if random_.random() < profile.loss:
+            delivery += profile.retransmit_delay
+            self.proxy.retransmits += 1
+
+        # Nothing overtakes what was sent before it
+        self._last_delivery = max(delivery, self._last_delivery)
+        return self._last_delivery
+
+    async def _deliver(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            delivery, data = await self._queue.get()
+            if data is None or self.writer.transport.is_closing():
+                self.writer.close()
+                return
+
+            await asyncio.sleep(max(delivery - loop.time(), 0))
+            await self.proxy.link_up()
+            self.writer.write(data)
+            self.proxy.bytes += len(data)
+            self.proxy.chunks += 1
+
+
+class ImpairedDatagrams(asyncio.DatagramProtocol):
+    ''' Forwards datagrams to the target, each one when the impairment says it gets through '''
+
+    def __init__(self, proxy, target, outgoing):
+        ''' Datagrams are sent on to target from the outgoing transport '''
+        self.proxy = proxy
+        self.target = target
+        self.outgoing = outgoing
+
+    def datagram_received(self, data, addr):
+        proxy = self.proxy
+        profile = proxy.profile
+        loop = asyncio.get_event_loop()
+
+        if proxy.in_outage() or proxy.random.random() < profile.loss:
+            proxy.dropped += 1
+            return
+
+        delay = profile.delay + proxy.random.uniform(0, profile.jitter)
+        if proxy.random.random() < profile.reorder:
+            delay += profile.reorder_delay
+            proxy.reordered += 1
+        loop.call_later(delay, self.outgoing.sendto, data, self.target)
+        proxy.datagrams += 1
+
+
+class ImpairmentProxy(object):
+    ''' Forwards TCP connections to target, and datagrams to udp_target,
+        through links impaired by the current profile
+    '''
+
+    def __init__(self, target, udp_target=None, profile=None, seed=0):
+        self.target = target
+        self.udp_target = udp_target
+        self.profile = profile or PROFILES['clean']
+        self.random = random.Random(seed)
+        self.logger = logging.getLogger('__main__')
+
+        self.port = None
+        self._server = None
+        self._datagram_transport = None
+        self._outgoing_transport = None
+        self._connections = set()
+        self._outage_end = 0
+
+        # When the link came back after each outage or disconnect (loop time)
+        self.restored = []
+
+        self.connections = 0
+        self.disconnects = 0
+        self.bytes = 0
+        self.chunks = 0
+        self.retransmits = 0
+        self.datagrams = 0
+        self.dropped = 0
+        self.reordered = 0
+
+    async def start(self, host='127.0.0.1', port=0, udp_port=None):
+        ''' Listen for connections on port (any free one for 0), and datagrams on udp_port '''
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+        if udp_port is not None and self.udp_target:
+            loop = asyncio.get_event_loop()
+            self._outgoing_transport, _ = await loop.create_datagram_endpoint(
+                asyncio.DatagramProtocol, family=socket.AF_INET)
+            self._datagram_transport, _ = await loop.create_datagram_endpoint(
+                lambda: ImpairedDatagrams(self, self.udp_target, self._outgoing_transport), local_addr=(host, udp_port))
+
+    async def stop(self):
+        self._reset_connections()
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+        if self._datagram_transport:
+            self._datagram_transport.close()
+            self._outgoing_transport.close()
+
+    def set_profile(self, profile):
+        self.profile = PROFILES[profile] if isinstance(profile, str) else profile
+
+    def in_outage(self):
+        return asyncio.get_event_loop().time() < self._outage_end
+
+    async def link_up(self):
+        ''' Wait until any outage is over '''
+        loop = asyncio.get_event_loop()
+        while loop.time() < self._outage_end:
+            await asyncio.sleep(self._outage_end - loop.time())
+
+    def outage(self, duration):
+        ''' Let nothing through for duration (sec). What is sent over TCP meanwhile
+            arrives when it ends, like retransmits after the link comes back,
+            datagrams are lost
+        '''
+        loop = asyncio.get_event_loop()
+        self._outage_end = loop.time() + duration
+        self.restored.append(self._outage_end)
+
+    def disconnect(self):
+        ''' Reset every connection through the proxy '''
+        self._reset_connections()
+        self.disconnects += 1
+        self.restored.append(asyncio.get_event_loop().time())
+
+    def _reset_connections(self):
+        for client_writer, server_writer in list(self._connections):
+            client_writer.transport.abort()
+            server_writer.transport.abort()
+        self._connections.clear()
+
+    async def run_scenario(self, steps, duration):
+        ''' Take each step at its time, and return after duration (sec) '''
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        for step_time, action, argument in steps:
+            await asyncio.sleep(max(start + step_time - loop.time(), 0))
+            self.logger.info('Impairment: {0} {1}'.format(action, argument if argument is not None else ''))
+            if action == 'profile':
+                self.set_profile(argument)
+            elif action == 'outage':
+                self.outage(argument)
+            elif action == 'disconnect':
+                self.disconnect()
+            else:
+                raise ValueError('Unknown impairment: {}'.format(action))
+        await asyncio.sleep(max(start + duration - loop.time(), 0))
+
+    async def _handle_connection(self, client_reader, client_writer):
+        # Connecting goes over the link too
+        await self.link_up()
+        try:
+            server_reader, server_writer = await asyncio.open_connection(*self.target)
+        except OSError as e:
+            self.logger.info('Impairment proxy could not connect to {0}: {1}'.format(self.target, e))
+            client_writer.close()
+            return
+
+        self.connections += 1
+        connection = (client_writer, server_writer)
+        self._connections.add(connection)
+        try:
+            await asyncio.gather(ImpairedPipe(self, client_reader, server_writer).run(),
+                                 ImpairedPipe(self, server_reader, client_writer).run())
+        finally:
+            self._connections.discard(connection)
+            client_writer.close()
+            server_writer.close()
+
+    def stats(self):
+        return {
+            'connections': self.connections,
+            'disconnects': self.disconnects,
+            'bytes': self.bytes,
+            'chunks': self.chunks,
+            'retransmits': self.retransmits,
+            'datagrams': self.datagrams,
+            'dropped': self.dropped,
+            'reordered': self.reordered,
+        }
+
+
+class ScriptedInput(object):
+    ''' Stands in for the client's ControllerInput, moving through frames at rate a second '''
+
+    def __init__(self, frames, rate=20):
+        self.frames = frames
+        self.rate = rate
+        self._start = None
+        self._index = 0
+
+    def start(self):
+        self._start = asyncio.get_event_loop().time()
+
+    def stop(self):
+        pass
+
+    def _current(self):
+        return int((asyncio.get_event_loop().time() - self._start) * self.rate)
+
+    def get(self):
+        self._index = self._current()
+        return self.frames[self._index % len(self.frames)]
+
+    async def wait(self, timeout=None):
+        ''' Wait up to timeout (sec) for the next frame after the last get '''
+        delay = self._start + (self._index + 1) / self.rate - asyncio.get_event_loop().time()
+        if timeout is not None:
+            delay = min(delay, timeout)
+        await asyncio.sleep(max(delay, 0))
+
+
+class MeasuredServer(Server):
+    ''' Notes when each frame was applied and how old it was, and when the robot was stopped '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.applied = []       # (loop time, age (ms)) of each frame applied
+        self.watchdog_stops = []
+        self.stops = []
+        self.accepted = 0
+        self.watchdog.stop = self._watchdog_stop
+
+    async def handle_new_connection(self, ws, path):
+        self.accepted += 1
+        await super().handle_new_connection(ws, path)
+
+    async def apply(self, frame, streams, codec):
+        if frame.timestamp is not None:
+            self.applied.append((asyncio.get_event_loop().time(), elapsed_ms(frame.timestamp)))
+        await super().apply(frame, streams, codec)
+
+    def stop(self):
+        self.stops.append(asyncio.get_event_loop().time())
+        super().stop()
+
+    def _watchdog_stop(self):
+        self.watchdog_stops.append(asyncio.get_event_loop().time())
+        self.stop()
+
+
+def free_udp_port(host='127.0.0.1'):
+    ''' A UDP port nothing is using right now '''
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+async def run_impaired(robot, scenario, transport='websocket', rate=20, seed=0):
+    ''' Drive the robot through the proxy for a scenario and return the results '''
+    duration, steps = SCENARIOS[scenario]
+    loop = asyncio.get_event_loop()
+
+    udp_port = free_udp_port() if transport == 'udp' else None
+    server = MeasuredServer('127.0.0.1', 0, robot, timeout=SERVER_TIMEOUT, udp_port=udp_port, record_dir=None)
+    await server.start_server()
+    await robot.ready()
+
+    # The client sends datagrams to SERVER_UDP_PORT on the host it connects to
+    proxy = ImpairmentProxy(('127.0.0.1', server.server.sockets[0].getsockname()[1]),
+                            udp_target=('127.0.0.1', udp_port) if udp_port else None, seed=seed)
+    await proxy.start(udp_port=SERVER_UDP_PORT if udp_port else None)
+
+    client = Client('127.0.0.1', proxy.port, controller_input=ScriptedInput(controller_session(), rate), transport=transport)
+    client_task = asyncio.ensure_future(client.start_client())
+
+    try:
+        # Start once the robot is being driven
+        deadline = loop.time() + 5
+        while not server.applied and loop.time() < deadline and not client_task.done():
+            await asyncio.sleep(0.01)
+        start = loop.time()
+        await proxy.run_scenario(steps, duration)
+    finally:
+        client_error = None
+        if client_task.done() and not client_task.cancelled() and client_task.exception():
+            client_error = repr(client_task.exception())
+        client_task.cancel()
+        client.controller_input.stop()
+        client.close_datagram()
+        if client.ws and client.ws.open:
+            await client.ws.close()
+        await proxy.stop()
+        await server.shutdown()
+
+    applied = [entry for entry in server.applied if entry[0] >= start]
+    times = [start] + [applied_time for applied_time, _ in applied] + [start + duration]
+    ages = Histogram()
+    for _, age in applied:
+        ages.record(age)
+
+    # From the link coming back to the next frame the robot applied
+    recoveries = []
+    for restored in proxy.restored:
+        after = [applied_time for applied_time in times[1:-1] if applied_time >= restored]
+        recoveries.append(round((after[0] - restored) * 1000, 1) if after else None)
+
+    return {
+        'applied': len(applied),
+        'age': ages.summary(),
+        'max_gap': round(max(later - earlier for earlier, later in zip(times, times[1:])) * 1000, 1),
+        'recoveries': recoveries,
+        'watchdog_trips': [round(stop - start, 2) for stop in server.watchdog_stops if stop >= start],
+        'robot_stops': [round(stop - start, 2) for stop in server.stops if start <= stop <= start + duration],
+        'connections': server.accepted,
+        'resumed': server.resumed_sessions,
+        'client_error': client_error,
+        'proxy': proxy.stats(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Drive the robot through an impaired link')
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help='scenario to run, can be given more than once (default all)')
+    parser.add_argument('--transport', choices=['websocket', 'udp'], default='websocket',
+                        help='how the client sends the controller data')
+    parser.add_argument('--rate', type=float, default=20, help='how many times a second the controller changes')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the impairments')
+    parser.add_argument('--output', help='append the results to this file as lines of json')
+    parser.add_argument('--verbose', action='store_true', help='log what the client, server and robot are doing')
+    args = parser.parse_args()
+
+    if HARDWARE_BACKEND != 'sim':
+        parser.error('needs the simulated hardware, run with KSURCT_HARDWARE=sim')
+
+    log_listener = setup_logging(logging.INFO if args.verbose else logging.ERROR)
+
+    # Imported here so the arguments are checked before the hardware is set up
+    from robot import Robot
+
+    loop = asyncio.get_event_loop()
+    robot = Robot()
+    runs = []
+    try:
+        for scenario in args.scenario or sorted(SCENARIOS):
+            results = loop.run_until_complete(run_impaired(robot, scenario, args.transport, args.rate, args.seed))
+            robot.stop()
+            runs.append((scenario, results))
+
+            age = results['age']
+            print('{0}: applied {1} frames, age p50 {2} ms p99 {3} ms, longest without a frame {4} ms'.format(
+                scenario, results['applied'], age['p50'], age['p99'], results['max_gap']))
+            if results['recoveries']:
+                print('    frames again {} ms after the link came back'.format(results['recoveries']))
+            if results['watchdog_trips']:
+                print('    watchdog stopped the robot at {} sec'.format(results['watchdog_trips']))
+            if results['robot_stops']:
+                print('    robot stopped at {} sec'.format(results['robot_stops']))
+            print('    {0} connection(s), {1} resumed, proxy {2}'.format(
+                results['connections'], results['resumed'], results['proxy']))
+            if results['client_error']:
+                print('    client stopped: {}'.format(results['client_error']))
+    finally:
+        robot.stop()
+        log_listener.stop()
+
+    if args.output:
+        with open(args.output, 'a') as f:
+            for scenario, results in runs:
+                run = {
+                    'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                    'scenario': scenario,
+                    'transport': args.transport,
+                    'rate': args.rate,
+                    'seed': args.seed,
+                    'results': results,
+                }
+                f.write(json.dumps(run, sort_keys=True) + '\n')
+        print('Appended the results to {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+''' logs.py
+
+    Log from the event loop without waiting on the terminal.
+    Records are put on a queue and formatted and written by a background thread
+'''
+
+import logging
+import queue
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+from settings import COMPETITION_MODE, LOG_FORMAT, LOG_FRAME_INTERVAL
+
+
+class LazyQueueHandler(QueueHandler):
+    ''' Queues records without formatting them, that is left to the listener's thread '''
+
+    def prepare(self, record):
+        return record
+
+
+def setup_logging(level=logging.INFO, stream=None):
+    ''' Send every log record through a queue to a thread that writes them to stream (stderr by default).
+        Return the listener, stop it before exiting to write the records still waiting
+    '''
+    records = queue.Queue()
+
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    listener = QueueListener(records, handler)
+
+    root = logging.getLogger()
+    for old_handler in root.handlers[:]:
+        root.removeHandler(old_handler)
+    root.addHandler(LazyQueueHandler(records))
+    root.setLevel(level)
+
+    listener.start()
+    return listener
+
+
+class FrameLog(object):
+    ''' Logs messages made for every frame at most once every interval,
+        and not at all in competition mode.
+        Use %-style arguments so nothing is formatted unless it is logged
+    '''
+
+    def __init__(self, logger, interval=LOG_FRAME_INTERVAL, enabled=not COMPETITION_MODE):
+        self.logger = logger
+        self.interval = interval
+        self.enabled = enabled
+        self.skipped = 0
+        self._next = 0
+
+    def __call__(self, message, *args):
+        if not self.enabled:
+            return
+
+        now = time.monotonic()
+        if now < self._next:
+            self.skipped += 1
+            return
+        self._next = now + self.interval
+
+        if self.logger.isEnabledFor(logging.INFO):
+            if self.skipped:
+                message += ' (%d more since the last)'
+                args += (self.skipped,)
+            self.logger.info(message, *args)
+        self.skipped = 0
@@ -0,0 +1,209 @@
+''' loopback.py
+
+    Benchmark the whole path from the client to the robot on one machine:
+        python loopback.py [--clients N] [--rate HZ] [--codec binary|pickle] [--duration SEC] [--output FILE]
+
+    Starts the server with a robot on simulated hardware (KSURCT_HARDWARE=sim)
+    on localhost, and connects senders to it that send controller frames like
+    the client does, without a controller. Reports how many frames the robot
+    applied, their latency from the acks (binary only, pickles aren't acked),
+    the CPU time per frame and the memory used.
+
+    --output appends the settings and results of the run to FILE as a line of
+    json, so runs against different versions of the code can be compared.
+    The senders run in the same process, so the CPU time includes them
+'''
+
+import argparse
+import asyncio
+import json
+import logging
+import platform
+import resource
+import subprocess
+import time
+import websockets
+
+from fixtures import controller_session
+from logs import setup_logging
+from metrics import StageTimings
+from protocol import ACK_MESSAGE, ACK_STAGES, CODECS, elapsed_ms, get_codec, subprotocols
+from server import Server
+from settings import *
+
+
+class LoopbackSender(object):
+    ''' Sends a made up drive to the server at a fixed rate, like the client does, timing the acks '''
+
+    def __init__(self, uri, codec, rate, frames, latency):
+        ''' - uri: the server to connect to
+            - codec: name of the codec to ask the server for
+            - rate: frames to send a second
+            - frames: the controller data to send, over and over
+            - latency: StageTimings of ('rtt', 'network') + ACK_STAGES to record the acks to
+        '''
+        self.uri = uri
+        self.codec_name = codec
+        self.rate = rate
+        self.frames = frames
+        self.latency = latency
+
+        self.ws = None
+        self.codec = None
+        self.sent = 0
+        self.acked = 0
+        self.late = 0   # Frames sent more than a frame late, the sender couldn't keep up
+        self.other = 0  # Telemetry and stats messages received
+
+    async def run(self, duration, drain=0.2):
+        ''' Send frames for duration (sec), then wait drain (sec) for the last acks '''
+        self.ws = await websockets.connect(self.uri, subprotocols=subprotocols([self.codec_name]))
+        self.codec = get_codec(self.ws.subprotocol)
+        receiver = asyncio.ensure_future(self.receive())
+        try:
+            await self.send(duration)
+            await asyncio.sleep(drain)
+        finally:
+            await self.ws.close()
+            await receiver
+
+    async def send(self, duration):
+        loop = asyncio.get_event_loop()
+        interval = 1 / self.rate
+        start = loop.time()
+
+        while self.sent * interval < duration:
+            delay = start + self.sent * interval - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            elif delay < -interval:
+                self.late += 1
+
+            await self.ws.send(self.codec.encode_controller(self.frames[self.sent % len(self.frames)]))
+            self.sent += 1
+
+    async def receive(self):
+        while True:
+            try:
+                packed_message = await self.ws.recv()
+            except websockets.ConnectionClosed:
+                return
+
+            if self.codec.message_type(packed_message) != ACK_MESSAGE:
+                self.other += 1
+                continue
+
+            self.acked += 1
+            _, timestamp, stages = self.codec.decode_ack(packed_message)
+            rtt = elapsed_ms(timestamp)
+            self.latency.record('rtt', rtt)
+            self.latency.record('network', max(rtt - stages['robot'], 0))
+            for stage in ACK_STAGES:
+                self.latency.record(stage, stages[stage])
+
+
+def git_revision():
+    ''' The commit being benchmarked, if it can be found '''
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run_loopback(robot, clients=1, rate=CLIENT_MAX_SEND_RATE, codec='binary', duration=5):
+    ''' Run senders against a server on localhost driving robot, and return the results '''
+    # Keep the timing of every frame of the run, so the percentiles and max cover all of it
+    samples = clients * (int(rate * duration) + 1)
+
+    server = Server('127.0.0.1', 0, robot, timeout=SERVER_TIMEOUT, record_dir=None)
+    server.latency = StageTimings(ACK_STAGES, size=samples)
+    await server.start_server()
+    port = server.server.sockets[0].getsockname()[1]
+    await robot.ready()
+
+    latency = StageTimings(('rtt', 'network') + ACK_STAGES, size=samples)
+    frames = controller_session()
+    senders = [LoopbackSender('ws://127.0.0.1:{}'.format(port), codec, rate, frames, latency) for _ in range(clients)]
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    try:
+        await asyncio.gather(*[sender.run(duration) for sender in senders])
+    finally:
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu_start
+        await server.shutdown()
+
+    sent = sum(sender.sent for sender in senders)
+    applied = server.latency.histograms['robot'].count
+    return {
+        'sent': sent,
+        'applied': applied,
+        'skipped': sent - applied,
+        'acked': sum(sender.acked for sender in senders),
+        'late': sum(sender.late for sender in senders),
+        'frames_per_sec': applied / elapsed,
+        'cpu_per_frame_us': cpu / applied * 1e6 if applied else None,
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'rss_growth_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - max_rss,
+        'latency': latency.summary(),
+        'robot': server.latency.summary(),
+        'loop_lag': server.loop_monitor.lag.summary(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the client to robot path over localhost')
+    parser.add_argument('--clients', type=int, default=1, help='how many senders to connect')
+    parser.add_argument('--rate', type=float, default=CLIENT_MAX_SEND_RATE, help='frames a second each sender sends')
+    parser.add_argument('--codec', choices=sorted(CODECS), default='binary', help='how the frames are packed')
+    parser.add_argument('--duration', type=float, default=5, help='how long to send for (sec)')
+    parser.add_argument('--output', help='append the results to this file as a line of json')
+    parser.add_argument('--verbose', action='store_true', help='log what the server and robot are doing')
+    args = parser.parse_args()
+
+    if HARDWARE_BACKEND != 'sim':
+        parser.error('needs the simulated hardware, run with KSURCT_HARDWARE=sim')
+
+    log_listener = setup_logging(logging.INFO if args.verbose else logging.WARNING)
+
+    # Imported here so the arguments are checked before the hardware is set up
+    from robot import Robot
+
+    loop = asyncio.get_event_loop()
+    robot = Robot()
+    try:
+        results = loop.run_until_complete(run_loopback(robot, args.clients, args.rate, args.codec, args.duration))
+    finally:
+        robot.stop()
+        log_listener.stop()
+
+    print('{0} {1} sender(s) at {2:.0f} frames/sec for {3:.0f} sec'.format(args.clients, args.codec, args.rate, args.duration))
+    print('Applied {0} of {1} frames, {2:.0f} frames/sec, {3} sent late'.format(
+        results['applied'], results['sent'], results['frames_per_sec'], results['late']))
+    if results['acked']:
+        rtt = results['latency']['rtt']
+        print('Round trip: p50 {0:.2f} ms, p99 {1:.2f} ms, max {2:.2f} ms'.format(rtt['p50'], rtt['p99'], rtt['max']))
+    if results['cpu_per_frame_us'] is not None:
+        print('CPU: {:.0f} us/frame'.format(results['cpu_per_frame_us']))
+    print('Memory: {0} KB max RSS, grew {1} KB'.format(results['max_rss_kb'], results['rss_growth_kb']))
+
+    if args.output:
+        run = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'clients': args.clients,
+            'rate': args.rate,
+            'codec': args.codec,
+            'duration': args.duration,
+            'results': results,
+        }
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(run, sort_keys=True) + '\n')
+        print('Appended the results to {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,9 +3,12 @@
     Starts the program
 '''
 
+# Imported first, to time the rest of startup from here
+import startup
+
 import asyncio
-import websockets
 import logging
+from logs import setup_logging
 from server import Server
 from robot import Robot
 from settings import *
@@ -14,17 +17,19 @@ from settings import *
 def main():
     ''' Main Entrance to the program '''
 
-    # Setup Logging
-    logging.basicConfig(format='%(name)s: %(levelname)s: %(asctime)s: %(message)s', level=logging.INFO)
+    # Setup Logging, written on its own thread
+    log_listener = setup_logging(logging.INFO)
     logger = logging.getLogger(__name__)
+    startup.mark('imports')
 
     # Get the event loop to work with
     loop = asyncio.get_event_loop()
 
-    # Setup Robot
+    # Setup Robot, its boards are set up in the background
     robot = Robot()
+    startup.mark('robot')
 
-    server = Server(SERVER_IP, SERVER_PORT, robot, timeout=SERVER_TIMEOUT)
+    server = Server(SERVER_IP, SERVER_PORT, robot, timeout=SERVER_TIMEOUT, udp_port=SERVER_UDP_PORT)
 
     try:
         # Main event loop
@@ -42,6 +47,7 @@ def main():
         # Close the loop
         loop.close()
         logger.info('Event loop closed')
+        log_listener.stop()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,100 @@
+''' metrics.py
+
+    Keep track of how long things take
+'''
+
+import asyncio
+from collections import deque
+
+
+class Histogram(object):
+    ''' Keeps the last size samples to find percentiles from '''
+
+    def __init__(self, size=1000):
+        self._samples = deque(maxlen=size)
+        self.count = 0
+
+    def record(self, value):
+        self._samples.append(value)
+        self.count += 1
+
+    def summary(self):
+        ''' Return the count, median, 99th percentile and max of the samples kept '''
+        if not self._samples:
+            return {'count': self.count, 'p50': None, 'p99': None, 'max': None}
+
+        samples = sorted(self._samples)
+        return {
+            'count': self.count,
+            'p50': samples[len(samples) // 2],
+            'p99': samples[min(len(samples) - 1, len(samples) * 99 // 100)],
+            'max': samples[-1],
+        }
+
+
+class StageTimings(object):
+    ''' A histogram for each stage of handling something, in milliseconds '''
+
+    def __init__(self, stages, size=1000):
+        self.stages = tuple(stages)
+        self.histograms = {stage: Histogram(size) for stage in self.stages}
+
+    def record(self, stage, milliseconds):
+        self.histograms[stage].record(milliseconds)
+
+    def summary(self):
+        ''' Return the summary of every stage '''
+        return {stage: self.histograms[stage].summary() for stage in self.stages}
+
+    def compact(self):
+        ''' Return the [median, 99th percentile, max] of every stage with samples, to send '''
+        return {stage: compact(self.histograms[stage]) for stage in self.stages if self.histograms[stage].count}
+
+    def format(self):
+        ''' Return the summary as a single line for the logs '''
+        parts = []
+        for stage in self.stages:
+            summary = self.histograms[stage].summary()
+            if summary['count']:
+                parts.append('{0} p50={1:.2f} p99={2:.2f}'.format(stage, summary['p50'], summary['p99']))
+        return ', '.join(parts) + ' (ms)'
+
+
+def compact(histogram):
+    ''' Return the [median, 99th percentile, max] of a histogram, rounded to 3 places '''
+    summary = histogram.summary()
+    return [round(summary[key], 3) if summary[key] is not None else None for key in ('p50', 'p99', 'max')]
+
+
+class LoopMonitor(object):
+    ''' Measures how late the event loop runs a callback scheduled every interval.
+        Anything that blocks the loop shows up as lag
+    '''
+
+    def __init__(self, interval=0.05, size=1000):
+        self.interval = interval
+        self.lag = Histogram(size) # ms
+        self._loop = None
+        self._handle = None
+        self._expected = None
+
+    def start(self):
+        ''' Start measuring on the current event loop '''
+        if self._handle:
+            return
+        self._loop = asyncio.get_event_loop()
+        self._schedule()
+
+    def stop(self):
+        if self._handle:
+            self._handle.cancel()
+            self._handle = None
+
+    def _schedule(self):
+        self._expected = self._loop.time() + self.interval
+        self._handle = self._loop.call_at(self._expected, self._tick)
+
+    def _tick(self):
+        # Callbacks can run a little early, within the clock's resolution
+        self.lag.record(max(self._loop.time() - self._expected, 0) * 1000)
+        self._schedule()
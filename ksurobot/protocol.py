@@ -0,0 +1,332 @@
+''' protocol.py
+
+    Define how messages are packed to go between the client and the server
+'''
+
+import json
+import os
+import pickle
+import re
+import struct
+import time
+from operator import itemgetter
+
+from settings import *
+
+
+# Version of the binary layout, bump this when the layout changes
+PROTOCOL_VERSION = 4
+
+# Message types
+CONTROLLER_MESSAGE = 1          # Every field of the controller data, a keyframe
+TELEMETRY_MESSAGE = 2
+CONTROLLER_DELTA_MESSAGE = 3    # Only the fields that changed since the frame before it
+ACK_MESSAGE = 4                 # Sent back by the robot after applying a controller frame
+STATS_MESSAGE = 5               # How long things are taking on the robot
+
+# Keys of the controller data, in the order they are packed
+BUTTON_KEYS = ('x', 'y', 'a', 'b', 'r_bump', 'l_bump', '', 'left', 'right', 'up', 'down')
+AXIS_KEYS = ('r_trigger', 'l_trigger', 'r_stick_x', 'r_stick_y', 'l_stick_x', 'l_stick_y')
+CONTROLLER_KEYS = BUTTON_KEYS + AXIS_KEYS
+
+# Every combination of buttons, so packing and unpacking them is a single lookup
+BUTTON_VALUES = [tuple((buttons >> bit) & 1 for bit in range(len(BUTTON_KEYS))) for buttons in range(1 << len(BUTTON_KEYS))]
+BUTTON_FIELDS = {values: buttons for buttons, values in enumerate(BUTTON_VALUES)}
+BUTTON_MASK = len(BUTTON_VALUES) - 1
+
+get_buttons = itemgetter(*BUTTON_KEYS)
+get_axes = itemgetter(*AXIS_KEYS)
+
+# Keys of the telemetry data, in the order they are packed
+TELEMETRY_KEYS = (SENSOR_0_NAME, SENSOR_1_NAME, SENSOR_2_NAME, SENSOR_3_NAME,
+                  SENSOR_4_NAME, SENSOR_5_NAME, SENSOR_6_NAME, SENSOR_7_NAME)
+
+HEADER = struct.Struct('<BB')                       # version, type
+CONTROLLER = struct.Struct('<BBHIH6h')              # header, sequence, timestamp, buttons, axes
+CONTROLLER_DELTA = struct.Struct('<BBHIHB')         # header, sequence, timestamp, base sequence, changed fields
+ACK = struct.Struct('<BBHI4I')                      # header, sequence, timestamp, stage times (us)
+TELEMETRY_MASK = struct.Struct('<BBB')              # header, present sensors
+TELEMETRY_VALUES = [struct.Struct('<{}f'.format(n)) for n in range(len(TELEMETRY_KEYS) + 1)]
+
+# The fields following a delta for each combination of changed fields.
+# Bit 0 is the buttons, the rest are the axes in order.
+CONTROLLER_FIELDS = 1 + len(AXIS_KEYS)
+DELTA_FIELDS = [struct.Struct('<' + ''.join(('H' if field == 0 else 'h') for field in range(CONTROLLER_FIELDS) if changed & (1 << field)))
+                for changed in range(1 << CONTROLLER_FIELDS)]
+
+SEQUENCE_MASK = 0xffff
+TIMESTAMP_MASK = 0xffffffff
+
+# Clients connect to this path followed by a token that is the same for each of their connections,
+# so the server can carry on with a client that reconnects where it left off
+SESSION_PATH = '/session/'
+SESSION_TOKEN = re.compile('[0-9a-f]{1,32}')
+
+# Stages of handling a controller frame on the robot that are sent back in the ack
+ACK_STAGES = ('decode', 'dispatch', 'i2c', 'robot')
+
+
+class PickleCodec(object):
+    ''' The original format, a pickled dictionary.
+        Used when the other side does not support anything else
+    '''
+
+    name = 'pickle'
+    subprotocol = None
+
+    # Pickles don't say which frame they are
+    received_sequence = None
+    received_timestamp = None
+
+    def reset(self):
+        pass
+
+    def message_type(self, message):
+        ''' Pickles are only ever controller data or telemetry '''
+        return None
+
+    def encode_controller(self, data_dict, timestamp=None):
+        return pickle.dumps(data_dict)
+
+    def decode_controller(self, message):
+        return pickle.loads(message)
+
+    def encode_ack(self, sequence, timestamp, stages):
+        ''' Old clients don't know about acks '''
+        return None
+
+    def encode_stats(self, stats):
+        ''' Old clients don't know about stats messages either '''
+        return None
+
+    def encode_telemetry(self, data_dict):
+        return pickle.dumps(data_dict)
+
+    def decode_telemetry(self, message):
+        return pickle.loads(message)
+
+
+class BinaryCodec(object):
+    ''' Fixed layout binary format
+
+        - controller: a sequence number, the buttons packed into a 16 bit field and the axes as int16.
+            Only the fields that changed since the last frame are sent, with every field sent
+            again as a keyframe every keyframe_interval frames and on a new connection
+        - telemetry: a byte marking which sensors are present followed by their values as float32
+
+        Keep one codec per connection, frames only make sense with the ones before them.
+    '''
+
+    name = 'binary'
+    subprotocol = 'ksurct.binary.v{}'.format(PROTOCOL_VERSION)
+
+    def __init__(self, keyframe_interval=KEYFRAME_INTERVAL):
+        self.keyframe_interval = keyframe_interval
+
+        # Last frame sent, as (buttons, axes...)
+        self._sent = None
+        self._sent_sequence = 0
+        self._since_keyframe = 0
+
+        # Last frame received
+        self._received = None
+        self.received_sequence = 0
+        self.received_timestamp = 0
+        self.out_of_order = 0
+
+    def reset(self):
+        ''' Forget the frames sent and received, like on a new connection '''
+        self._sent = None
+        self._received = None
+
+    def message_type(self, message):
+        return message[1] if len(message) > 1 else None
+
+    def encode_controller(self, data_dict, timestamp=None):
+        ''' Pack the controller data, tagged with a timestamp (ms) from timestamp_ms() '''
+        if timestamp is None:
+            timestamp = timestamp_ms()
+
+        fields = (pack_buttons(data_dict),) + get_axes(data_dict)
+        base = self._sent
+        base_sequence = self._sent_sequence
+
+        self._sent = fields
+        self._sent_sequence = sequence = (base_sequence + 1) & SEQUENCE_MASK
+        self._since_keyframe += 1
+
+        if base is None or self._since_keyframe >= self.keyframe_interval:
+            self._since_keyframe = 0
+            return CONTROLLER.pack(PROTOCOL_VERSION, CONTROLLER_MESSAGE, sequence, timestamp, *fields)
+
+        changed = 0
+        values = []
+        for field in range(CONTROLLER_FIELDS):
+            if fields[field] != base[field]:
+                changed |= 1 << field
+                values.append(fields[field])
+
+        return (CONTROLLER_DELTA.pack(PROTOCOL_VERSION, CONTROLLER_DELTA_MESSAGE, sequence, timestamp, base_sequence, changed)
+                + DELTA_FIELDS[changed].pack(*values))
+
+    def decode_controller(self, message):
+        ''' Return the full controller data, or None if the frame builds on one we don't have '''
+        if len(message) > 1 and message[1] == CONTROLLER_DELTA_MESSAGE:
+            self._check_header(message, CONTROLLER_DELTA_MESSAGE)
+            if len(message) < CONTROLLER_DELTA.size:
+                raise ValueError('Message too short: {} bytes'.format(len(message)))
+
+            _, _, sequence, timestamp, base_sequence, changed = CONTROLLER_DELTA.unpack_from(message)
+            values = DELTA_FIELDS[changed & ((1 << CONTROLLER_FIELDS) - 1)]
+            if len(message) != CONTROLLER_DELTA.size + values.size:
+                raise ValueError('Expected {0} bytes, got {1}'.format(CONTROLLER_DELTA.size + values.size, len(message)))
+
+            if self._received is None or base_sequence != self.received_sequence:
+                # Missed the frame this one changes, wait for the next keyframe
+                return None
+
+            fields = self._received
+            values = iter(values.unpack_from(message, CONTROLLER_DELTA.size))
+            for field in range(CONTROLLER_FIELDS):
+                if changed & (1 << field):
+                    fields[field] = next(values)
+        else:
+            self._check_header(message, CONTROLLER_MESSAGE, CONTROLLER.size)
+
+            values = CONTROLLER.unpack(message)
+            sequence, timestamp = values[2:4]
+            fields = list(values[4:])
+
+            if self._received is not None and not sequence_after(sequence, self.received_sequence):
+                # Arrived after a newer frame, which can happen over UDP
+                self.out_of_order += 1
+                return None
+
+        self._received = fields
+        self.received_sequence = sequence
+        self.received_timestamp = timestamp
+        return dict(zip(CONTROLLER_KEYS, BUTTON_VALUES[fields[0] & BUTTON_MASK] + tuple(fields[1:])))
+
+    def encode_ack(self, sequence, timestamp, stages):
+        ''' Pack an ack of the frame with sequence and timestamp,
+            with how long each of ACK_STAGES took in milliseconds
+        '''
+        return ACK.pack(PROTOCOL_VERSION, ACK_MESSAGE, sequence, timestamp,
+                        *[min(int(stages[stage] * 1000), TIMESTAMP_MASK) for stage in ACK_STAGES])
+
+    def decode_ack(self, message):
+        ''' Return the sequence, timestamp and stage times (ms) of an ack '''
+        self._check_header(message, ACK_MESSAGE, ACK.size)
+
+        values = ACK.unpack(message)
+        return values[2], values[3], {stage: us / 1000 for stage, us in zip(ACK_STAGES, values[4:])}
+
+    def encode_stats(self, stats):
+        ''' Pack a dictionary of performance stats from the robot, as compact json '''
+        return HEADER.pack(PROTOCOL_VERSION, STATS_MESSAGE) + json.dumps(stats, separators=(',', ':')).encode()
+
+    def decode_stats(self, message):
+        self._check_header(message, STATS_MESSAGE)
+        return json.loads(message[HEADER.size:].decode())
+
+    def encode_telemetry(self, data_dict):
+        mask = 0
+        values = []
+        for bit, key in enumerate(TELEMETRY_KEYS):
+            if key in data_dict:
+                mask |= 1 << bit
+                values.append(data_dict[key])
+
+        if len(values) != len(data_dict):
+            raise ValueError('Unknown telemetry keys: {}'.format(set(data_dict) - set(TELEMETRY_KEYS)))
+
+        return TELEMETRY_MASK.pack(PROTOCOL_VERSION, TELEMETRY_MESSAGE, mask) + TELEMETRY_VALUES[len(values)].pack(*values)
+
+    def decode_telemetry(self, message):
+        self._check_header(message, TELEMETRY_MESSAGE)
+
+        mask = TELEMETRY_MASK.unpack_from(message)[2]
+        keys = [key for bit, key in enumerate(TELEMETRY_KEYS) if mask & (1 << bit)]
+        values = TELEMETRY_VALUES[len(keys)]
+
+        if len(message) != TELEMETRY_MASK.size + values.size:
+            raise ValueError('Expected {0} bytes, got {1}'.format(TELEMETRY_MASK.size + values.size, len(message)))
+
+        return dict(zip(keys, values.unpack_from(message, TELEMETRY_MASK.size)))
+
+    @staticmethod
+    def _check_header(message, message_type, size=None):
+        ''' Make sure the message is the version, type and size that we expect '''
+        if len(message) < max(HEADER.size + 1, size or 0):
+            raise ValueError('Message too short: {} bytes'.format(len(message)))
+
+        version, received_type = HEADER.unpack_from(message)
+        if version != PROTOCOL_VERSION:
+            raise ValueError('Unsupported protocol version: {}'.format(version))
+        if received_type != message_type:
+            raise ValueError('Expected message type {0}, got {1}'.format(message_type, received_type))
+        if size is not None and len(message) != size:
+            raise ValueError('Expected {0} bytes, got {1}'.format(size, len(message)))
+
+
+def timestamp_ms():
+    ''' Milliseconds on the monotonic clock, as sent with controller frames '''
+    return int(time.monotonic() * 1000) & TIMESTAMP_MASK
+
+
+def elapsed_ms(timestamp):
+    ''' Milliseconds since a timestamp from timestamp_ms() '''
+    return (timestamp_ms() - timestamp) & TIMESTAMP_MASK
+
+
+def sequence_after(sequence, other):
+    ''' Return True if sequence comes after other, allowing for wrap around '''
+    return 0 < ((sequence - other) & SEQUENCE_MASK) < (SEQUENCE_MASK + 1) // 2
+
+
+def pack_buttons(data_dict):
+    ''' Pack the buttons of the controller data into a bit field '''
+    values = get_buttons(data_dict)
+    try:
+        return BUTTON_FIELDS[values]
+    except KeyError:
+        # Something other than 0/1 or True/False was used
+        return sum(1 << bit for bit, value in enumerate(values) if value)
+
+
+CODECS = {codec.name: codec for codec in (BinaryCodec, PickleCodec)}
+
+
+def new_session_token():
+    ''' A random token for a client to connect with, see session_path '''
+    return os.urandom(8).hex()
+
+
+def session_path(token):
+    ''' The path to connect to, to be recognised as the same client on every connection '''
+    return SESSION_PATH + token
+
+
+def session_token(path):
+    ''' The token in the path of a connection, None if it doesn't have one '''
+    if path and path.startswith(SESSION_PATH):
+        token = path[len(SESSION_PATH):]
+        if SESSION_TOKEN.fullmatch(token):
+            return token
+    return None
+
+
+def subprotocols(names):
+    ''' The websocket subprotocols to offer for the codec names, in order of preference '''
+    offered = [CODECS[name].subprotocol for name in names if CODECS[name].subprotocol]
+    return offered or None
+
+
+def get_codec(subprotocol):
+    ''' Return a codec for the subprotocol negotiated on a connection,
+        falling back to pickle if none was agreed on
+    '''
+    for codec in CODECS.values():
+        if codec.subprotocol and codec.subprotocol == subprotocol:
+            return codec()
+    return PickleCodec()
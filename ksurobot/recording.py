@@ -0,0 +1,97 @@
+''' recording.py
+
+    Record the controller frames of a session to a file, and read them back.
+
+    A recording is a header followed by one fixed size record per frame:
+    the time since the recording started, the buttons packed into a bit field
+    and the axes, the same as a controller keyframe
+'''
+
+import itertools
+import os
+import struct
+import time
+
+from protocol import BUTTON_MASK, BUTTON_VALUES, CONTROLLER_KEYS, get_axes, pack_buttons
+
+
+RECORDING_MAGIC = b'KSRC'
+RECORDING_VERSION = 1
+
+HEADER = struct.Struct('<4sBd')     # magic, version, wall clock time the recording started
+RECORD = struct.Struct('<dH6h')     # time since the start (sec), buttons, axes
+
+# Write the frames out at least this often (sec)
+FLUSH_INTERVAL = 1
+
+
+class SessionRecorder(object):
+    ''' Writes every controller frame given to it to a new recording '''
+
+    def __init__(self, path):
+        ''' Start a recording at path, raising FileExistsError if there already is one '''
+        self.path = path
+        self.frames = 0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._file = open(path, 'xb')
+        self._file.write(HEADER.pack(RECORDING_MAGIC, RECORDING_VERSION, time.time()))
+        self._start = time.monotonic()
+        self._last_flush = self._start
+
+    @classmethod
+    def in_directory(cls, directory, name='session'):
+        ''' Start a new recording in directory, named after when it started.
+            Recordings started in the same second are numbered after the first
+        '''
+        stem = os.path.join(directory, '{0}-{1}'.format(name, time.strftime('%Y%m%d-%H%M%S')))
+        try:
+            return cls(stem + '.ksrec')
+        except FileExistsError:
+            pass
+
+        for number in itertools.count(1):
+            try:
+                return cls('{0}-{1}.ksrec'.format(stem, number))
+            except FileExistsError:
+                pass
+
+    def record(self, data_dict):
+        ''' Append a frame, timed from when the recording started '''
+        now = time.monotonic()
+        self._file.write(RECORD.pack(now - self._start, pack_buttons(data_dict), *get_axes(data_dict)))
+        self.frames += 1
+
+        if now - self._last_flush >= FLUSH_INTERVAL:
+            self._last_flush = now
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def read_recording(path):
+    ''' Yield the (time, controller data) of each frame in a recording.
+        A frame cut off at the end, by a crash, is ignored
+    '''
+    with open(path, 'rb') as f:
+        header = f.read(HEADER.size)
+        if len(header) < HEADER.size:
+            raise ValueError('{} is not a recording'.format(path))
+
+        magic, version, _ = HEADER.unpack(header)
+        if magic != RECORDING_MAGIC:
+            raise ValueError('{} is not a recording'.format(path))
+        if version != RECORDING_VERSION:
+            raise ValueError('Unsupported recording version: {}'.format(version))
+
+        while True:
+            record = f.read(RECORD.size)
+            if len(record) < RECORD.size:
+                return
+
+            values = RECORD.unpack(record)
+            yield values[0], dict(zip(CONTROLLER_KEYS, BUTTON_VALUES[values[1] & BUTTON_MASK] + values[2:]))
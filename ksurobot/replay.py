@@ -0,0 +1,169 @@
+''' replay.py
+
+    Replay a recorded session into the server and robot, without a controller:
+        python replay.py recording.ksrec [--speed N | --max] [--trace trace.csv]
+
+    Frames are sent as the client would send them, at the recorded times
+    (sped up by --speed). With --max each frame is sent as soon as the robot
+    has applied the one before it, so none are skipped and the robot sees the
+    same frames in the same order every time.
+
+    --trace writes every PWM and GPIO write to a csv file, grouped by channel,
+    which needs the simulated hardware (KSURCT_HARDWARE=sim). Traces from
+    --max replays can be compared between versions of the code, ignoring the
+    time column. Servos move with time, so their steps between targets can differ.
+'''
+
+import argparse
+import asyncio
+import csv
+import logging
+import time
+
+from logs import setup_logging
+from protocol import BinaryCodec, get_codec
+from recording import read_recording
+from server import FrameCoalescer, Server
+from settings import *
+from streams import StreamSender
+
+
+class ReplayFinished(Exception):
+    ''' Every frame of the recording has been sent '''
+
+
+class ReplayConnection(object):
+    ''' Stands in for the client's websocket, sending the recorded frames to the server '''
+
+    def __init__(self, frames, coalescer, speed=1):
+        ''' - frames: the (time, controller data) of each frame to send
+            - coalescer: where the server puts the frames, to wait on with speed None
+            - speed: how many times faster than recorded to send the frames,
+                None to send each one as soon as the one before it is applied
+        '''
+        self.coalescer = coalescer
+        self.speed = speed
+        self.codec = BinaryCodec()
+
+        self.open = True
+        self.remote_address = ('replay', 0)
+        self.subprotocol = self.codec.subprotocol
+
+        self.sent = 0
+        self.acks = 0
+
+        self._frames = iter(frames)
+        self._start = None
+
+    async def recv(self):
+        ''' Return the next frame when it is due '''
+        try:
+            frame_time, data = next(self._frames)
+        except StopIteration:
+            raise ReplayFinished()
+
+        if self.speed is None:
+            await self.coalescer.wait_idle()
+        else:
+            loop = asyncio.get_event_loop()
+            if self._start is None:
+                self._start = loop.time() - frame_time / self.speed
+            delay = self._start + frame_time / self.speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+        self.sent += 1
+        return self.codec.encode_controller(data)
+
+    async def send(self, message):
+        ''' Acks from the server '''
+        self.acks += 1
+
+
+async def replay(server, connection, coalescer):
+    ''' Feed every frame of the connection through the server, waiting until they are all applied '''
+    codec = get_codec(connection.subprotocol)
+    streams = StreamSender(connection)
+    tasks = [asyncio.ensure_future(server.apply_handler(streams, codec, coalescer)), asyncio.ensure_future(streams.run())]
+    try:
+        try:
+            await server.consumer_handler(connection, codec, coalescer)
+        except ReplayFinished:
+            pass
+        await coalescer.wait_idle()
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def write_trace(path, start):
+    ''' Write every PWM and GPIO write made by the simulated hardware to a csv file '''
+    from hardware import gpio
+    from simulation import SimPCA9685
+
+    rows = []
+    for address, board in sorted(SimPCA9685.boards.items()):
+        device = 'pca9685-0x{:02x}'.format(address)
+        rows += [(write_time - start, device, channel, on, off) for write_time, channel, on, off in board.writes]
+    rows += [(write_time - start, 'gpio', pin, '', value) for write_time, pin, value in gpio.writes]
+
+    # Each channel's writes together, in order, as writes to different
+    # channels made on different threads can be interleaved differently every run
+    rows.sort(key=lambda row: (row[1], row[2], row[0]))
+
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['time', 'device', 'channel', 'on', 'off'])
+        for row in rows:
+            writer.writerow(['{:.6f}'.format(row[0])] + list(row[1:]))
+    return len(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a recorded session into the robot')
+    parser.add_argument('recording', help='a .ksrec file recorded by the server or client')
+    speed = parser.add_mutually_exclusive_group()
+    speed.add_argument('--speed', type=float, default=1, help='how many times faster than recorded to replay')
+    speed.add_argument('--max', action='store_true', help='send each frame as soon as the last is applied')
+    parser.add_argument('--trace', help='write the PWM and GPIO writes to this csv file (simulated hardware only)')
+    parser.add_argument('--verbose', action='store_true', help='log what the server and robot are doing')
+    args = parser.parse_args()
+
+    if args.trace and HARDWARE_BACKEND != 'sim':
+        parser.error('--trace needs the simulated hardware, run with KSURCT_HARDWARE=sim')
+
+    log_listener = setup_logging(logging.INFO if args.verbose else logging.WARNING)
+
+    # Imported here so the arguments are checked before the hardware is set up
+    from robot import Robot
+
+    frames = list(read_recording(args.recording))
+    if not frames:
+        parser.error('{} has no frames'.format(args.recording))
+
+    loop = asyncio.get_event_loop()
+    start = time.monotonic()
+    robot = Robot()
+    server = Server(SERVER_IP, SERVER_PORT, robot)
+    coalescer = FrameCoalescer(robot.edge_keys)
+    connection = ReplayConnection(frames, coalescer, speed=None if args.max else args.speed)
+
+    replay_start = time.perf_counter()
+    try:
+        loop.run_until_complete(replay(server, connection, coalescer))
+    finally:
+        elapsed = time.perf_counter() - replay_start
+        robot.stop()
+        log_listener.stop()
+
+    print('Replayed {0} frames ({1:.1f} sec recorded) in {2:.2f} sec, {3:.0f} frames/sec'.format(
+        connection.sent, frames[-1][0], elapsed, connection.sent / elapsed))
+    print('Applied {0}, skipped {1} behind newer ones'.format(coalescer.applied, coalescer.skipped))
+    print('Frame latency: {}'.format(server.latency.format()))
+
+    if args.trace:
+        print('Wrote {0} writes to {1}'.format(write_trace(args.trace, start), args.trace))
+
+
+if __name__ == '__main__':
+    main()
@@ -4,10 +4,14 @@
 '''
 
 import asyncio
+import logging
+import time
 
-from Adafruit_PCA9685 import PCA9685
-
+import startup
 from components import *
+from hardware import gpio, open_pca9685, I2CArbiter, ShadowPCA9685, MOTOR_PRIORITY, SERVO_PRIORITY, LED_PRIORITY
+from logs import FrameLog
+from metrics import StageTimings
 from settings import *
 
 
@@ -17,15 +21,31 @@ class Robot(object):
     def __init__(self):
 
         # Set the GPIO numbering mode
-        io.setmode(GPIO_MODE)
-
-        # Connect to servo and motor pca9685 boards
-        servo_pca9685 = PCA9685(SERVO_I2C_ADDRESS)
-        motor_pca9685 = PCA9685(MOTOR_I2C_ADDRESS)
-
-        # Set pca9685 board frequencies
-        servo_pca9685.set_pwm_freq(SERVO_PWM_FREQ)
-        motor_pca9685.set_pwm_freq(MOTOR_PWM_FREQ)
+        gpio.setmode(getattr(gpio, GPIO_MODE))
+
+        # The servo and motor pca9685 boards, skipping writes that don't change anything
+        self.servo_board = ShadowPCA9685()
+        self.motor_board = ShadowPCA9685()
+
+        # All writes to the boards go through one thread, most urgent first.
+        # They wait there until their board is connected
+        self.i2c = I2CArbiter()
+        self.i2c.start()
+
+        # Connect to the boards and set their frequencies on their own threads,
+        # at the same time, so the server can start listening meanwhile
+        loop = asyncio.get_event_loop()
+        self.motors_ready = loop.run_in_executor(None, self._connect_board, 'motor board', self.motor_board,
+                                                 MOTOR_I2C_ADDRESS, MOTOR_PWM_FREQ)
+        self.servos_ready = loop.run_in_executor(None, self._connect_board, 'servo board', self.servo_board,
+                                                 SERVO_I2C_ADDRESS, SERVO_PWM_FREQ)
+        motor_pca9685 = self.i2c.channel(self.motor_board, MOTOR_PRIORITY)
+        servo_pca9685 = self.i2c.channel(self.servo_board, SERVO_PRIORITY)
+        led_pca9685 = self.i2c.channel(self.servo_board, LED_PRIORITY)
+
+        # Time spent writing to the motor board during the last update
+        self.i2c_time = 0
+        self.i2c_log = FrameLog(logging.getLogger('__main__'))
 
         motors = [
             # Motors
@@ -35,41 +55,50 @@ class Robot(object):
             MotorComponent(pca9685=motor_pca9685, pca9685_channel=3, dir_pin=31, reverse=True), # Back Left
         ]
 
+        # Moves all of the servos on one thread
+        self.servo_scheduler = ServoScheduler(period=SERVO_PERIOD)
+
         self.output_components = [
             # Servos
             ServoComponent(pca9685=servo_pca9685, pca9685_channel=SERVO_0_CHANNEL, modifier=SERVO_0_MODIFIER, max_pwm=SERVO_0_MAX_PWM,
                             min_pwm=SERVO_0_MIN_PWM, presets=SERVO_0_PRESETS, control_speed=SERVO_0_CONTROL_SPEED, servo_speed=SERVO_0_SPEED, 
-                            reverse=False),
+                            reverse=False, scheduler=self.servo_scheduler),
             ServoComponent(pca9685=servo_pca9685, pca9685_channel=SERVO_1_CHANNEL, modifier=SERVO_1_MODIFIER, max_pwm=SERVO_1_MAX_PWM,
                             min_pwm=SERVO_1_MIN_PWM, presets=SERVO_1_PRESETS, control_speed=SERVO_1_CONTROL_SPEED, servo_speed=SERVO_1_SPEED, 
-                            reverse=False),
+                            reverse=False, scheduler=self.servo_scheduler),
             ServoComponent(pca9685=servo_pca9685, pca9685_channel=SERVO_2_CHANNEL, modifier=SERVO_2_MODIFIER, max_pwm=SERVO_2_MAX_PWM,
                             min_pwm=SERVO_2_MIN_PWM, presets=SERVO_2_PRESETS, control_speed=SERVO_2_CONTROL_SPEED, servo_speed=SERVO_2_SPEED, 
-                            reverse=False),
+                            reverse=False, scheduler=self.servo_scheduler),
 
             # Motors
             MotorController(fwd_axis=MOTOR_FORWARD_AXIS, back_axis=MOTOR_BACKWARD_AXIS, steer_axis=MOTOR_STEER_AXIS,
                                     steer_speed=MOTOR_STEER_SPEED, motors=motors, min_pwm=MOTOR_MIN_PWM, reverse=True),
 
             # LED
-            LEDComponent(pca9685=servo_pca9685, pca9685_channel=LED_CHANNEL, button=LED_BUTTON, value=LED_VALUE),
+            LEDComponent(pca9685=led_pca9685, pca9685_channel=LED_CHANNEL, button=LED_BUTTON, value=LED_VALUE),
         ]
 
         # check output components
         for output in self.output_components:
             assert isinstance(output, OutputComponent)
 
+        # Components that react to inputs changing
+        self.edge_keys = set(key for output in self.output_components for key in output.edge_keys)
+
+        # Only update the components whose inputs changed
+        self.router = OutputRouter(self.output_components)
+
         # Commented out sensors for debug, we removed the actual sensors / pcb from the bot
         
         self.input_components = [
-        #   SensorComponent(SENSOR_0_NAME, SENSOR_0_CHANNEL, SENSOR_0_COEFFICIENTS),
-        #   SensorComponent(SENSOR_1_NAME, SENSOR_1_CHANNEL, SENSOR_1_COEFFICIENTS),
-        #   SensorComponent(SENSOR_2_NAME, SENSOR_2_CHANNEL, SENSOR_2_COEFFICIENTS),
-        #   SensorComponent(SENSOR_3_NAME, SENSOR_3_CHANNEL, SENSOR_3_COEFFICIENTS),
-        #   SensorComponent(SENSOR_4_NAME, SENSOR_4_CHANNEL, SENSOR_4_COEFFICIENTS),
-        #   SensorComponent(SENSOR_5_NAME, SENSOR_5_CHANNEL, SENSOR_5_COEFFICIENTS),
-        #   SensorComponent(SENSOR_6_NAME, SENSOR_6_CHANNEL, SENSOR_6_COEFFICIENTS),
-        #   SensorComponent(SENSOR_7_NAME, SENSOR_7_CHANNEL, SENSOR_7_COEFFICIENTS),
+        #   SensorComponent(SENSOR_0_NAME, SENSOR_0_CHANNEL, SENSOR_0_COEFFICIENTS, SENSOR_TABLE_CACHE_DIR),
+        #   SensorComponent(SENSOR_1_NAME, SENSOR_1_CHANNEL, SENSOR_1_COEFFICIENTS, SENSOR_TABLE_CACHE_DIR),
+        #   SensorComponent(SENSOR_2_NAME, SENSOR_2_CHANNEL, SENSOR_2_COEFFICIENTS, SENSOR_TABLE_CACHE_DIR),
+        #   SensorComponent(SENSOR_3_NAME, SENSOR_3_CHANNEL, SENSOR_3_COEFFICIENTS, SENSOR_TABLE_CACHE_DIR),
+        #   SensorComponent(SENSOR_4_NAME, SENSOR_4_CHANNEL, SENSOR_4_COEFFICIENTS, SENSOR_TABLE_CACHE_DIR),
+        #   SensorComponent(SENSOR_5_NAME, SENSOR_5_CHANNEL, SENSOR_5_COEFFICIENTS, SENSOR_TABLE_CACHE_DIR),
+        #   SensorComponent(SENSOR_6_NAME, SENSOR_6_CHANNEL, SENSOR_6_COEFFICIENTS, SENSOR_TABLE_CACHE_DIR),
+        #   SensorComponent(SENSOR_7_NAME, SENSOR_7_CHANNEL, SENSOR_7_COEFFICIENTS, SENSOR_TABLE_CACHE_DIR),
         ]
         
 
@@ -77,39 +106,132 @@ class Robot(object):
         for input_ in self.input_components:
             assert isinstance(input_, InputComponent)
 
+        # Sensors are all read from the adc at once, on their own thread
+        self.sensors = [input_ for input_ in self.input_components if isinstance(input_, SensorComponent)]
+        self.other_inputs = [input_ for input_ in self.input_components if not isinstance(input_, SensorComponent)]
+
+        self.sampler = None
+        if self.sensors:
+            self.sampler = SensorSampler(self.sensors, rate=SENSOR_SAMPLE_RATE, size=SENSOR_BUFFER_SIZE)
+            self.sampler.start()
+
+        # Time each input takes to produce (ms)
+        self.input_names = dict(zip(self.other_inputs, component_names(self.other_inputs)))
+        self.input_timings = StageTimings(['sensors'] + list(self.input_names.values()))
+
+    def _connect_board(self, name, board, address, freq_hz):
+        ''' Connect to a pca9685 board and set its frequency, on a setup thread '''
+        try:
+            board.connect(open_pca9685(address), freq_hz)
+        except Exception as e:
+            logging.getLogger('__main__').error('Could not set up the {0}: {1}'.format(name, e))
+            raise
+        self.i2c.board_connected()
+        startup.mark(name)
+
+    async def ready(self):
+        ''' Wait until both boards are set up '''
+        await self.motors_ready
+        await self.servos_ready
+
+    async def boards_ready(self):
+        ''' Wait for the motor board to be set up, not the servo board.
+            Raises the error of either board that could not be, so frames
+            are never applied to a board that will never write them
+        '''
+        await self.motors_ready
+        if self.servos_ready.done():
+            self.servos_ready.result()
+
     async def produce(self):
         ''' Wait for the sensors to read back a distance '''
 
-        tasks = [asyncio.ensure_future(input_.produce()) for input_ in self.input_components]
-
-        # Wait for all sensors to return data with async
-        done, pending = await asyncio.wait(tasks)
-
         # Package all results into a dictionary
         data_dict = {}
 
-        for task in done:
-            key, value = task.result()
-            data_dict[key] = value
+        # The sensors are already read
+        if self.sampler:
+            start = time.perf_counter()
+            self.sampler.start()
+            if SENSOR_FILTER == 'median':
+                data_dict.update(self.sampler.filtered())
+            else:
+                data_dict.update(self.sampler.latest())
+            self.input_timings.record('sensors', (time.perf_counter() - start) * 1000)
+
+        if self.other_inputs:
+            tasks = [asyncio.ensure_future(self._timed_produce(input_)) for input_ in self.other_inputs]
+
+            # Wait for all other inputs to return data with async
+            done, pending = await asyncio.wait(tasks)
+
+            for task in done:
+                key, value = task.result()
+                data_dict[key] = value
 
         # return the dictionary
         return data_dict
 
+    async def _timed_produce(self, input_):
+        start = time.perf_counter()
+        result = await input_.produce()
+        self.input_timings.record(self.input_names[input_], (time.perf_counter() - start) * 1000)
+        return result
+
+    def performance(self):
+        ''' Return the [median, 99th percentile, max] time (ms) each component took to update or produce '''
+        summary = self.router.timings.compact()
+        summary.update(self.input_timings.compact())
+        return summary
+
     def stop(self):
         ''' Stop the Robot's components '''
 
         for output in self.output_components:
             output.stop()
 
+        # Update everything with the first frame after a stop
+        self.router.reset()
+
+        self.servo_scheduler.stop()
+
+        # Make sure the stop has reached the boards, without waiting forever on a stuck bus
+        if not self.i2c.flush(I2C_WRITE_TIMEOUT):
+            logging.getLogger('__main__').warn('The stop was not written to the boards within {} sec'.format(I2C_WRITE_TIMEOUT))
+
+        logging.getLogger('__main__').info('Motor board: {0}, servo board: {1}, I2C: {2}, router: {3}'.format(
+            self.motor_board.stats(), self.servo_board.stats(), self.i2c.stats(), self.router.stats()))
+
         for input_ in self.input_components:
             input_.stop()
 
+        if self.sampler:
+            self.sampler.stop()
+            logging.getLogger('__main__').info('Sensor sampler: {}'.format(self.sampler.stats()))
+
     async def update(self, data_dict):
-        ''' Update all the robots components with the data dictionary '''
-        tasks = []
+        ''' Update the robots components affected by the data dictionary '''
 
-        for output in self.output_components:
-            tasks.append(asyncio.ensure_future(output.update(data_dict)))
+        await self.boards_ready()
+
+        # Restart the servos if the robot was stopped
+        self.servo_scheduler.start()
+        write_time = self.motor_board.write_time
+
+        await self.router.update(data_dict)
+
+        # Wait for the motors to be written
+        try:
+            await asyncio.wait_for(self.i2c.written(MOTOR_PRIORITY), I2C_WRITE_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.i2c_log('The motors were not written within %s sec', I2C_WRITE_TIMEOUT)
+        self.i2c_time = self.motor_board.write_time - write_time
+
+    async def update_edges(self, data_dict):
+        ''' Update the components affected by a frame that was skipped over
+            because it changed an edge triggered input
+        '''
+        await self.boards_ready()
 
-        await asyncio.gather(*tasks)
+        await self.router.update_edges(data_dict)
 
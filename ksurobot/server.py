@@ -3,11 +3,24 @@
     This is the server to be ran on the pi
 '''
 import asyncio
-import pickle
 import logging
-import subprocess
 import time
 import websockets
+from collections import namedtuple
+
+import startup
+from logs import FrameLog
+from metrics import LoopMonitor, StageTimings, compact
+from protocol import ACK_STAGES, BinaryCodec, get_codec, session_token, subprotocols
+from recording import SessionRecorder
+from settings import (CONNECTION_CODECS, LATENCY_LOG_INTERVAL, LOOP_MONITOR_INTERVAL, SERVER_REBOOT_AFTER,
+                      SERVER_REBOOT_COMMAND, SERVER_RECORD_DIR, SERVER_SESSION_TIMEOUT, STATS_INTERVAL)
+from streams import CONTROL, STATS, TELEMETRY, StreamSender
+from watchdog import Watchdog
+
+
+# A controller frame and when it was received and how long it took to decode (ms)
+Frame = namedtuple('Frame', ['data', 'sequence', 'timestamp', 'received', 'decode_time'])
 
 
 class TextColors:
@@ -20,27 +33,137 @@ class TextColors:
     BOLD = '\033[1m'	# Bold text to amplify textclass textColors
 
 
+class FrameCoalescer(object):
+    ''' Holds the newest controller frame until the robot is ready for it,
+        so the robot never works through a backlog of old frames.
+
+        Frames replaced before being applied are skipped, except the ones where
+        an edge triggered input (one of edge_keys) changed on the next frame.
+        Those are kept so the components watching those inputs still see every press and release.
+    '''
+
+    def __init__(self, edge_keys=()):
+        self.edge_keys = tuple(edge_keys)
+        self._latest = None
+        self._edges = []
+        self._ready = asyncio.Event()
+        self._idle = asyncio.Event()
+
+        self.received = 0
+        self.applied = 0
+        self.skipped = 0
+
+    def put(self, frame):
+        ''' Replace the frame waiting to be applied '''
+        self.received += 1
+
+        latest = self._latest
+        if latest is not None:
+            self.skipped += 1
+            if any(frame.data[key] != latest.data[key] for key in self.edge_keys):
+                self._edges.append(latest)
+
+        self._latest = frame
+        self._idle.clear()
+        self._ready.set()
+
+    async def get(self):
+        ''' Wait for a frame, return the skipped frames edge triggered inputs need and the newest frame '''
+        if self._latest is None:
+            # Everything put has been applied
+            self._idle.set()
+        await self._ready.wait()
+        self._ready.clear()
+        self._idle.clear()
+
+        edges, frame = self._edges, self._latest
+        self._edges, self._latest = [], None
+        self.applied += 1
+        return edges, frame
+
+    async def wait_idle(self):
+        ''' Wait until every frame put has been applied, and the next one is being waited for '''
+        await self._idle.wait()
+
+
+class Session(object):
+    ''' What the server keeps of a client between its connections. A client that
+        reconnects with the same token within SERVER_SESSION_TIMEOUT carries on
+        with the same frames and robot, without the robot being stopped
+    '''
+
+    def __init__(self, token, coalescer, recorder=None):
+        self.token = token          # None for clients that don't send one, their session ends with the connection
+        self.coalescer = coalescer
+        self.recorder = recorder
+        self.ws = None              # The connection the client is using
+        self.tasks = []             # Tasks handling that connection
+        self.expiry = None          # Ends the session, while waiting for the client to reconnect
+        self.resumes = 0
+
+
+class ControlDatagramProtocol(asyncio.DatagramProtocol):
+    ''' Hands controller frames sent over UDP to the server '''
+
+    def __init__(self, server):
+        self.server = server
+
+    def datagram_received(self, data, addr):
+        self.server.datagram_received(data, addr)
+
+
 class Server(object):
     ''' Defines a server object to handle connections '''
 
-    def __init__(self, ip, port, robot, timeout=1):
-        ''' Construct a server with an ip on a port '''
+    def __init__(self, ip, port, robot, timeout=1, udp_port=None, record_dir=SERVER_RECORD_DIR):
+        ''' Construct a server with an ip on a port,
+            and optionally receive controller frames over UDP on udp_port.
+            The frames of each connection are recorded to record_dir, unless it is None
+        '''
 
         self._active_connections = set()
+        self._datagram_peers = {}
+        self._sessions = {}  # token -> Session
         self.ip = ip
         self.port = port
+        self.udp_port = udp_port
+        self.datagram_transport = None
         self.logger = logging.getLogger('__main__')
+        self.receive_log = FrameLog(self.logger)
+        self.send_log = FrameLog(self.logger)
         self.server = None
         self.robot = robot
-        self._time_of_last_recv = time.time()
         self.timeout = timeout
-        self.active = True
+        self.record_dir = record_dir
+        self.skipped_frames = 0
+        self.resumed_sessions = 0
+        self.started = False # Applied a controller frame yet
+
+        # One for the whole robot, fed by every controller frame
+        self.watchdog = Watchdog(timeout, self.stop, self.close_connections,
+                                 reboot_after=SERVER_REBOOT_AFTER, reboot_command=SERVER_REBOOT_COMMAND)
+
+        # How long each stage of applying controller frames takes
+        self.latency = StageTimings(ACK_STAGES)
+        self._last_latency_log = time.monotonic()
+
+        # How late the event loop gets to things
+        self.loop_monitor = LoopMonitor(LOOP_MONITOR_INTERVAL)
 
     async def start_server(self):
         ''' Start the server on the defined ip and port '''
+        self.loop_monitor.start()
 
         self.logger.info('Server starting up at {0}:{1}'.format(self.ip, self.port))
-        self.server = await websockets.serve(self.handle_new_connection, self.ip, self.port, timeout=1)
+        self.server = await websockets.serve(self.handle_new_connection, self.ip, self.port, timeout=1,
+                                             subprotocols=subprotocols(CONNECTION_CODECS))
+
+        if self.udp_port:
+            self.logger.info('Receiving controller frames over UDP at {0}:{1}'.format(self.ip, self.udp_port))
+            self.datagram_transport, _ = await asyncio.get_event_loop().create_datagram_endpoint(
+                lambda: ControlDatagramProtocol(self), local_addr=(self.ip, self.udp_port))
+
+        startup.mark('listening')
 
     async def handle_new_connection(self, ws, path):
         ''' Handle a new incoming connection to the server '''
@@ -50,20 +173,55 @@ class Server(object):
         # Add the connection to the set
         self._active_connections.add(ws)
 
+        # Use the message format agreed on when connecting
+        codec = get_codec(ws.subprotocol)
+        self.logger.info('Using {} messages'.format(codec.name))
+
+        # Carry on with a client that lost its connection, or start a new session
+        token = session_token(path)
+        session = self._sessions.get(token) if token else None
+        if session:
+            self.resume_session(session)
+        else:
+            session = self.new_session(token)
+        session.ws = ws
+
+        # Accept controller frames over UDP from the same host, never pickles
+        host = ws.remote_address[0]
+        if isinstance(codec, BinaryCodec):
+            self._datagram_peers[host] = datagram_peer = (BinaryCodec(), session.coalescer, session.recorder)
+
+        # Acks, stats and telemetry are sent by one writer, in that order of priority
+        streams = StreamSender(ws)
+
         # Create tasks to run in the event loop
+        tasks = []
         try:
-            consumer_task = asyncio.ensure_future(self.consumer_handler(ws))
-            producer_task = asyncio.ensure_future(self.producer_handler(ws))
-            watchdog_task = asyncio.ensure_future(self.watchdog())
+            consumer_task = asyncio.ensure_future(self.consumer_handler(ws, codec, session.coalescer, session.recorder))
+            apply_task = asyncio.ensure_future(self.apply_handler(streams, codec, session.coalescer))
+            producer_task = asyncio.ensure_future(self.producer_handler(streams, codec))
+            sender_task = asyncio.ensure_future(streams.run())
+            tasks = session.tasks = [consumer_task, apply_task, producer_task, sender_task]
 
-            await asyncio.wait([consumer_task, producer_task, watchdog_task], return_when=asyncio.FIRST_EXCEPTION)
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
 
         except websockets.ConnectionClosed:
             self.logger.info('Connection already closed')
         finally:
-            # Stop robot
-            self.logger.info('Stopping Robot')
-            self.stop()
+            for task in tasks:
+                task.cancel()
+            self.logger.info('Streams: {}'.format(streams.summary()))
+
+            if session.ws is ws:
+                session.ws = None
+                session.tasks = []
+                if session.token:
+                    # Give the client a moment to reconnect before stopping the robot
+                    session.expiry = asyncio.get_event_loop().call_later(
+                        SERVER_SESSION_TIMEOUT, self.end_session, session)
+                else:
+                    self.end_session(session)
+            # Otherwise the client already reconnected, and carries on on the new connection
 
             # Close Connection
             if ws.open:
@@ -72,60 +230,236 @@ class Server(object):
 
             # Remove connection
             self._active_connections.remove(ws)
+            if isinstance(codec, BinaryCodec) and self._datagram_peers.get(host) is datagram_peer:
+                del self._datagram_peers[host]
             self.logger.info('Connection removed: {}'.format(ws.remote_address))
 
-    async def consumer_handler(self, ws):
+            # No frames are expected until someone connects again
+            self._disarm_if_idle()
+
+    def new_session(self, token=None):
+        ''' Start keeping what is needed to carry on with a client, remembered by token if it has one '''
+
+        # Frames wait here between being received and applied
+        coalescer = FrameCoalescer(self.robot.edge_keys if self.robot else ())
+
+        # Keep every frame received, to replay later
+        recorder = None
+        if self.record_dir:
+            try:
+                recorder = SessionRecorder.in_directory(self.record_dir)
+                self.logger.info('Recording controller frames to {}'.format(recorder.path))
+            except OSError as e:
+                self.logger.warn('Could not start recording: {}'.format(e))
+
+        session = Session(token, coalescer, recorder)
+        if token:
+            self._sessions[token] = session
+        return session
+
+    def resume_session(self, session):
+        ''' Carry on with a client that reconnected, without stopping the robot '''
+        if session.expiry:
+            session.expiry.cancel()
+            session.expiry = None
+
+        # The old connection may not have noticed it is gone yet
+        for task in session.tasks:
+            task.cancel()
+        session.tasks = []
+
+        session.resumes += 1
+        self.resumed_sessions += 1
+        self.logger.info('Resuming session {0}, reconnect {1}'.format(session.token, session.resumes))
+
+    def end_session(self, session):
+        ''' The client is gone, stop the robot '''
+        session.expiry = None
+        if session.token:
+            self._sessions.pop(session.token, None)
+
+        # Stop robot
+        self.logger.info('Stopping Robot')
+        self.stop()
+        coalescer = session.coalescer
+        self.logger.info('Applied {0} of {1} frames, skipped {2} behind newer ones'.format(
+            coalescer.applied, coalescer.received, coalescer.skipped))
+        self.skipped_frames += coalescer.skipped
+
+        if session.recorder:
+            session.recorder.close()
+            self.logger.info('Recorded {0} frames to {1}'.format(session.recorder.frames, session.recorder.path))
+
+        self._disarm_if_idle()
+
+    def _disarm_if_idle(self):
+        ''' Stop the watchdog once no client is connected or expected back '''
+        if not self._active_connections and not any(session.expiry for session in self._sessions.values()):
+            self.watchdog.disarm()
+
+    async def consumer_handler(self, ws, codec, coalescer, recorder=None):
         ''' Waits for a message from the client and
-            passes that message to the robot, if it exsits
+            passes that message on to be applied to the robot,
+            recording it if given a recorder
         '''
         while True:
             # Receive the message
-            pickled_message = await ws.recv()
+            packed_message = await ws.recv()
+
+            # Unpack the message
+            frame = self.read_frame(codec, packed_message)
 
-            # Use pickle to load the message
-            message = pickle.loads(pickled_message)
+            if frame is None:
+                # The frame only had changes to a frame we never got
+                continue
 
-            # Feed the watch dog
-            self._time_of_last_recv = time.time()
-            self.logger.info('Recieved: {}'.format(message))
+            if recorder:
+                recorder.record(frame.data)
+            coalescer.put(frame)
 
-            # Update the robot if it exsits
+    async def apply_handler(self, streams, codec, coalescer):
+        ''' Applies the newest frame to the robot whenever it is ready for one '''
+        while True:
+            edges, frame = await coalescer.get()
+
+            # Let edge triggered inputs see the presses and releases in skipped frames
             if self.robot:
-                await self.robot.update(message)
+                for edge in edges:
+                    await self.robot.update_edges(edge.data)
+
+            await self.apply(frame, streams, codec)
+
+    def datagram_received(self, data, addr):
+        ''' Pass a controller frame received over UDP to the robot,
+            dropping frames from unknown hosts or that arrived out of order
+        '''
+        peer = self._datagram_peers.get(addr[0])
+        if peer is None:
+            return
+        datagram_codec, coalescer, recorder = peer
+
+        try:
+            frame = self.read_frame(datagram_codec, data)
+        except ValueError as e:
+            self.logger.info('Bad datagram from {0}: {1}'.format(addr, e))
+            return
+
+        if frame is not None:
+            if recorder:
+                recorder.record(frame.data)
+            coalescer.put(frame)
+
+    def read_frame(self, codec, packed_message):
+        ''' Unpack a controller frame and feed the watchdog,
+            return None if the frame can't be used
+        '''
+        received = time.perf_counter()
+        message = codec.decode_controller(packed_message)
+        decoded = time.perf_counter()
 
-    async def producer_handler(self, ws):
+        # Feed the watch dog
+        self.watchdog.feed()
+
+        if message is None:
+            return None
+        return Frame(message, codec.received_sequence, codec.received_timestamp, received, (decoded - received) * 1000)
+
+    async def apply(self, frame, streams, codec):
+        ''' Pass a controller frame to the robot, if it exsits,
+            then ack it with how long each stage took on the control stream
+        '''
+        self.receive_log('Recieved: %s', frame.data)
+
+        # Update the robot if it exsits
+        dispatch_start = time.perf_counter()
+        if self.robot:
+            await self.robot.update(frame.data)
+        done = time.perf_counter()
+
+        if not self.started:
+            self.started = True
+            startup.mark('first frame')
+            self.logger.info('Startup: {}'.format(startup.summary()))
+
+        stages = {
+            'decode': frame.decode_time,
+            'dispatch': (done - dispatch_start) * 1000,
+            'i2c': self.robot.i2c_time * 1000 if self.robot else 0,
+            'robot': (done - frame.received) * 1000,
+        }
+        for stage in ACK_STAGES:
+            self.latency.record(stage, stages[stage])
+        self.log_latency()
+
+        if frame.sequence is not None:
+            ack = codec.encode_ack(frame.sequence, frame.timestamp, stages)
+            if ack:
+                streams.send(CONTROL, ack)
+
+    def log_latency(self):
+        ''' Log the latency of controller frames every LATENCY_LOG_INTERVAL '''
+        if time.monotonic() - self._last_latency_log >= LATENCY_LOG_INTERVAL:
+            self._last_latency_log = time.monotonic()
+            self.logger.info('Frame latency: {}'.format(self.latency.format()))
+
+    def latency_summary(self):
+        ''' Return the count, p50, p99 and max time (ms) of each stage of applying controller frames '''
+        return self.latency.summary()
+
+    def stats(self):
+        ''' Return the [median, 99th percentile, max] loop lag and time of each stage (ms), to send to the client '''
+        stats = {'loop_lag': compact(self.loop_monitor.lag)}
+        stats.update(self.latency.compact())
+        if self.robot:
+            stats.update(self.robot.performance())
+        return stats
+
+    async def producer_handler(self, streams, codec):
         ''' Waits for the robot to produce a message
-            and then sends that message to the client
+            and then queues that message for the client on the telemetry stream
         '''
+        last_stats = time.monotonic()
         while True:
+            # Send how the robot and the streams are keeping up every STATS_INTERVAL
+            if STATS_INTERVAL is not None and time.monotonic() - last_stats >= STATS_INTERVAL:
+                last_stats = time.monotonic()
+                stats = self.stats()
+                stats['streams'] = streams.compact()
+                packed_stats = codec.encode_stats(stats)
+                if packed_stats:
+                    streams.send(STATS, packed_stats)
+
             # Get the message from the robot, if it exsits
             if self.robot:
                 message = await self.robot.produce()
 
-                self.logger.info("Sending: {}".format(message))
+                self.send_log('Sending: %s', message)
 
-                # Use pickle to package the message
-                pickled_message = pickle.dumps(message)
+                # Package the message
+                packed_message = codec.encode_telemetry(message)
 
-                # Send the message
-                await ws.send(pickled_message)
+                # Send the message, replacing any older one still waiting
+                streams.send(TELEMETRY, packed_message)
             await asyncio.sleep(.1)
 
-    async def watchdog(self):
-        ''' Make sure that the server still has connection,
-            if not, stop the robot and shutdown the server '''
-        await asyncio.sleep(5)
-        while self.active:
-            await asyncio.sleep(0.1)
-            if time.time() - self._time_of_last_recv > self.timeout:
-                self.logger.info('Watchdog was not fed, stopping robot and shuting down server')
-                self.stop()
-                await self.shutdown()
-                subprocess.run(['sudo','reboot'])
+    async def close_connections(self):
+        ''' Close every connection, so the clients reconnect '''
+        for ws in list(self._active_connections):
+            if ws.open:
+                await ws.close()
 
     async def shutdown(self):
         ''' Shutdown the server if it exsits '''
-        self.active = False
+        self.watchdog.shutdown()
+        self.logger.info('Watchdog: {}'.format(self.watchdog.stats()))
+        self.loop_monitor.stop()
+        self.logger.info('Loop lag: {}'.format(self.loop_monitor.lag.summary()))
+        for session in list(self._sessions.values()):
+            if session.expiry:
+                session.expiry.cancel()
+                self.end_session(session)
+        if self.datagram_transport:
+            self.datagram_transport.close()
         if self.server:
             self.server.close()
             await self.server.wait_closed()
@@ -145,6 +479,8 @@ def test_server():
     logging.basicConfig(format='%(asctime)s %(message)s', level=logging.DEBUG)
     logger = logging.getLogger(__name__)
 
+    loop = asyncio.get_event_loop()
+
     # Create server object
     server = Server(ip, port, None)
 
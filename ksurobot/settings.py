@@ -3,27 +3,113 @@
     Define the settings to use for the robot and it's components
 '''
 
-try:
-    import RPi.GPIO as io
-except RuntimeError:
-    io = None
-except ImportError:
-    io = None
+import os
 
 
+##############################################################
+
+# Hardware settings
+HARDWARE_BACKEND = os.environ.get('KSURCT_HARDWARE', 'real')
+# 'real' to use the pi's GPIO, SPI and I2C, 'sim' to simulate them so the robot can run anywhere
+SIM_I2C_BUS_HZ = 100000
+# Clock speed of the simulated I2C bus, writes take as long as they would at this speed
+SIM_TRANSACTION_LATENCY = 0.0001
+# Extra time every simulated I2C or SPI transaction takes (sec)
+SIM_SENSOR_NOISE = 8
+# Standard deviation of the noise added to simulated ADC readings
+SIM_SENSOR_PERIOD = 10
+# Time for a simulated sensor to sweep across its range and back (sec)
+SIM_TRACE_SIZE = 100000
+# How many of the last simulated PWM and GPIO writes to keep
+
+##############################################################
+
+# Logging settings
+COMPETITION_MODE = os.environ.get('KSURCT_COMPETITION', '') == '1'
+# True turns off logging every frame, set KSURCT_COMPETITION=1 to turn it on
+LOG_FRAME_INTERVAL = 1
+# Most often to log messages made for every frame, like the controller data (sec)
+LOG_FORMAT = '%(name)s: %(levelname)s: %(asctime)s: %(message)s'
+
 ##############################################################
 
 # Server Setings
 SERVER_IP = '10.131.209.188'
 SERVER_PORT = 8055
+SERVER_UDP_PORT = 8056
+# Port to receive controller data over UDP on, None to only use the websocket
 SERVER_TIMEOUT = 1
-# Will shut down server after not reciving a command for this long (sec)
+# Stops the robot and closes the connection after not reciving a command for this long (sec)
+SERVER_REBOOT_AFTER = None
+# After that, reboot if nothing reconnects for this long (sec), None to never reboot
+SERVER_REBOOT_COMMAND = ['sudo', 'reboot']
+SERVER_SESSION_TIMEOUT = 0.5
+# How long to keep the robot going after a client's connection drops, for it to reconnect
+# and carry on where it left off (sec). The robot is stopped after that
+
+# Message formats to offer when connecting, in order of preference.
+# Pickle is always used if the other side doesn't agree on one of these.
+CONNECTION_CODECS = ['binary']
+
+# Send every field of the controller data at least once every this many frames,
+# in between only the fields that changed are sent
+KEYFRAME_INTERVAL = 20
+
+LATENCY_LOG_INTERVAL = 10
+# Time between logging the latency of controller frames (sec)
+
+STATS_INTERVAL = 1
+# Time between sending the robot's loop lag and stage timings to the client (sec). None to not send them
+
+LOOP_MONITOR_INTERVAL = 0.05
+# How often to check how late the event loop is running (sec)
+
+SERVER_CONTROL_BACKLOG = 100
+# Acks to hold for the client while the link is busy, the oldest are dropped past this.
+# They are always sent before telemetry
+SERVER_TELEMETRY_BACKLOG = 1
+# Telemetry and stats messages to hold while the link is busy, the oldest are dropped for newer ones
+
+SERVER_RECORD_DIR = None
+# Where to record the controller frames of every connection, for replay.py, e.g.
+# os.path.join(os.path.dirname(os.path.abspath(__file__)), 'recordings'). None to not record them
+
+##############################################################
+
+# Client settings
+CLIENT_CONTROL_TRANSPORT = 'websocket'
+# 'udp' sends the controller data to SERVER_UDP_PORT instead of over the websocket,
+# only used with the binary message format
+CLIENT_SEND_MODE = 'event'
+# 'poll' sends the controller data every CLIENT_SEND_INTERVAL,
+# 'event' sends it as soon as it changes
+CLIENT_SEND_INTERVAL = 0.1
+CLIENT_MAX_SEND_RATE = 50
+# Most frames a second to send in event mode
+CLIENT_HEARTBEAT_INTERVAL = 0.25
+# Time between frames when nothing changes in event mode (sec), keep this under SERVER_TIMEOUT
+CLIENT_INPUT_TIMEOUT = 0.1
+# Longest the input thread waits for a controller event before checking if it should stop (sec)
+CLIENT_REPEAT_KEYS = ['up', 'down', 'r_stick_y']
+# Inputs the robot acts on every frame while they are held (servo fine control),
+# these are still sent every CLIENT_SEND_INTERVAL in event mode
+CLIENT_RECORD_DIR = None
+# Where to record the controller frames sent, for replay.py. None to not record them
+CLIENT_CONNECT_TIMEOUT = 1
+# Longest to wait for a connection attempt to the server (sec)
+CLIENT_RECONNECT_MIN_DELAY = 0.05
+CLIENT_RECONNECT_MAX_DELAY = 2
+# Time between starting connection attempts, doubling after each one that fails (sec)
+CLIENT_CONNECT_ATTEMPTS = 2
+# Most TCP connection attempts to have going at once, a new one is started while a slow one waits
 
 ##############################################################
 
 # Servo settings
 SERVO_I2C_ADDRESS = 0x60
 SERVO_PWM_FREQ = 60
+SERVO_PERIOD = 0.02
+# Time between each step the servos take towards their targets (sec)
 
 # Servo 0 settings (Brontosaurus neck)
 SERVO_0_CHANNEL = 0
@@ -63,11 +149,14 @@ MOTOR_STEER_AXIS = 'l_stick_x'
 MOTOR_STEER_SPEED = 1000
 MOTOR_MIN_PWM = 750
 
+I2C_WRITE_TIMEOUT = 0.1
+# Longest to wait for writes to the boards to be made (sec). The robot carries on without them and logs it
+
 ##############################################################
 
 # GPIO settings
-if io:
-    GPIO_MODE = io.BOARD
+GPIO_MODE = 'BOARD'
+# Pin numbering of the GPIO, the name of the mode in RPi.GPIO
 
 # LED settings
 LED_CHANNEL = 3
@@ -78,6 +167,15 @@ LED_VALUE = 4095
 
 SPI_DEVICE = 1
 
+SENSOR_TABLE_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sensor_data', 'cache')
+# Where to save the sensor distance tables so they don't need to be built on every start, None to not save them
+SENSOR_SAMPLE_RATE = 50
+# How many times a second to read the sensors
+SENSOR_BUFFER_SIZE = 5
+# How many readings of each sensor to keep
+SENSOR_FILTER = 'median'
+# 'median' sends the median of the readings kept, 'latest' sends the newest
+
 ##############################################################
 
 # Sensor 0 settings
@@ -0,0 +1,271 @@
+''' simulation.py
+
+    Simulated GPIO, SPI and PCA9685 boards, so the robot can run without a pi.
+    Selected with HARDWARE_BACKEND = 'sim' (or KSURCT_HARDWARE=sim)
+'''
+
+import math
+import os
+import random
+import threading
+import time
+from collections import deque
+
+import settings
+from settings import *
+
+
+SENSOR_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sensor_data')
+
+# The adc's channel select bits for each channel
+MAX192AEPP_COMMAND_TO_CHANNEL = [0, 2, 4, 6, 1, 3, 5, 7]
+
+
+def load_sensor_curve(path):
+    ''' Read (distance, reading) pairs from a calibration file, sorted by distance '''
+    curve = []
+    with open(path) as f:
+        next(f) # Header
+        for line in f:
+            if line.strip():
+                distance, reading = line.split(',')
+                curve.append((float(distance), float(reading)))
+    curve.sort()
+    return curve
+
+
+def interpolate(curve, distance):
+    ''' The reading at distance, along straight lines between the points of the curve '''
+    if distance <= curve[0][0]:
+        return curve[0][1]
+    for (d0, r0), (d1, r1) in zip(curve, curve[1:]):
+        if distance <= d1:
+            return r0 + (r1 - r0) * (distance - d0) / (d1 - d0)
+    return curve[-1][1]
+
+
+class SimGPIO(object):
+    ''' Stands in for RPi.GPIO, recording every output '''
+
+    BOARD = 10
+    BCM = 11
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+
+    def __init__(self, trace_size=SIM_TRACE_SIZE):
+        self.mode = None
+        self.pins = {}
+        self.writes = deque(maxlen=trace_size) # (time, pin, value)
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setup(self, pin, direction, **kwargs):
+        self.pins.setdefault(pin, 0)
+
+    def output(self, pin, value):
+        self.pins[pin] = int(value)
+        self.writes.append((time.monotonic(), pin, int(value)))
+
+    def input(self, pin):
+        return self.pins.get(pin, 0)
+
+    def cleanup(self, *args):
+        self.pins.clear()
+
+
+class SimSpiDev(object):
+    ''' Stands in for spidev.SpiDev with a MAX192 adc on the other end.
+
+        Each sensor sweeps across the distances in its sensor_data file,
+        and the adc reads back what the sensor measured at that distance, plus noise
+    '''
+
+    def __init__(self, latency=SIM_TRANSACTION_LATENCY, noise=SIM_SENSOR_NOISE, period=SIM_SENSOR_PERIOD, seed=0):
+        self.latency = latency
+        self.noise = noise
+        self.period = period
+        self.max_speed_hz = 500000
+        self.transfers = 0
+
+        self._random = random.Random(seed)
+        self._start = time.monotonic()
+
+        # channel -> curve of the sensor on it
+        self.curves = {}
+        for sensor in range(8):
+            path = os.path.join(SENSOR_DATA_DIR, 'sensor{}.data'.format(sensor))
+            if os.path.exists(path):
+                self.curves[getattr(settings, 'SENSOR_{}_CHANNEL'.format(sensor))] = load_sensor_curve(path)
+
+        # Set a channel to a distance to hold it there instead of sweeping
+        self.distances = {}
+
+    def open(self, bus, device):
+        pass
+
+    def close(self):
+        pass
+
+    def distance(self, channel):
+        ''' Where the thing in front of the sensor on channel is now '''
+        if channel in self.distances:
+            return self.distances[channel]
+
+        curve = self.curves[channel]
+        low, high = curve[0][0], curve[-1][0]
+        phase = 2 * math.pi * (time.monotonic() - self._start) / self.period + channel
+        return low + (high - low) * (1 - math.cos(phase)) / 2
+
+    def reading(self, channel):
+        ''' A conversion of the adc on channel '''
+        if channel not in self.curves:
+            return 0
+        value = interpolate(self.curves[channel], self.distance(channel)) + self._random.gauss(0, self.noise)
+        return min(max(int(value), 0), (1 << 13) - 1)
+
+    def xfer2(self, command):
+        ''' Clock the command out and the adc's response in.
+            A byte with the top bit set starts a conversion, and its result
+            comes back in the two bytes after it
+        '''
+        # Sleep like a real transfer does, letting other threads run
+        time.sleep(self.latency + len(command) * 8 / self.max_speed_hz)
+        self.transfers += 1
+
+        response = [0] * len(command)
+        for i, byte in enumerate(command):
+            if byte & 0x80:
+                code = self.reading(MAX192AEPP_COMMAND_TO_CHANNEL[(byte >> 4) & 7])
+                if i + 1 < len(response):
+                    response[i + 1] = code >> 5
+                if i + 2 < len(response):
+                    response[i + 2] = (code & 31) << 3
+        return response
+
+
+class SimI2CDevice(object):
+    ''' Stands in for an Adafruit_GPIO I2C device: 256 registers,
+        with writes taking as long as they would on the bus
+    '''
+
+    def __init__(self, address, on_write=None, bus_hz=SIM_I2C_BUS_HZ, latency=SIM_TRANSACTION_LATENCY):
+        self.address = address
+        self.registers = [0] * 256
+        self.on_write = on_write
+        self.bus_hz = bus_hz
+        self.latency = latency
+        self.transactions = 0
+        self.busy_time = 0
+        self._lock = threading.Lock()
+
+    def _transfer(self, data_bytes):
+        ''' Wait for the address, register and data bytes to go over the bus, 9 clocks each '''
+        duration = self.latency + (2 + data_bytes) * 9 / self.bus_hz
+        time.sleep(duration)
+        self.transactions += 1
+        self.busy_time += duration
+
+    def write8(self, register, value):
+        self.writeList(register, [value])
+
+    def writeList(self, register, data):
+        with self._lock:
+            self._transfer(len(data))
+            auto_increment = self.registers[0] & 0x20
+            for i, value in enumerate(data):
+                self.registers[(register + i if auto_increment else register) & 0xFF] = value & 0xFF
+            if self.on_write:
+                self.on_write(register, len(data) if auto_increment else 1)
+
+    def readU8(self, register):
+        with self._lock:
+            self._transfer(1)
+            return self.registers[register]
+
+
+class SimPCA9685(object):
+    ''' Stands in for Adafruit_PCA9685.PCA9685, recording the pwm of every channel written.
+        Setting it up and changing its frequency write the same registers and
+        wait for the oscillator as long as the Adafruit library does
+    '''
+
+    MODE1 = 0x00
+    MODE2 = 0x01
+    PRESCALE = 0xFE
+    SLEEP = 0x10
+    ALLCALL = 0x01
+    OUTDRV = 0x04
+    RESTART = 0x80
+    OSCILLATOR_WAIT = 0.005 # sec
+    LED0_ON_L = 0x06
+    ALL_LED_ON_L = 0xFA
+    CHANNELS = 16
+
+    # Every board made, by address
+    boards = {}
+
+    def __init__(self, address=0x40, trace_size=SIM_TRACE_SIZE, **kwargs):
+        self.address = address
+        self.writes = deque(maxlen=trace_size) # (time, channel, on, off)
+        self._device = SimI2CDevice(address, on_write=self._registers_written, **kwargs)
+        self.set_all_pwm(0, 0)
+        self._device.write8(self.MODE2, self.OUTDRV)
+        self._device.write8(self.MODE1, self.ALLCALL)
+        time.sleep(self.OSCILLATOR_WAIT)
+        mode1 = self._device.readU8(self.MODE1)
+        self._device.write8(self.MODE1, mode1 & ~self.SLEEP)
+        time.sleep(self.OSCILLATOR_WAIT)
+        SimPCA9685.boards[address] = self
+
+    def set_pwm_freq(self, freq_hz):
+        prescale = int(math.floor(25000000.0 / 4096.0 / float(freq_hz) - 1.0 + 0.5))
+        old_mode = self._device.readU8(self.MODE1)
+        self._device.write8(self.MODE1, (old_mode & 0x7F) | self.SLEEP)
+        self._device.write8(self.PRESCALE, prescale)
+        self._device.write8(self.MODE1, old_mode)
+        time.sleep(self.OSCILLATOR_WAIT)
+        self._device.write8(self.MODE1, old_mode | self.RESTART)
+
+    def set_pwm(self, channel, on, off):
+        ''' Write a channel a register at a time, like the Adafruit library '''
+        register = self.LED0_ON_L + 4 * channel
+        self._device.write8(register, on & 0xFF)
+        self._device.write8(register + 1, on >> 8)
+        self._device.write8(register + 2, off & 0xFF)
+        self._device.write8(register + 3, off >> 8)
+
+    def set_all_pwm(self, on, off):
+        self._device.write8(self.ALL_LED_ON_L, on & 0xFF)
+        self._device.write8(self.ALL_LED_ON_L + 1, on >> 8)
+        self._device.write8(self.ALL_LED_ON_L + 2, off & 0xFF)
+        self._device.write8(self.ALL_LED_ON_L + 3, off >> 8)
+
+    def pwm(self, channel):
+        ''' The (on, off) a channel is set to '''
+        registers = self._device.registers
+        register = self.LED0_ON_L + 4 * channel
+        return (registers[register] | registers[register + 1] << 8,
+                registers[register + 2] | registers[register + 3] << 8)
+
+    def _registers_written(self, register, count):
+        ''' Record the channels whose last register was written, as the board only updates them then '''
+        now = time.monotonic()
+        registers = self._device.registers
+        if register >= self.ALL_LED_ON_L:
+            if register <= self.ALL_LED_ON_L + 3 < register + count:
+                for channel in range(self.CHANNELS):
+                    base = self.LED0_ON_L + 4 * channel
+                    registers[base:base + 4] = registers[self.ALL_LED_ON_L:self.ALL_LED_ON_L + 4]
+                    self.writes.append((now, channel) + self.pwm(channel))
+            return
+
+        for channel in range(self.CHANNELS):
+            last = self.LED0_ON_L + 4 * channel + 3
+            if register <= last < register + count:
+                self.writes.append((now, channel) + self.pwm(channel))
+
+    def stats(self):
+        return {'transactions': self._device.transactions, 'busy_time': self._device.busy_time, 'pwm_writes': len(self.writes)}
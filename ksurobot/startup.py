@@ -0,0 +1,33 @@
+''' startup.py
+
+    Time each phase of starting the robot, to find what holds up driving
+    after a reboot. Times are from when this module is first imported,
+    which main.py does before anything else
+'''
+
+import threading
+import time
+
+
+STARTED = time.monotonic()
+
+# (phase, time it finished since STARTED (sec)), in the order they finished
+_phases = []
+_lock = threading.Lock()
+
+
+def mark(phase):
+    ''' Note that a phase has finished, from any thread '''
+    with _lock:
+        _phases.append((phase, time.monotonic() - STARTED))
+
+
+def phases():
+    ''' Return the (phase, time it finished (sec)) of every phase so far '''
+    with _lock:
+        return list(_phases)
+
+
+def summary():
+    ''' Return the phases as a single line for the logs '''
+    return ', '.join('{0} {1:.1f}'.format(phase, finished * 1000) for phase, finished in phases()) + ' (ms since start)'
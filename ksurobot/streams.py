@@ -0,0 +1,119 @@
+''' streams.py
+
+    Send control and telemetry to the client over one connection without one holding up the other.
+
+    Each kind of message goes on its own stream, with a priority. A single writer
+    sends the oldest message of the highest priority stream with any waiting, so acks
+    never wait behind telemetry, and applying frames never waits on a send.
+    While the link is slow, lower priority streams hold only their newest messages,
+    so telemetry is downsampled first.
+'''
+
+import asyncio
+import time
+from collections import deque
+
+from metrics import Histogram, compact
+from settings import SERVER_CONTROL_BACKLOG, SERVER_TELEMETRY_BACKLOG
+
+CONTROL = 'control'       # Acks of controller frames
+STATS = 'stats'           # How the robot is keeping up
+TELEMETRY = 'telemetry'   # Sensor readings
+
+# The name, priority (lowest is sent first) and most messages to hold of each stream
+STREAMS = (
+    (CONTROL, 0, SERVER_CONTROL_BACKLOG),
+    (STATS, 1, SERVER_TELEMETRY_BACKLOG),
+    (TELEMETRY, 2, SERVER_TELEMETRY_BACKLOG),
+)
+
+
+class Stream(object):
+    ''' The messages of one kind waiting to be sent, dropping the oldest past limit '''
+
+    def __init__(self, name, priority, limit):
+        self.name = name
+        self.priority = priority
+        self.limit = limit
+        self._queue = deque()
+
+        self.queued = 0
+        self.sent = 0
+        self.dropped = 0
+        self.bytes = 0
+        self.max_depth = 0
+        self.wait = Histogram()  # From being queued until sent (ms)
+
+    def __len__(self):
+        return len(self._queue)
+
+    def put(self, message):
+        self.queued += 1
+        if len(self._queue) >= self.limit:
+            self._queue.popleft()
+            self.dropped += 1
+        self._queue.append((message, time.perf_counter()))
+        self.max_depth = max(self.max_depth, len(self._queue))
+
+    def pop(self):
+        ''' Return the oldest message and when it was queued '''
+        return self._queue.popleft()
+
+    def sent_message(self, message, queued):
+        self.sent += 1
+        self.bytes += len(message)
+        self.wait.record((time.perf_counter() - queued) * 1000)
+
+
+class StreamSender(object):
+    ''' Sends the messages put on each stream over ws, highest priority first.
+        Run run() as a task for as long as the connection is open
+    '''
+
+    def __init__(self, ws, streams=STREAMS):
+        ''' - ws: the connection to send over
+            - streams: the (name, priority, limit) of each stream
+        '''
+        self.ws = ws
+        self.streams = sorted((Stream(*stream) for stream in streams), key=lambda stream: stream.priority)
+        self._by_name = {stream.name: stream for stream in self.streams}
+        self._waiting = asyncio.Event()
+        self._start = time.monotonic()
+
+    def send(self, name, message):
+        ''' Queue a message on the named stream, without waiting for it to be sent '''
+        self._by_name[name].put(message)
+        self._waiting.set()
+
+    async def run(self):
+        ''' Send the waiting messages until the connection closes '''
+        while True:
+            stream = next((stream for stream in self.streams if stream), None)
+            if stream is None:
+                self._waiting.clear()
+                await self._waiting.wait()
+                continue
+
+            message, queued = stream.pop()
+            await self.ws.send(message)
+            stream.sent_message(message, queued)
+
+    def summary(self):
+        ''' Return how many messages of each stream were sent and dropped, and the bandwidth used '''
+        elapsed = max(time.monotonic() - self._start, 1e-6)
+        return {stream.name: {
+            'queued': stream.queued,
+            'sent': stream.sent,
+            'dropped': stream.dropped,
+            'depth': len(stream),
+            'max_depth': stream.max_depth,
+            'bytes': stream.bytes,
+            'bytes_per_sec': round(stream.bytes / elapsed),
+            'wait': stream.wait.summary(),
+        } for stream in self.streams}
+
+    def compact(self):
+        ''' Return the [depth, dropped, bytes/sec, [median, 99th percentile, max] wait (ms)] of each stream, to send '''
+        elapsed = max(time.monotonic() - self._start, 1e-6)
+        return {stream.name: [len(stream), stream.dropped, round(stream.bytes / elapsed), compact(stream.wait)]
+                for stream in self.streams}
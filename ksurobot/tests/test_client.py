@@ -0,0 +1,92 @@
+''' Tests for the client connecting to the server '''
+
+import asyncio
+import logging
+import socket
+from contextlib import suppress
+
+import pytest
+
+websockets = pytest.importorskip('websockets')
+
+from client import Client
+from protocol import get_codec, session_path, subprotocols
+from settings import CONNECTION_CODECS
+
+
+class Listener(object):
+    ''' A websocket server that remembers the path and subprotocol of each connection '''
+
+    def __init__(self):
+        self.connections = []
+        self.server = None
+
+    async def start(self, port=0):
+        self.server = await websockets.serve(self.handle, '127.0.0.1', port, subprotocols=subprotocols(CONNECTION_CODECS))
+        return self.server.sockets[0].getsockname()[1]
+
+    async def handle(self, ws, path):
+        self.connections.append((path, ws.subprotocol))
+        with suppress(websockets.ConnectionClosed):
+            while True:
+                await ws.recv()
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+    asyncio.set_event_loop(asyncio.new_event_loop())
+
+
+def test_client_connects_with_its_session(loop):
+    listener = Listener()
+    port = loop.run_until_complete(listener.start())
+    client = Client('127.0.0.1', port, controller_input=object(), transport='websocket')
+
+    async def connect_twice():
+        for _ in range(2):
+            await client.connect()
+            await client.ws.close()
+
+    try:
+        loop.run_until_complete(asyncio.wait_for(connect_twice(), 5))
+    finally:
+        loop.run_until_complete(listener.stop())
+
+    # Both connections carry on the same session, with the best codec both ends know
+    assert client.connections == 2
+    assert [path for path, _ in listener.connections] == [session_path(client.session)] * 2
+    assert client.codec.name == get_codec(listener.connections[-1][1]).name
+
+
+def test_client_logs_failed_connection_attempts(loop, caplog):
+    # A port nothing is listening on yet
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+
+    listener = Listener()
+    client = Client('127.0.0.1', port, controller_input=object(), transport='websocket')
+
+    async def start_late():
+        await asyncio.sleep(0.2)
+        await listener.start(port)
+
+    caplog.set_level(logging.WARNING, logger='client')
+    try:
+        loop.run_until_complete(asyncio.wait_for(asyncio.gather(client.connect(), start_late()), 5))
+        loop.run_until_complete(client.ws.close())
+    finally:
+        loop.run_until_complete(listener.stop())
+
+    # Logged even in competition mode, where reconnects matter most
+    assert client.connections == 1
+    assert any(record.levelno == logging.WARNING and record.getMessage().startswith('Could not connect')
+               for record in caplog.records)
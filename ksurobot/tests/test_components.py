@@ -0,0 +1,83 @@
+''' Tests for the robot's components '''
+
+import asyncio
+import time
+
+import pytest
+
+import components
+from components import OutputComponent, OutputRouter, ServoComponent
+from fixtures import NullBoard, sample_controller_data
+
+
+class NullScheduler(object):
+    ''' Stands in for a ServoScheduler, the tests move the servos themselves '''
+
+    def add(self, servo):
+        pass
+
+    def start(self):
+        pass
+
+
+class Clock(object):
+    ''' A monotonic clock the test moves on '''
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def perf_counter(self):
+        return time.perf_counter()
+
+
+@pytest.mark.parametrize('rate', [10, 30, 50])
+def test_servo_control_speed_does_not_depend_on_frame_rate(monkeypatch, rate):
+    clock = Clock()
+    monkeypatch.setattr(components, 'time', clock)
+    servo = ServoComponent(pca9685=NullBoard(), pca9685_channel=0, modifier='l_bump', max_pwm=1000, min_pwm=200,
+                           presets=[], control_speed=10, servo_speed=100, scheduler=NullScheduler())
+
+    data_dict = dict(sample_controller_data(), l_bump=1, up=1, down=0, r_stick_y=0)
+    for _ in range(rate):
+        clock.now += 1 / rate
+        servo.update(data_dict)
+
+    # control_speed every CONTROL_PERIOD, for a second
+    assert servo.target == 200 + 10 / ServoComponent.CONTROL_PERIOD
+
+
+class Recorder(OutputComponent):
+    ''' Remembers the frames it is updated with '''
+
+    def __init__(self, inputs, edge_keys=()):
+        self.inputs = inputs
+        self.edge_keys = edge_keys
+        self.frames = []
+
+    def update(self, data_dict):
+        self.frames.append(data_dict)
+
+
+def test_skipped_frames_only_update_edge_triggered_components():
+    led = Recorder(('a',), edge_keys=('a',))
+    motor = Recorder(('l_stick_y',))
+    router = OutputRouter([led, motor])
+
+    released = dict(sample_controller_data(), a=0)
+    pressed = dict(released, a=1, l_stick_y=0.5)
+    newest = dict(released, l_stick_y=0.75)
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(router.update(released))
+        loop.run_until_complete(router.update_edges(pressed))
+        loop.run_until_complete(router.update(newest))
+    finally:
+        loop.close()
+
+    # The LED sees the press and the release, the motor never sees the skipped frame
+    assert led.frames == [released, pressed, newest]
+    assert motor.frames == [released, newest]
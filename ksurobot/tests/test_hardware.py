@@ -0,0 +1,209 @@
+''' Tests for reading the adc and writing to the boards '''
+
+import asyncio
+import threading
+from contextlib import contextmanager
+
+import pytest
+
+import components
+import hardware
+from components import MotorComponent
+from hardware import (MAX192AEPP, MAX192AEPP_CHANNEL_TO_COMMAND, MOTOR_PRIORITY, SERVO_PRIORITY, I2CArbiter, I2CError,
+                      build_burst_command, process_burst_response)
+
+
+class FakeSpiDev(object):
+    ''' Answers transfers like the MAX192AEPP would with a set reading on each channel.
+        The 10 bit result of a conversion comes back in the two bytes after its command byte
+    '''
+
+    def __init__(self, readings):
+        self.readings = readings
+        self.transfers = []
+
+    def xfer2(self, command):
+        self.transfers.append(list(command))
+        response = [0] * len(command)
+        for i, byte in enumerate(command):
+            if byte & 0x80:
+                # A command byte starts a conversion
+                channel = MAX192AEPP_CHANNEL_TO_COMMAND.index((byte >> 4) & 0x7)
+                reading = self.readings[channel]
+                response[i + 1] |= reading >> 5
+                response[i + 2] |= (reading & 0x1f) << 3
+        return response
+
+
+READINGS = [0, 1, 31, 32, 511, 512, 1000, 1023]
+
+
+@pytest.fixture
+def adc(monkeypatch):
+    spi = FakeSpiDev(READINGS)
+    monkeypatch.setattr(hardware, 'spi', spi)
+    return spi
+
+
+def test_burst_command_overlaps_transfers():
+    # Each command byte goes out while the last byte of the previous result comes in
+    assert build_burst_command(list(range(8))) == [0x8f, 0, 0xcf, 0, 0x9f, 0, 0xdf, 0, 0xaf, 0, 0xef, 0, 0xbf, 0, 0xff, 0, 0]
+
+
+def test_read_all_channels_in_one_transfer(adc):
+    assert MAX192AEPP.read_channels(list(range(8))) == READINGS
+    assert adc.transfers == [[0x8f, 0, 0xcf, 0, 0x9f, 0, 0xdf, 0, 0xaf, 0, 0xef, 0, 0xbf, 0, 0xff, 0, 0]]
+
+
+def test_read_some_channels_in_order(adc):
+    channels = [7, 0, 3]
+    assert MAX192AEPP.read_channels(channels) == [READINGS[channel] for channel in channels]
+    assert adc.transfers == [[0xff, 0, 0x8f, 0, 0xdf, 0, 0]]
+
+
+def test_burst_matches_one_at_a_time(adc):
+    single = [MAX192AEPP.read_channel(channel) for channel in range(8)]
+    assert single == READINGS
+    assert adc.transfers == [[command, 0, 0] for command in (0x8f, 0xcf, 0x9f, 0xdf, 0xaf, 0xef, 0xbf, 0xff)]
+    assert MAX192AEPP.read_channels(list(range(8))) == single
+
+
+def test_process_burst_response():
+    response = FakeSpiDev(READINGS).xfer2(build_burst_command([2, 5]))
+    # The low bits of channel 2 come in while the command for channel 5 goes out
+    assert response == [0, READINGS[2] >> 5, (READINGS[2] & 0x1f) << 3, READINGS[5] >> 5, (READINGS[5] & 0x1f) << 3]
+    assert process_burst_response(response, 2) == [READINGS[2], READINGS[5]]
+
+
+def test_read_channels_checks_channels(adc):
+    with pytest.raises(ValueError):
+        MAX192AEPP.read_channels([0, 8])
+    assert MAX192AEPP.read_channels([]) == []
+    assert adc.transfers == []
+
+
+class FakeBoard(object):
+    ''' Stands in for a ShadowPCA9685, noting each write in events '''
+
+    def __init__(self, events, connected=True):
+        self.events = events
+        self.connected = connected
+        self.release = threading.Event() # Writes wait on this
+        self.release.set()
+        self.writing = threading.Event()
+        self.error = None
+
+    def set_pwm(self, channel, on, off):
+        self.writing.set()
+        self.release.wait()
+        if self.error:
+            raise self.error
+        self.events.append(('pwm', channel, off))
+
+    @contextmanager
+    def batch(self):
+        yield self
+
+
+@pytest.fixture
+def arbiter():
+    arbiter = I2CArbiter()
+    arbiter.start()
+    yield arbiter
+    arbiter.stop()
+
+
+def test_flush_times_out_on_a_stuck_bus(arbiter):
+    board = FakeBoard([])
+    board.release.clear()
+    arbiter.submit(board, MOTOR_PRIORITY, [(0, 0, 100)])
+    assert not arbiter.flush(0.05)
+
+    board.release.set()
+    assert arbiter.flush(1)
+
+
+def test_flush_skips_boards_that_never_connect(arbiter):
+    events = []
+    arbiter.submit(FakeBoard(events, connected=False), SERVO_PRIORITY, [(0, 0, 100)])
+    arbiter.submit(FakeBoard(events), MOTOR_PRIORITY, [(0, 0, 200)])
+    assert arbiter.flush(1)
+    assert events == [('pwm', 0, 200)]
+
+
+def test_waiters_fail_when_the_thread_dies(arbiter):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        board = FakeBoard([])
+        board.release.clear()
+        board.error = RuntimeError('not an OSError')
+        arbiter.submit(board, MOTOR_PRIORITY, [(0, 0, 100)])
+        written = arbiter.written(MOTOR_PRIORITY)
+        board.release.set()
+
+        with pytest.raises(I2CError):
+            loop.run_until_complete(asyncio.wait_for(written, 1))
+
+        # Nothing waits on the dead thread
+        arbiter.submit(board, MOTOR_PRIORITY, [(1, 0, 100)])
+        assert not arbiter.flush(1)
+        with pytest.raises(I2CError):
+            loop.run_until_complete(arbiter.written(MOTOR_PRIORITY))
+    finally:
+        loop.close()
+        asyncio.set_event_loop(asyncio.new_event_loop())
+
+
+def test_after_write_follows_the_newest_write(arbiter):
+    events = []
+    board = FakeBoard(events)
+    board.release.clear()
+    channel = arbiter.channel(board, MOTOR_PRIORITY)
+
+    # The first write is being made while the next two wait, the second is replaced by the third
+    channel.set_pwm(0, 0, 100)
+    assert board.writing.wait(1)
+    with channel.batch():
+        channel.set_pwm(0, 0, 200)
+        channel.after_write(0, lambda: events.append('after 200'))
+    channel.set_pwm(0, 0, 300)
+    board.release.set()
+    assert arbiter.flush(1)
+
+    assert events == [('pwm', 0, 100), ('pwm', 0, 300), 'after 200']
+
+    # Nothing waiting for the channel, so straight away
+    channel.after_write(0, lambda: events.append('now'))
+    assert events[-1] == 'now'
+
+
+def test_motor_direction_changes_after_its_duty_cycle(arbiter, monkeypatch):
+    events = []
+
+    class RecordingGPIO(object):
+        OUT = 0
+
+        def setup(self, pin, direction):
+            pass
+
+        def output(self, pin, value):
+            events.append(('gpio', pin, value))
+
+    monkeypatch.setattr(components, 'io', RecordingGPIO())
+    board = FakeBoard(events)
+    motor = MotorComponent(pca9685=arbiter.channel(board, MOTOR_PRIORITY), pca9685_channel=2, dir_pin=35)
+    assert arbiter.flush(1)
+    del events[:]
+
+    # Forwards while the write is being made, then backwards at the same speed
+    board.release.clear()
+    board.writing.clear()
+    motor.output(3000)
+    assert board.writing.wait(1)
+    motor.output(-3000)
+    assert events == []
+    board.release.set()
+    assert arbiter.flush(1)
+
+    assert events == [('pwm', 2, 3000), ('gpio', 35, 0), ('pwm', 2, 3000), ('gpio', 35, 1)]
@@ -0,0 +1,106 @@
+''' Tests for the binary message format '''
+
+import pytest
+
+from fixtures import controller_session
+from protocol import (CONTROLLER, CONTROLLER_DELTA_MESSAGE, CONTROLLER_MESSAGE, PROTOCOL_VERSION, SEQUENCE_MASK,
+                      BinaryCodec, get_axes, pack_buttons, sequence_after)
+
+TIMESTAMP = 123456
+
+
+def full_frames(session):
+    ''' Every frame of the session packed as a keyframe '''
+    sender = BinaryCodec(keyframe_interval=1)
+    return [sender.encode_controller(data_dict, TIMESTAMP) for data_dict in session]
+
+
+def rebuilt_frame(receiver, data_dict):
+    ''' The keyframe of a frame the receiver rebuilt, to compare with the full frame path '''
+    return CONTROLLER.pack(PROTOCOL_VERSION, CONTROLLER_MESSAGE, receiver.received_sequence, receiver.received_timestamp,
+                           pack_buttons(data_dict), *get_axes(data_dict))
+
+
+@pytest.mark.parametrize('keyframe_interval', [2, 5, 20])
+def test_delta_matches_full_frames(keyframe_interval):
+    session = controller_session(500)
+    sender, receiver = BinaryCodec(keyframe_interval), BinaryCodec(keyframe_interval)
+
+    for full, data_dict in zip(full_frames(session), session):
+        rebuilt = receiver.decode_controller(sender.encode_controller(data_dict, TIMESTAMP))
+        assert rebuilt == data_dict
+        assert rebuilt_frame(receiver, rebuilt) == full
+
+
+def test_keyframe_interval_rollover():
+    # Some frames change nothing, some change every field
+    session = controller_session(60)
+    session[10:20] = [session[9]] * 10
+    session[30] = {key: 1 - value if value in (0, 1) else -value - 1 for key, value in session[29].items()}
+
+    sender, receiver = BinaryCodec(keyframe_interval=5), BinaryCodec(keyframe_interval=5)
+    for i, data_dict in enumerate(session):
+        message = sender.encode_controller(data_dict, TIMESTAMP)
+        assert receiver.message_type(message) == (CONTROLLER_MESSAGE if i % 5 == 0 else CONTROLLER_DELTA_MESSAGE)
+        assert receiver.decode_controller(message) == data_dict
+
+
+def test_reset_after_reconnect():
+    session = controller_session(200)
+    sender, receiver = BinaryCodec(keyframe_interval=20), BinaryCodec(keyframe_interval=20)
+    for data_dict in session[:107]:
+        receiver.decode_controller(sender.encode_controller(data_dict))
+
+    # Both sides start over on a new connection, the next frame is a keyframe
+    sender.reset()
+    receiver.reset()
+    message = sender.encode_controller(session[107])
+    assert receiver.message_type(message) == CONTROLLER_MESSAGE
+    assert receiver.decode_controller(message) == session[107]
+    for data_dict in session[108:]:
+        assert receiver.decode_controller(sender.encode_controller(data_dict)) == data_dict
+
+
+def test_deltas_wait_for_keyframe_after_receiver_reset():
+    session = controller_session(200)
+    sender, receiver = BinaryCodec(keyframe_interval=20), BinaryCodec(keyframe_interval=20)
+    for data_dict in session[:107]:
+        receiver.decode_controller(sender.encode_controller(data_dict))
+
+    # Deltas to frames from before the reset can't be rebuilt, until the next keyframe at 120
+    receiver.reset()
+    for i, data_dict in enumerate(session[107:], 107):
+        expected = data_dict if i >= 120 else None
+        assert receiver.decode_controller(sender.encode_controller(data_dict)) == expected
+
+
+def test_sequence_wrap():
+    session = controller_session(SEQUENCE_MASK + 100)
+    sender, receiver = BinaryCodec(), BinaryCodec()
+
+    wrapped = False
+    for full, data_dict in zip(full_frames(session), session):
+        rebuilt = receiver.decode_controller(sender.encode_controller(data_dict, TIMESTAMP))
+        assert rebuilt == data_dict
+        assert rebuilt_frame(receiver, rebuilt) == full
+        wrapped = wrapped or receiver.received_sequence == 0
+    assert wrapped and receiver.received_sequence == len(session) & SEQUENCE_MASK
+
+
+def test_sequence_after_wrap():
+    assert sequence_after(0, SEQUENCE_MASK)
+    assert sequence_after(5, SEQUENCE_MASK - 5)
+    assert not sequence_after(SEQUENCE_MASK, 0)
+    assert not sequence_after(7, 7)
+
+
+def test_keyframe_from_before_wrap_is_dropped():
+    sender, receiver = BinaryCodec(keyframe_interval=1), BinaryCodec(keyframe_interval=1)
+    session = controller_session(SEQUENCE_MASK + 3)
+    messages = [sender.encode_controller(data_dict) for data_dict in session]
+
+    # Sequence 1 after the wrap arrives before SEQUENCE_MASK from before it, over UDP
+    assert receiver.decode_controller(messages[-2]) == session[-2]
+    assert receiver.decode_controller(messages[-4]) is None
+    assert receiver.out_of_order == 1
+    assert receiver.decode_controller(messages[-1]) == session[-1]
@@ -0,0 +1,34 @@
+''' Tests for recording controller frames '''
+
+import pytest
+
+from fixtures import controller_session
+from recording import SessionRecorder, read_recording
+
+
+def test_recording_reads_back(tmpdir):
+    frames = list(controller_session(frames=50))
+    recorder = SessionRecorder.in_directory(str(tmpdir))
+    for frame in frames:
+        recorder.record(frame)
+    recorder.close()
+
+    assert [data for _, data in read_recording(recorder.path)] == frames
+
+
+def test_recordings_started_together_get_their_own_files(tmpdir):
+    recorders = [SessionRecorder.in_directory(str(tmpdir)) for _ in range(3)]
+    for recorder in recorders:
+        recorder.close()
+
+    assert len(set(recorder.path for recorder in recorders)) == 3
+    assert len(tmpdir.listdir()) == 3
+    for recorder in recorders:
+        assert list(read_recording(recorder.path)) == []
+
+
+def test_recording_does_not_append_to_an_existing_one(tmpdir):
+    path = str(tmpdir.join('session.ksrec'))
+    SessionRecorder(path).close()
+    with pytest.raises(FileExistsError):
+        SessionRecorder(path)
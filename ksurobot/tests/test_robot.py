@@ -0,0 +1,48 @@
+''' Tests for the robot on the simulated hardware '''
+
+import asyncio
+
+import pytest
+
+import robot
+from fixtures import sample_controller_data
+from robot import Robot
+from settings import MOTOR_I2C_ADDRESS, SERVO_I2C_ADDRESS
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+    asyncio.set_event_loop(asyncio.new_event_loop())
+
+
+def failing_board(monkeypatch, failing_address):
+    ''' Make setting up the board at failing_address raise '''
+    open_pca9685 = robot.open_pca9685
+
+    def open_board(address):
+        if address == failing_address:
+            raise OSError('No board at {:#x}'.format(address))
+        return open_pca9685(address)
+
+    monkeypatch.setattr(robot, 'open_pca9685', open_board)
+
+
+@pytest.mark.parametrize('address', [MOTOR_I2C_ADDRESS, SERVO_I2C_ADDRESS])
+def test_frames_fail_when_a_board_could_not_be_set_up(monkeypatch, loop, address):
+    failing_board(monkeypatch, address)
+    bot = Robot()
+    try:
+        # Once the board has failed every frame does, not just the first
+        with pytest.raises(OSError):
+            loop.run_until_complete(bot.ready())
+        for _ in range(3):
+            with pytest.raises(OSError):
+                loop.run_until_complete(bot.update(sample_controller_data()))
+        with pytest.raises(OSError):
+            loop.run_until_complete(bot.update_edges(sample_controller_data()))
+    finally:
+        bot.stop()
@@ -0,0 +1,56 @@
+''' Tests for converting sensor readings to distances '''
+
+import os
+
+import pytest
+
+import settings
+from components import SensorComponent
+from hardware import MAX192AEPP_READINGS
+
+COEFFICIENTS = [getattr(settings, 'SENSOR_{}_COEFFICIENTS'.format(sensor)) for sensor in range(8)]
+
+
+@pytest.mark.parametrize('coefficients', COEFFICIENTS)
+def test_table_matches_polynomial(coefficients):
+    sensor = SensorComponent('test', 0, coefficients)
+    assert len(sensor.table) == MAX192AEPP_READINGS
+    for reading in range(MAX192AEPP_READINGS):
+        assert sensor.convert(reading) == sensor._convert_to_distance(reading)
+
+
+def test_cached_table_is_loaded(tmp_path, monkeypatch):
+    built = SensorComponent('test', 0, COEFFICIENTS[0], cache_dir=str(tmp_path))
+    assert len(os.listdir(str(tmp_path))) == 1
+
+    def build_table(self):
+        raise AssertionError('the table should come from the cache')
+    monkeypatch.setattr(SensorComponent, '_build_table', build_table)
+
+    cached = SensorComponent('test', 0, COEFFICIENTS[0], cache_dir=str(tmp_path))
+    assert cached.table == built.table
+
+
+def test_table_is_rebuilt_when_coefficients_change(tmp_path):
+    SensorComponent('test', 0, COEFFICIENTS[0], cache_dir=str(tmp_path))
+
+    changed = list(COEFFICIENTS[0])
+    changed[0] *= 2
+    sensor = SensorComponent('test', 0, changed, cache_dir=str(tmp_path))
+
+    # Saved under its own key, and worked out from the new coefficients
+    assert len(os.listdir(str(tmp_path))) == 2
+    assert sensor.convert(1865) == sensor._convert_to_distance(1865)
+    assert sensor.convert(1865) != SensorComponent('test', 0, COEFFICIENTS[0]).convert(1865)
+
+
+@pytest.mark.parametrize('size', [0, 100, 800])
+def test_short_cache_file_is_rebuilt(tmp_path, size):
+    SensorComponent('test', 0, COEFFICIENTS[0], cache_dir=str(tmp_path))
+    path = os.path.join(str(tmp_path), os.listdir(str(tmp_path))[0])
+    with open(path, 'r+b') as f:
+        f.truncate(size)
+
+    sensor = SensorComponent('test', 0, COEFFICIENTS[0], cache_dir=str(tmp_path))
+    assert sensor.table == SensorComponent('test', 0, COEFFICIENTS[0]).table
+    assert os.path.getsize(path) == MAX192AEPP_READINGS * sensor.table.itemsize
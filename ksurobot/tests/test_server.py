@@ -0,0 +1,145 @@
+''' Tests for the server keeping a client's session across reconnects '''
+
+import asyncio
+
+import pytest
+
+websockets = pytest.importorskip('websockets')
+
+import server
+from fixtures import sample_controller_data
+from protocol import get_codec, new_session_token, session_path, subprotocols
+from server import Server
+from settings import CONNECTION_CODECS
+
+
+class StubRobot(object):
+    ''' Stands in for the Robot, counting the frames applied and the stops '''
+
+    edge_keys = ()
+    i2c_time = 0
+
+    def __init__(self):
+        self.frames = 0
+        self.stops = 0
+
+    async def update(self, data_dict):
+        self.frames += 1
+
+    async def update_edges(self, data_dict):
+        pass
+
+    async def produce(self):
+        return {}
+
+    def performance(self):
+        return {}
+
+    def stop(self):
+        self.stops += 1
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+    asyncio.set_event_loop(asyncio.new_event_loop())
+
+
+def run_server(loop, test):
+    ''' Run test(server, connect) against a server on localhost driving a StubRobot,
+        connect(token) connects to it with token, or without one if it is None
+    '''
+    robot_server = Server('127.0.0.1', 0, StubRobot(), timeout=5, record_dir=None)
+
+    async def connect(token=None):
+        port = robot_server.server.sockets[0].getsockname()[1]
+        path = session_path(token) if token else '/'
+        return await websockets.connect('ws://127.0.0.1:{0}{1}'.format(port, path),
+                                        subprotocols=subprotocols(CONNECTION_CODECS))
+
+    async def run():
+        await robot_server.start_server()
+        try:
+            await asyncio.wait_for(test(robot_server, connect), 5)
+        finally:
+            await robot_server.shutdown()
+
+    loop.run_until_complete(run())
+
+
+async def send_frame(ws):
+    await ws.send(get_codec(ws.subprotocol).encode_controller(sample_controller_data()))
+
+
+async def wait_for(condition):
+    while not condition():
+        await asyncio.sleep(0.01)
+
+
+def test_reconnecting_resumes_the_session(loop):
+    async def test(robot_server, connect):
+        robot = robot_server.robot
+        token = new_session_token()
+
+        first = await connect(token)
+        await send_frame(first)
+        await wait_for(lambda: robot.frames == 1)
+        old_tasks = list(robot_server._sessions[token].tasks)
+
+        # The server hasn't noticed the first connection is gone when the client comes back
+        second = await connect(token)
+        await wait_for(lambda: robot_server.resumed_sessions == 1)
+        await asyncio.sleep(server.SERVER_SESSION_TIMEOUT * 2)
+
+        assert all(task.cancelled() for task in old_tasks)
+        assert robot.stops == 0
+
+        # And it carries on driving over the new one
+        await send_frame(second)
+        await wait_for(lambda: robot.frames == 2)
+
+        await first.close()
+        await second.close()
+
+    run_server(loop, test)
+
+
+def test_session_ends_after_the_timeout(loop):
+    async def test(robot_server, connect):
+        robot = robot_server.robot
+        token = new_session_token()
+
+        ws = await connect(token)
+        await send_frame(ws)
+        await wait_for(lambda: robot.frames == 1)
+        await ws.close()
+
+        # Kept going for the client to reconnect
+        await asyncio.sleep(server.SERVER_SESSION_TIMEOUT / 2)
+        assert robot.stops == 0
+        assert token in robot_server._sessions
+
+        await asyncio.sleep(server.SERVER_SESSION_TIMEOUT)
+        assert robot.stops == 1
+        assert token not in robot_server._sessions
+        assert robot_server.resumed_sessions == 0
+
+    run_server(loop, test)
+
+
+def test_client_without_a_token_stops_the_robot_when_it_disconnects(loop):
+    async def test(robot_server, connect):
+        robot = robot_server.robot
+
+        ws = await connect()
+        await send_frame(ws)
+        await wait_for(lambda: robot.frames == 1)
+        await ws.close()
+
+        await asyncio.wait_for(wait_for(lambda: robot.stops == 1), server.SERVER_SESSION_TIMEOUT / 2)
+        assert not robot_server._sessions
+
+    run_server(loop, test)
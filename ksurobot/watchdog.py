@@ -0,0 +1,122 @@
+''' watchdog.py
+
+    Stop the robot when the controller frames stop coming
+'''
+
+import asyncio
+import logging
+import subprocess
+
+from metrics import Histogram
+
+
+class Watchdog(object):
+    ''' Trips when no controller frame arrives for timeout seconds.
+
+        Feeding it only notes the time, a single timer checks the deadline
+        when it comes. When it trips it steps up:
+        1. the robot is stopped straight away
+        2. the connections are closed, so the client reconnects
+        3. if nothing reconnects within reboot_after, reboot_command is run
+    '''
+
+    def __init__(self, timeout, stop, close, reboot_after=None, reboot_command=None):
+        ''' - timeout: longest to go without a frame (sec)
+            - stop: stops the robot
+            - close: coroutine function that closes the connections
+            - reboot_after: time after tripping to wait for a reconnect before rebooting (sec), None to never reboot
+            - reboot_command: the command to reboot with
+        '''
+        self.timeout = timeout
+        self.stop = stop
+        self.close = close
+        self.reboot_after = reboot_after
+        self.reboot_command = reboot_command
+        self.logger = logging.getLogger('__main__')
+
+        self._loop = None
+        self._last_feed = None
+        self._deadline = None
+        self._reboot = None
+        self._tripped_at = None
+
+        self.trips = 0
+        self.time_to_stop = Histogram()     # From the missed deadline until the robot was stopped (ms)
+        self.time_to_resume = Histogram()   # From the missed deadline until frames came again (ms)
+
+    def feed(self):
+        ''' Push the deadline back, called for every controller frame '''
+        if self._loop is None:
+            self._loop = asyncio.get_event_loop()
+
+        now = self._loop.time()
+        self._last_feed = now
+
+        if self._tripped_at is not None:
+            self._resumed(now)
+        if self._deadline is None:
+            self._deadline = self._loop.call_at(now + self.timeout, self._check)
+
+    def disarm(self):
+        ''' Stop waiting for frames, when the connection was closed on purpose.
+            A reboot already waiting for a reconnect after tripping still happens
+        '''
+        if self._deadline:
+            self._deadline.cancel()
+            self._deadline = None
+
+    def shutdown(self):
+        ''' Cancel everything, the server is shutting down '''
+        self.disarm()
+        if self._reboot:
+            self._reboot.cancel()
+            self._reboot = None
+
+    def _check(self):
+        ''' The deadline was reached, trip unless fed since it was set '''
+        deadline = self._last_feed + self.timeout
+        if self._loop.time() < deadline:
+            self._deadline = self._loop.call_at(deadline, self._check)
+            return
+
+        self._deadline = None
+        self._trip(deadline)
+
+    def _trip(self, deadline):
+        self.trips += 1
+        self._tripped_at = deadline
+
+        self.stop()
+        time_to_stop = (self._loop.time() - deadline) * 1000
+        self.time_to_stop.record(time_to_stop)
+        self.logger.warn('Watchdog: no controller frame for {0} sec, stopped the robot {1:.1f} ms after the deadline'.format(
+            self.timeout, time_to_stop))
+
+        # Make the client reconnect
+        asyncio.ensure_future(self.close())
+
+        if self.reboot_after is not None and self.reboot_command:
+            self._reboot = self._loop.call_later(self.reboot_after, self._reboot_now)
+
+    def _resumed(self, now):
+        time_to_resume = (now - self._tripped_at) * 1000
+        self._tripped_at = None
+        self.time_to_resume.record(time_to_resume)
+        self.logger.info('Watchdog: controller frames resumed {:.0f} ms after the deadline'.format(time_to_resume))
+
+        if self._reboot:
+            self._reboot.cancel()
+            self._reboot = None
+
+    def _reboot_now(self):
+        self._reboot = None
+        self.logger.warn('Watchdog: nothing reconnected within {0} sec, running {1}'.format(
+            self.reboot_after, ' '.join(self.reboot_command)))
+        subprocess.run(self.reboot_command)
+
+    def stats(self):
+        return {
+            'trips': self.trips,
+            'time_to_stop': self.time_to_stop.summary(),
+            'time_to_resume': self.time_to_resume.summary(),
+        }
@@ -3,6 +3,7 @@
     Responsable for getting information directly from controller
 '''
 
+import ctypes
 from math import isclose
 from collections import namedtuple
 import sdl2
@@ -16,6 +17,11 @@ DeviceEvent = namedtuple('DeviceEvent', ['number'])
 
 
 class AbstractState(object):
+    ''' The state of one button or axis. Events are passed to process_value
+        as just their value, so nothing is made for each one
+    '''
+    __slots__ = ()
+
     def __init__(self):
         pass
 
@@ -36,6 +42,9 @@ class AbstractState(object):
         pass
 
     def process_event(self, event):
+        self.process_value(event.state)
+
+    def process_value(self, value):
         raise NotImplemented()
 
     def value(self):
@@ -46,22 +55,26 @@ class AbstractState(object):
 
 
 class CurrentButtonState(AbstractState):
+    __slots__ = ('_value',)
+
     def __init__(self):
         self._value = False
 
-    def process_event(self, event):
-        self._value = event.state
+    def process_value(self, value):
+        self._value = value
 
     def value(self):
         return self._value
 
 
 class ToggleButtonState(AbstractState):
+    __slots__ = ('_value',)
+
     def __init__(self):
         self._value = False
 
-    def process_event(self, event):
-        self._value ^= event.state
+    def process_value(self, value):
+        self._value ^= value
 
     def value(self):
         return self._value
@@ -71,11 +84,13 @@ class ToggleButtonState(AbstractState):
 
 
 class ClickedButtonState(AbstractState):
+    __slots__ = ('_value',)
+
     def __init__(self):
         self._value = False
 
-    def process_event(self, event):
-        self._value |= event.state
+    def process_value(self, value):
+        self._value |= value
 
     def value(self):
         return self._value
@@ -85,6 +100,8 @@ class ClickedButtonState(AbstractState):
 
 
 class DecimalAxisState(AbstractState):
+    __slots__ = ('zero_value', '__value')
+
     VAR_MAX = 32767
     VAR_MIN = -32768
 
@@ -92,8 +109,8 @@ class DecimalAxisState(AbstractState):
         self.zero_value = 0
         self.__value = 0
 
-    def process_event(self, event: AxisEvent):
-        self.__value = event.state
+    def process_value(self, value):
+        self.__value = value
 
     def value(self):
         normal = self.__value - self.zero_value
@@ -111,6 +128,8 @@ class DecimalAxisState(AbstractState):
 
 
 class DecimalTriggerState(AbstractState):
+    __slots__ = ('zero_value', '__value')
+
     VAR_MAX = 32767
     VAR_MIN = -32768
 
@@ -118,20 +137,22 @@ class DecimalTriggerState(AbstractState):
         self.zero_value = 0
         self.__value = 0
 
-    def process_event(self, event: AxisEvent):
-        self.__value = event.state
+    def process_value(self, value):
+        self.__value = value
 
     def value(self):
         return (self.__value - self.VAR_MIN) / (self.VAR_MAX - self.VAR_MIN)
 
 
 class PulledTriggerState(DecimalTriggerState):
+    __slots__ = ('_value',)
+
     def __init__(self):
         super().__init__()
         self._value = False
 
-    def process_event(self, event):
-        super().process_event(event)
+    def process_value(self, value):
+        super().process_value(value)
         self._value |= super().value() > .9
 
     def value(self):
@@ -142,11 +163,13 @@ class PulledTriggerState(DecimalTriggerState):
 
 
 class HatState(AbstractState):
+    __slots__ = ('__value',)
+
     def __init__(self):
         self.__value = 0
 
-    def process_event(self, event: HatEvent):
-        self.__value = event.state
+    def process_value(self, value):
+        self.__value = value
 
     def value(self):
         value = self.__value
@@ -168,12 +191,14 @@ class HatState(AbstractState):
 
 
 class HatSwitchesState(HatState):
+    __slots__ = ('__value',)
+
     def __init__(self):
         super().__init__()
         self.__value = set()
 
-    def process_event(self, event):
-        super().process_event(event)
+    def process_value(self, value):
+        super().process_value(value)
         self.__value.add(super().value().strip())
 
     def value(self):
@@ -194,6 +219,11 @@ class Controller(object):
         self.haptic = sdl2.haptic.SDL_HapticOpenFromJoystick(self.device)
         sdl2.haptic.SDL_HapticRumbleInit(self.haptic)
 
+        self._create_states()
+        self.zero()
+
+    def _create_states(self):
+        ''' Make the state of every button and axis, and what is needed to read events into them '''
         self.a = CurrentButtonState()
         self.b = CurrentButtonState()
         self.x = CurrentButtonState()
@@ -215,7 +245,22 @@ class Controller(object):
 
         self.hat = HatState()
 
-        self.zero()
+        # In the order SDL numbers them
+        self._buttons = (
+            self.a, self.b, self.x, self.y,
+            self.left_bumper, self.right_bumper,
+            self.start_button, self.select_button, self.center_button,
+            self.left_stick_button, self.right_stick_button)
+        self._axes = (
+            self.left_x, self.left_y, self.left_trigger,
+            self.right_x, self.right_y, self.right_trigger)
+
+        # Every event is read into this one, the fields are views into it
+        self._event = sdl2.SDL_Event()
+        self._event_pointer = ctypes.byref(self._event)
+        self._jbutton = self._event.jbutton
+        self._jaxis = self._event.jaxis
+        self._jhat = self._event.jhat
 
     @classmethod
     def init(cls):
@@ -226,15 +271,55 @@ class Controller(object):
             axis.zero(sdl2.joystick.SDL_JoystickGetAxis(self.device, i))
 
     def _axises(self):
-        axis_array = (
-            self.left_x, self.left_y, self.left_trigger,
-            self.right_x, self.right_y, self.right_trigger)
-        return axis_array
+        return self._axes
 
     def get_name(self):
         return sdl2.joystick.SDL_JoystickName(self.device)
 
     def update(self):
+        ''' Process the events waiting for the controller,
+            return how many there were
+        '''
+        sdl2.SDL_JoystickUpdate()
+
+        event_pointer = self._event_pointer
+        process_event = self._process_event
+
+        count = 0
+        while sdl2.SDL_PollEvent(event_pointer):
+            count += 1
+            process_event()
+
+        return count
+
+    def wait(self, timeout):
+        ''' Wait up to timeout (sec) for an event, then process every event waiting.
+            Return how many there were
+        '''
+        if not sdl2.SDL_WaitEventTimeout(self._event_pointer, int(timeout * 1000)):
+            return 0
+        self._process_event()
+        return 1 + self.update()
+
+    def _process_event(self):
+        ''' Pass the event just read to the button or axis it is for '''
+        event_type = self._event.type
+
+        # Axes first, a moving stick sends far more events than anything else
+        if event_type == sdl2.SDL_JOYAXISMOTION:
+            jaxis = self._jaxis
+            self._axes[jaxis.axis].process_value(jaxis.value)
+        elif event_type == sdl2.SDL_JOYBUTTONDOWN:
+            self._buttons[self._jbutton.button].process_value(True)
+        elif event_type == sdl2.SDL_JOYBUTTONUP:
+            self._buttons[self._jbutton.button].process_value(False)
+        elif event_type == sdl2.SDL_JOYHATMOTION:
+            self.hat.process_value(self._jhat.value)
+
+    def update_events(self):
+        ''' Process the events waiting for the controller the original way,
+            making an event for each one. Kept to compare against in benchmark.py
+        '''
         sdl2.SDL_JoystickUpdate()
 
         button_array = (
@@ -245,7 +330,8 @@ class Controller(object):
 
         axis_array = self._axises()
 
-        for event in sdl2.ext.get_events():
+        events = sdl2.ext.get_events()
+        for event in events:
             if event.type == sdl2.SDL_JOYBUTTONUP:
                 button_array[event.jbutton.button].process_event(
                     ButtonEvent(event.jbutton.timestamp, False))
@@ -260,6 +346,9 @@ class Controller(object):
 
             # elif event.type == sdl2.SDL_JOYDEVICEADDED:
             # elif event.type == sdl2.SDL_JOYDEVICEREMOVED:
+
+        return len(events)
+
 def Test():
     import time
     Controller.init()